@@ -1,9 +1,8 @@
 import secrets
-import pandas as pd
-from typing import Callable, Annotated, Union
+from typing import Callable, Annotated, Optional, Tuple, Union
 
 from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, Request, Body, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.routing import APIRoute
 from fastapi.exceptions import RequestValidationError
@@ -23,6 +22,10 @@ from app.models.constants import constants
 from app.models.conversations_response import SupportingContentRecord, SupportingImageRecord, ApproachResponse
 from app.services.langchain_service import LangchainService
 from app.services.azure_blob_storage import AzureBlobStorageService
+from app.services.chat_stream_service import ChatStreamService, ChatStreamEvent, to_server_sent_event
+from app.services.chat_coalescing import chat_single_flight, chat_request_key
+from app.core.concurrency import OverloadedError, chat_limiter
+from app.services.conversation_store import ConversationNotFoundError, conversation_store, record_conversation_turn, resolve_conversation
 
 import logging
 import uuid
@@ -56,9 +59,10 @@ async def create_conversations(
 
     try:
         logger.info("conversations API call start...")
+        owner = current_claims.sub
 
         _obj_token_dbcontext = token_dbcontext()
-        ds = _obj_token_dbcontext.get_api_consumer_details(current_claims.sub)
+        ds = await _obj_token_dbcontext.get_api_consumer_details_async(owner)
         access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = auth_jwt.create_access_token(
             data=ds, expires_delta=access_token_expires
@@ -70,6 +74,10 @@ async def create_conversations(
                              conversationId=str(uuid.uuid4()),
                              expires_in=int(expire.timestamp()),
                              streamUrl=str(streamUrl))
+
+        # the conversation state lives as long as its token
+        if conversation_store is not None:
+            await conversation_store.acreate(conv.conversationId, expires_at=expire.timestamp(), owner=owner)
         
         logger.info("conversations API call end...")
 
@@ -103,38 +111,77 @@ def chat(request: RequestModel):
         error=dummy_response.error
     )
 
+async def resolve_chat_request(request: RequestModel, owner: Optional[str]):
+    try:
+        return await resolve_conversation(request, owner)
+    except ConversationNotFoundError as ex:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(ex))
+
+def too_many_requests(ex: OverloadedError) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                         detail=str(ex),
+                         headers={"Retry-After": str(ex.retry_after_seconds)})
+
 @router.post("/chat", response_model=ResponseModel)
-def chat(request: RequestModel):
+async def chat(
+    request: RequestModel,
+    owner: Annotated[Optional[str], Depends(auth_jwt.get_optional_token_subject)]
+):
+
+    # with a conversationId the history comes from the conversation store
+    request, conversation = await resolve_chat_request(request, owner)
+
+    try:
+        # the same request sent again while in flight, e.g. a retry, runs the pipeline once, errors reach every caller
+        if chat_single_flight is not None:
+            response, turn = await chat_single_flight.ado(chat_request_key(request, owner), lambda: get_limited_chat_response(request))
+        else:
+            response, turn = await get_limited_chat_response(request)
+
+    except OverloadedError as ex:
+        raise too_many_requests(ex)
+
+    # the answer becomes a turn of the conversation, unless degraded
+    await record_conversation_turn(conversation, request.lastUserQuestion, **turn)
+
+    return response
+
+async def get_limited_chat_response(request: RequestModel) -> Tuple[ResponseModel, dict]:
+
+    # at most CHAT_MAX_CONCURRENT pipelines, the others queue or get a 429
+    async with chat_limiter.slot():
+        return await get_chat_response(request)
+
+async def get_chat_response(request: RequestModel) -> Tuple[ResponseModel, dict]:
+    '''
+    :return: the response and the turn to record in the conversation (see record_conversation_turn)
+    '''
 
     langchain_service = LangchainService()
     # chat_response = langchain_service.get_chat_response(request)
 
-    chat_response = langchain_service.get_chat_response_with_history(request)
+    chat_response = await langchain_service.aget_chat_response_with_history(request)
 
     if chat_response['context']:
 
         source_doc_list = langchain_service.get_source_doc_list(chat_response['context'])
         # print(source_doc_list)
 
-        str_doc = ""
-        for singdoc in source_doc_list:
-            str_doc += "["+singdoc+"]"
+        str_doc = langchain_service.format_source_docs(source_doc_list)
 
         chat_answer = chat_response['answer']['answer'] 
         chat_answer = chat_answer + " " + str_doc
 
-        follow_up_q_list = langchain_service.generate_queries(request.lastUserQuestion)
+        # generated with the answer, see FollowupQuestionsMode
+        follow_up_q_list = langchain_service.get_followup_questions(request, chat_response['answer'])
 
-        str_follow_up_q = ""
-        for sing_q in follow_up_q_list:
-            sing_q = ''.join([i for i in sing_q if not i.isdigit()])
-            sing_q = sing_q.replace("- ", "")
-            str_follow_up_q += "<<"+sing_q+">>"
+        if follow_up_q_list:
+            str_follow_up_q = langchain_service.format_follow_up_questions(follow_up_q_list)
 
-        chat_answer = chat_answer + " " + str_follow_up_q
+            chat_answer = chat_answer + " " + str_follow_up_q
 
         blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client)
-        sas_url = blob_storage.get_sas_url_async(blob_name=source_doc_list[0])
+        sas_url = await blob_storage.aget_sas_url(blob_name=source_doc_list[0])
 
         final_response = ApproachResponse(
             answer=chat_answer,
@@ -157,6 +204,10 @@ def chat(request: RequestModel):
             citation_base_url="http://127.0.0.1:10000/"
         )
 
+    turn = {"answer": chat_response['answer'],
+            "standalone_question": langchain_service.standalone_question,
+            "sources": langchain_service.get_source_doc_list(chat_response['context'])}
+
     return ResponseModel(
         answer=final_response.answer,
         thoughts=final_response.thoughts,
@@ -164,4 +215,34 @@ def chat(request: RequestModel):
         images=final_response.images,
         citation_base_url=final_response.citation_base_url,
         error=final_response.error
-    )
\ No newline at end of file
+    ), turn
+
+@router.post("/chat/stream")
+async def chat_stream(
+    request: RequestModel,
+    owner: Annotated[Optional[str], Depends(auth_jwt.get_optional_token_subject)]
+):
+
+    request, conversation = await resolve_chat_request(request, owner)
+
+    # reject before the response starts, the slot itself is taken by the stream
+    try:
+        chat_limiter.admit()
+    except OverloadedError as ex:
+        raise too_many_requests(ex)
+
+    langchain_service = LangchainService()
+    blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client)
+    chat_stream_service = ChatStreamService(langchain_service=langchain_service, blob_storage=blob_storage)
+
+    async def event_stream():
+        try:
+            async with chat_limiter.slot():
+                async for event, payload in chat_stream_service.stream(request, conversation):
+                    yield to_server_sent_event(event, payload)
+        except OverloadedError as ex:
+            yield to_server_sent_event(ChatStreamEvent.ERROR, {"error": str(ex), "retry_after": ex.retry_after_seconds})
+
+    return StreamingResponse(event_stream(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,5 +1,4 @@
 import secrets
-import pandas as pd
 from typing import Callable, Annotated, Union
 
 from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, Request, Body, Response, UploadFile, File
@@ -11,6 +10,7 @@ from fastapi.encoders import jsonable_encoder
 from datetime import datetime, timedelta, timezone
 
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 
 from app.schemas.token_schema import AccessTokenSchema, TokenRequestBodyPayload, TokenClaim
 from app.schemas.conversations_schema import Conversations
@@ -48,11 +48,17 @@ blob_service_client = BlobServiceClient.from_connection_string(connect_str)
 # Create the container
 container_client = blob_service_client.get_container_client(container_name)
 
+# Async clients for listings and uploads, closed with the application
+async_blob_service_client = AsyncBlobServiceClient.from_connection_string(connect_str)
+async_container_client = async_blob_service_client.get_container_client(container_name)
+router.add_event_handler("shutdown", async_blob_service_client.close)
+
 @router.post("/documents")
 async def on_post_document_async(files: list[UploadFile] = File(...)):
     try:
-        blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client)
+        blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client, async_container_client=async_container_client)
 
+        # cached answers are invalidated by the ingestion function once the documents are indexed
         result = await blob_storage.upload_files_async(files=files)
 
         return result
@@ -64,7 +70,7 @@ async def on_post_document_async(files: list[UploadFile] = File(...)):
 @router.get("/documents")
 async def on_get_documents_async():
     try:
-        blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client)
+        blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client, async_container_client=async_container_client)
         
         result = await blob_storage.on_get_documents_async()
         
@@ -30,7 +30,7 @@ async def login_for_access_token(
     try:
         logger.info("token API call start...")
         _obj_token_dbcontext = token_dbcontext()
-        ds = _obj_token_dbcontext.get_api_consumer_details(form_data.username)
+        ds = await _obj_token_dbcontext.get_api_consumer_details_async(form_data.username)
 
         if ds is None:
             raise HTTPException(
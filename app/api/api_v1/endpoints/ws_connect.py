@@ -1,5 +1,4 @@
 import secrets
-import pandas as pd
 from typing import Callable, Annotated, Union
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, WebSocketException, APIRouter, Depends, Query, HTTPException, status, Request, Body, Response
@@ -8,6 +7,7 @@ from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2PasswordBear
 from fastapi.routing import APIRoute
 from fastapi.exceptions import RequestValidationError
 from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
 from datetime import datetime, timedelta, timezone
 
 from app.schemas.token_schema import AccessTokenSchema, TokenRequestBodyPayload, TokenClaim
@@ -19,9 +19,23 @@ from app.dbcontext.db_token import token_dbcontext
 from app.handlers import exception_handler, log_database_handler
 from app.models.constants import constants
 from app.services.ws_connection_manager import ws_connection_manager
+from app.services.langchain_service import LangchainService
+from app.services.azure_blob_storage import AzureBlobStorageService
+from app.core.concurrency import OverloadedError, chat_limiter
+from app.services.conversation_store import ConversationNotFoundError, resolve_conversation
+from app.services.chat_stream_service import ChatStreamService, ChatStreamEvent, parse_directline_request, to_directline_activity, to_directline_activity_set
+
+from azure.storage.blob import BlobServiceClient
 
 import logging
 import uuid
+import os
+
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+connect_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
+container_name = os.environ["AZURE_STORAGE_BLOB_CONTAINERS"]
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -32,6 +46,12 @@ router = APIRouter(route_class=exception_handler.ValidationErrorLoggingRoute)
 
 security = HTTPBasic()
 
+# Create the BlobServiceClient object
+blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+
+# Create the container
+container_client = blob_service_client.get_container_client(container_name)
+
 async def get_token_param(
     t: Annotated[str | None, Query()] = None
 ):
@@ -58,9 +78,57 @@ async def websocket_endpoint(
 
     try:
         await ws_connection_manager.connect(websocket)
+
+        # the conversation is resolved for the holder of the stream token
+        try:
+            owner = auth_jwt.decode_access_token(t).get("sub")
+        except HTTPException:
+            owner = None
+
+        sequence = int(watermark) if watermark and watermark.isdigit() else 0
+
         while True:
             data = await websocket.receive_json()
-            await websocket.send_json(data)
+
+            try:
+                request, reply_to_id = parse_directline_request(data)
+            except ValidationError as ex:
+                sequence += 1
+                activity = to_directline_activity(ChatStreamEvent.ERROR, {"error": str(ex)}, conversation_id=conversationId, sequence=sequence)
+                await websocket.send_json(to_directline_activity_set(activity, watermark=sequence))
+                continue
+
+            if request is None:
+                await websocket.send_json(data)
+                continue
+
+            logger.info("conversation stream call start...")
+
+            # the conversation of the stream holds the history, unless the client sends it
+            request = request.model_copy(update={"conversationId": request.conversationId or conversationId})
+            try:
+                request, conversation = await resolve_conversation(request, owner)
+            except ConversationNotFoundError:
+                # e.g. created by another worker with the in-memory store, answered without history
+                conversation = None
+
+            langchain_service = LangchainService()
+            blob_storage = AzureBlobStorageService(blob_service_client=blob_service_client ,container_client=container_client)
+            chat_stream_service = ChatStreamService(langchain_service=langchain_service, blob_storage=blob_storage)
+
+            try:
+                async with chat_limiter.slot():
+                    async for event, payload in chat_stream_service.stream(request, conversation):
+                        sequence += 1
+                        activity = to_directline_activity(event, payload, conversation_id=conversationId, sequence=sequence, reply_to_id=reply_to_id)
+                        await websocket.send_json(to_directline_activity_set(activity, watermark=sequence))
+            except OverloadedError as ex:
+                sequence += 1
+                activity = to_directline_activity(ChatStreamEvent.ERROR, {"error": str(ex), "retry_after": ex.retry_after_seconds},
+                                                  conversation_id=conversationId, sequence=sequence, reply_to_id=reply_to_id)
+                await websocket.send_json(to_directline_activity_set(activity, watermark=sequence))
+
+            logger.info("conversation stream call end...")
             # await websocket.send_text(f"Message text was: {data} " + conversationId + watermark + connectionId + t)
 
     except WebSocketDisconnect:
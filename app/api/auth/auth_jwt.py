@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta, timezone
-from typing import Any, Union, Annotated
+from typing import Any, Optional, Union, Annotated
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import jwt, ExpiredSignatureError, JWTError
+from pydantic import ValidationError
 from passlib.context import CryptContext
 
 from app.schemas.token_schema import User, TokenData, TokenClaim
 from app.dbcontext.db_token import token_dbcontext
+from app.dbcontext.db_pool import run_in_db_executor
 from app.core.config import settings
 from app.models.constants import constants
 import time
@@ -15,6 +17,7 @@ import time
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 def decode_access_token(token: str) -> dict:
     try:
@@ -38,12 +41,11 @@ def get_user(username: str):
     if ds is None:
         return None
     
-    User.username = str(ds[0]['user_name'])
-    User.full_name = str(ds[0]['full_name'])
-    User.email = str(ds[0]['email'])
-    User.disabled = bool(ds[0]['disabled'])
-
-    return User
+    # an instance per call, lookups run concurrently on the database threads
+    return User(username=str(ds[0]['user_name']),
+                full_name=str(ds[0]['full_name']),
+                email=str(ds[0]['email']),
+                disabled=bool(ds[0]['disabled']))
     
 # def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
 #     to_encode = data.copy()
@@ -97,7 +99,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     except JWTError:
         raise credentials_exception
     
-    user = get_user(username=token_data.username)
+    user = await run_in_db_executor(get_user, username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
@@ -128,20 +130,29 @@ async def get_current_claims(token: Annotated[str, Depends(oauth2_scheme)]):
         if payload is None:
             raise credentials_exception
 
-        TokenClaim.client_id = payload.get("client_id")
-        TokenClaim.sub = payload.get("sub")
-        TokenClaim.exp = payload.get("exp")
-        TokenClaim.iss = payload.get("iss")
+        # an instance per request, the class is shared by the concurrent ones
+        claims = TokenClaim(client_id=payload.get("client_id"),
+                            sub=payload.get("sub"),
+                            exp=payload.get("exp"),
+                            iss=payload.get("iss"))
 
     except ExpiredSignatureError:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=constants.TOKEN_EXPIRED)
-    except JWTError:
+    except (JWTError, ValidationError):
         raise credentials_exception
     
-    return TokenClaim
+    return claims
 
 async def get_current_token_claims(
     current_claims: Annotated[TokenClaim, Depends(get_current_claims)]
 ):
     
-    return current_claims
\ No newline at end of file
+    return current_claims
+
+async def get_optional_token_subject(
+    token: Annotated[Optional[str], Depends(optional_oauth2_scheme)]
+) -> Optional[str]:
+    # anonymous callers get None, an invalid or expired token is still rejected
+    if token is None:
+        return None
+    return decode_access_token(token).get("sub")
@@ -0,0 +1,10 @@
+from fastapi import APIRouter, Response
+
+from app.core.telemetry import telemetry
+
+router = APIRouter()
+
+@router.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = telemetry.metrics_response()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,76 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+
+from app.core.config import settings
+
+class OverloadedError(Exception):
+    def __init__(self, message: str, retry_after_seconds: int):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+class ConcurrencyLimiter:
+    '''
+    Bounds the executions running at once (max_concurrent) and waiting for a slot (max_queued).
+    A caller finding the queue full, or waiting longer than queue_timeout_seconds, gets an
+    OverloadedError whose retry_after_seconds estimates when a slot frees up, from a moving average
+    of recent execution times. Meant for a single event loop.
+    '''
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout_seconds: float, initial_duration_seconds: float = 5.0):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._average_seconds = initial_duration_seconds
+
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        # time for the callers ahead to drain through the slots
+        return max(1, math.ceil(self._average_seconds * (self.queued + 1) / self.max_concurrent))
+
+    def _overloaded(self, reason: str) -> OverloadedError:
+        self.rejected += 1
+        return OverloadedError(f"Too many concurrent requests, {reason}", retry_after_seconds=self.retry_after())
+
+    def admit(self):
+        '''Raise OverloadedError right away if a new caller could neither run nor queue.'''
+        if self._semaphore.locked() and self.queued >= self.max_queued:
+            raise self._overloaded("the queue is full")
+
+    @asynccontextmanager
+    async def slot(self):
+        self.admit()
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            raise self._overloaded(f"no slot became free within {self.queue_timeout_seconds}s") from None
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            self._average_seconds = 0.8 * self._average_seconds + 0.2 * (time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {"active": self.active,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "average_seconds": round(self._average_seconds, 3)}
+
+# LLM pipelines of /chat, /chat/stream and the Direct Line stream
+chat_limiter = ConcurrencyLimiter(max_concurrent=settings.CHAT_MAX_CONCURRENT,
+                                  max_queued=settings.CHAT_MAX_QUEUED,
+                                  queue_timeout_seconds=settings.CHAT_QUEUE_TIMEOUT_SECONDS)
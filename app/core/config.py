@@ -3,7 +3,7 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 # from azure.keyvault.secrets import SecretClient
 
 import json
-from typing import List
+from typing import Dict, List, Optional
 from pydantic import AnyHttpUrl
 from cryptography.fernet import Fernet
 
@@ -47,6 +47,24 @@ class Settings(BaseSettings):
     CONNECTION_STRINGS:  str  = 'DRIVER={ODBC Driver 18 for SQL Server};SERVER=.\SQLEXPRESS;DATABASE=MusaddiqueHussainLabs;Trusted_Connection=yes;TrustServerCertificate=yes'
     ISSUER: str = 'http://localhost:8080'
 
+    # Database connection pool and the executor running blocking database calls for async routes
+    DB_POOL_MAX_SIZE: int = 10
+    DB_POOL_MAX_LIFETIME_SECONDS: int = 1800
+    DB_POOL_ACQUIRE_TIMEOUT_SECONDS: int = 5
+    DB_EXECUTOR_MAX_WORKERS: int = 10
+
+    # Cache of API consumer details used for authentication, CONSUMER_CACHE_TTL_SECONDS = 0 disables it
+    CONSUMER_CACHE_TTL_SECONDS: int = 300
+    CONSUMER_CACHE_NEGATIVE_TTL_SECONDS: int = 30
+    CONSUMER_CACHE_MAX_ENTRIES: int = 10000
+
+    # Database logging (LogDBHandler), records are written in batches by a background thread
+    # LOG_DB_OVERFLOW_POLICY: "drop_newest", "drop_oldest" or "block"
+    LOG_DB_BATCH_SIZE: int = 100
+    LOG_DB_FLUSH_INTERVAL_SECONDS: float = 1.0
+    LOG_DB_QUEUE_SIZE: int = 10000
+    LOG_DB_OVERFLOW_POLICY: str = "drop_newest"
+
     # JWT Config
     JWT_KEY: str = 'ee8b0035a3ea72d26ba26806e576c9bb961559b66cc3432f80ce41a88f259155'
     TID: str = '3c55a074-b53c-43f6-8feb-480e8c35ae2b'
@@ -59,4 +77,141 @@ class Settings(BaseSettings):
 
     STREAM_BASE_URL: str = "ws://localhost:8080/"
 
+    # SAS URLs of blobs are reused until SAS_URL_REFRESH_MARGIN_MINUTES before they expire
+    # SAS_USE_USER_DELEGATION_KEY signs with a user delegation key (Azure AD, AZURE_STORAGE_ACCOUNT_URL) instead of the account key
+    SAS_URL_VALIDITY_MINUTES: int = 30
+    SAS_URL_REFRESH_MARGIN_MINUTES: int = 5
+    SAS_URL_CACHE_MAX_ENTRIES: int = 10000
+    SAS_USE_USER_DELEGATION_KEY: bool = False
+    SAS_USER_DELEGATION_KEY_VALIDITY_HOURS: int = 24
+
+    # Document uploads are streamed in blocks of UPLOAD_BLOCK_SIZE_MB, at most UPLOAD_MAX_CONCURRENT_BLOCKS
+    # blocks per file (bounding memory per upload) and UPLOAD_MAX_CONCURRENT_FILES files at a time
+    UPLOAD_BLOCK_SIZE_MB: int = 4
+    UPLOAD_MAX_CONCURRENT_BLOCKS: int = 4
+    UPLOAD_MAX_CONCURRENT_FILES: int = 4
+
+    # Vector store: "azure_search" or "numpy" (in-process index loaded from the snapshots in VECTOR_STORE_DIR)
+    # VECTOR_INDEX_MODE "flat" searches exactly, "ivf" scans only the VECTOR_INDEX_IVF_NPROBE closest lists
+    VECTOR_STORE_BACKEND: str = "azure_search"
+    VECTOR_STORE_DIR: str = "vector_index"
+    VECTOR_STORE_RELOAD_INTERVAL_SECONDS: float = 30
+    VECTOR_INDEX_MODE: str = "flat"
+    VECTOR_INDEX_IVF_NLIST: int = 0
+    VECTOR_INDEX_IVF_NPROBE: int = 8
+
+    # Hybrid retrieval: BM25 over the chunk text fused with the vector results by reciprocal rank fusion
+    # RETRIEVAL_CANDIDATES results of each search are fused. The BM25 index is built in the background (at startup with
+    # LEXICAL_INDEX_BUILD_AT_STARTUP), text and hybrid retrieval use the vector search alone until it is ready. It is
+    # rebuilt every LEXICAL_INDEX_REFRESH_SECONDS when the Azure Search document count or the last change of the
+    # ingestion manifests in AZURE_STORAGE_MANIFEST_CONTAINER (written by the ingestion function) changed
+    RETRIEVAL_CANDIDATES: int = 10
+    RETRIEVAL_RRF_K: int = 60
+    LEXICAL_INDEX_REFRESH_SECONDS: float = 300
+    LEXICAL_INDEX_BUILD_AT_STARTUP: bool = True
+    # the container the ingestion function keeps its manifests in, the function reads the same setting
+    AZURE_STORAGE_MANIFEST_CONTAINER: Optional[str] = "ingestion-manifest"
+    BM25_K1: float = 1.5
+    BM25_B: float = 0.75
+
+    # MMR re-ranking of MMR_CANDIDATES retrieved chunks down to the requested top, trading relevance for
+    # diversity by MMR_LAMBDA (1 = relevance only). Can be switched per request with the overrides
+    MMR_ENABLED: bool = False
+    MMR_CANDIDATES: int = 10
+    MMR_LAMBDA: float = 0.5
+
+    # Telemetry: Prometheus metrics per pipeline stage served on /metrics, OpenTelemetry spans per stage
+    # (the exporter is configured by the OpenTelemetry SDK). With several workers set PROMETHEUS_MULTIPROC_DIR
+    METRICS_ENABLED: bool = False
+    TRACING_ENABLED: bool = False
+    METRICS_LATENCY_BUCKETS: List[float] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    # Prompt context: retrieved chunks are deduplicated, ordered by score and cut at sentence boundaries to fit
+    # the token budget of the chat model (CONTEXT_TOKEN_BUDGETS, else CONTEXT_TOKEN_BUDGET)
+    # CONTEXT_TOKENIZER: "approximate" (4 characters per token) or "tiktoken"
+    CHAT_MODEL: str = "gemini-pro"
+    CONTEXT_TOKEN_BUDGET: int = 3000
+    CONTEXT_TOKEN_BUDGETS: Dict[str, int] = {"gemini-pro": 3000}
+    CONTEXT_TOKENIZER: str = "approximate"
+    CONTEXT_MIN_OVERLAP_CHARS: int = 30
+
+    # Follow-up questions: "inline" (returned by the answer generation itself), "concurrent" (separate call
+    # running next to the answer) or "after" (separate call once the answer is complete, e.g. streamed)
+    FOLLOWUP_QUESTIONS_MODE: str = "inline"
+
+    # Identical /chat requests (same conversation and owner, normalized question and history, same overrides)
+    # in flight share one pipeline execution. Its result is also served to identical requests arriving up to
+    # CHAT_COALESCING_WINDOW_SECONDS after it completed, 0 coalesces in-flight requests only
+    CHAT_COALESCING_ENABLED: bool = True
+    CHAT_COALESCING_WINDOW_SECONDS: float = 2.0
+
+    # Chat pipelines running at once. Further requests wait for at most CHAT_QUEUE_TIMEOUT_SECONDS in a queue
+    # of CHAT_MAX_QUEUED, beyond that they are rejected with 429 and a Retry-After estimate
+    CHAT_MAX_CONCURRENT: int = 16
+    CHAT_MAX_QUEUED: int = 64
+    CHAT_QUEUE_TIMEOUT_SECONDS: float = 10
+
+    # Client-side protection of the Gemini calls (chat model and embeddings, separate quotas and circuits):
+    # request and token rate limits (0 disables one), waiting at most GEMINI_MAX_WAIT_SECONDS for them, an AIMD
+    # concurrency limit backing off on 429/5xx, jittered retries within a shared budget (GEMINI_RETRY_BUDGET_RATIO
+    # of the calls of the last 10s plus GEMINI_RETRY_BUDGET_MIN_RETRIES) and a circuit opening after
+    # GEMINI_CIRCUIT_FAILURE_THRESHOLD consecutive failures. Meanwhile /chat answers with DEGRADED_ANSWER
+    GEMINI_GUARD_ENABLED: bool = True
+    GEMINI_CHAT_REQUESTS_PER_MINUTE: int = 360
+    GEMINI_CHAT_TOKENS_PER_MINUTE: int = 120000
+    GEMINI_EMBEDDING_REQUESTS_PER_MINUTE: int = 1500
+    GEMINI_MAX_WAIT_SECONDS: float = 5.0
+    GEMINI_CONCURRENCY_INITIAL: int = 8
+    GEMINI_CONCURRENCY_MIN: int = 1
+    GEMINI_CONCURRENCY_MAX: int = 32
+    GEMINI_MAX_RETRIES: int = 2
+    GEMINI_RETRY_BUDGET_RATIO: float = 0.1
+    GEMINI_RETRY_BUDGET_MIN_RETRIES: int = 10
+    GEMINI_BACKOFF_BASE_SECONDS: float = 0.5
+    GEMINI_BACKOFF_MAX_SECONDS: float = 8.0
+    GEMINI_CIRCUIT_FAILURE_THRESHOLD: int = 5
+    GEMINI_CIRCUIT_RESET_SECONDS: float = 30.0
+    DEGRADED_ANSWER: str = "The assistant is busy right now and could not answer. Please try again in a moment."
+
+    # Chat history: the last CHAT_HISTORY_RECENT_TURNS turns are sent verbatim, older ones are folded into a rolling
+    # summary, CHAT_HISTORY_FOLD_TURNS turns at a time, cached per conversation (for the lifetime of the conversation
+    # token when CHAT_HISTORY_SUMMARY_TTL_SECONDS = 0). Summary and turns stay within CHAT_HISTORY_TOKEN_BUDGET
+    CHAT_HISTORY_RECENT_TURNS: int = 4
+    CHAT_HISTORY_FOLD_TURNS: int = 4
+    CHAT_HISTORY_TOKEN_BUDGET: int = 1500
+    CHAT_HISTORY_SUMMARY_MAX_TOKENS: int = 300
+    CHAT_HISTORY_SUMMARY_MAX_ENTRIES: int = 10000
+    CHAT_HISTORY_SUMMARY_TTL_SECONDS: int = 0
+
+    # Server-side conversation state (turns, sources, history summary) of the conversations issued by
+    # /directline/conversations, kept until their token expires, so /chat only needs the conversationId and the
+    # new question. CONVERSATION_STORE_BACKEND: "memory" (per process) or "redis" (shared between workers)
+    CONVERSATION_STORE_ENABLED: bool = True
+    CONVERSATION_STORE_BACKEND: str = "memory"
+    CONVERSATION_STORE_MAX_ENTRIES: int = 10000
+    CONVERSATION_MAX_TURNS: int = 100
+
+    # Redis, shared backend for the caches below
+    REDIS_URL: str = "redis://localhost:6379/0"
+
+    # Embeddings
+    # EMBEDDING_CACHE_DIR enables the on-disk embedding store shared by all workers, the least recently
+    # used vectors are removed beyond EMBEDDING_CACHE_MAX_BYTES (None for no limit)
+    EMBEDDING_MODEL: str = "models/embedding-001"
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 4096
+    EMBEDDING_CACHE_DIR: Optional[str] = None
+    EMBEDDING_CACHE_MAX_BYTES: Optional[int] = 512 * 1024 * 1024
+
+    # Semantic answer cache
+    # SEMANTIC_CACHE_BACKEND: "memory" (per process) or "redis" (shared between workers, needs RediSearch for the vector index)
+    # Cached answers are dropped once the indexed chunks change: the revision of the vector store (numpy snapshot, or Azure
+    # Search document count and ingestion manifests) is checked every SEMANTIC_CACHE_REVISION_CHECK_SECONDS, with redis the
+    # ingestion function (same REDIS_URL) also bumps the shared version. They are kept up to SEMANTIC_CACHE_TTL_SECONDS
+    SEMANTIC_CACHE_ENABLED: bool = False
+    SEMANTIC_CACHE_BACKEND: str = "memory"
+    SEMANTIC_CACHE_SIMILARITY_THRESHOLD: float = 0.95
+    SEMANTIC_CACHE_TTL_SECONDS: int = 3600
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 1024
+    SEMANTIC_CACHE_REVISION_CHECK_SECONDS: float = 30
+
 settings = Settings()
\ No newline at end of file
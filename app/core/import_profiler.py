@@ -0,0 +1,75 @@
+import builtins
+import sys
+import threading
+import time
+from typing import List, Tuple
+
+class ImportProfiler:
+    '''
+    Measures how long every module takes to import, as inclusive time (with the modules it imports)
+    and self time. Only first imports are timed, imports of modules already loaded are free.
+
+    Enabled for the app with IMPORT_PROFILE=1 (report in the log at startup), or for any module:
+        python -m app.core.import_profiler app.main
+    '''
+    def __init__(self):
+        self.timings: dict = {}
+        self._original_import = None
+        self._local = threading.local()
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            inclusive, own = self.timings.get(name, (0.0, 0.0))
+            self.timings[name] = (inclusive + elapsed, own + elapsed - children)
+
+    def start(self):
+        if self._original_import is None:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._import
+
+    def stop(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def slowest(self, top: int = 25) -> List[Tuple[str, float, float]]:
+        return sorted(((name, inclusive, own) for name, (inclusive, own) in self.timings.items()),
+                      key=lambda item: item[1], reverse=True)[:top]
+
+    def report(self, top: int = 25) -> str:
+        lines = [f"{'inclusive ms':>12} {'self ms':>9}  module"]
+        for name, inclusive, own in self.slowest(top):
+            lines.append(f"{inclusive * 1000:12.1f} {own * 1000:9.1f}  {name}")
+        return "\n".join(lines)
+
+import_profiler = ImportProfiler()
+
+if __name__ == "__main__":
+    import importlib
+
+    module_name = sys.argv[1] if len(sys.argv) > 1 else "app.main"
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+    import_profiler.start()
+    started = time.perf_counter()
+    importlib.import_module(module_name)
+    elapsed = time.perf_counter() - started
+    import_profiler.stop()
+
+    print(import_profiler.report(top))
+    print(f"Imported {module_name} in {elapsed * 1000:.1f} ms")
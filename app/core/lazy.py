@@ -0,0 +1,53 @@
+import threading
+from contextlib import contextmanager
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+class LazyResource(Generic[T]):
+    '''
+    Creates a client on first use instead of at import, once, even when several threads ask for
+    it at the same time. override() swaps in another instance, e.g. a fake in tests.
+    '''
+    def __init__(self, factory: Callable[[], T], name: str = None):
+        self.factory = factory
+        self.name = name or getattr(factory, "__name__", "resource")
+        self._lock = threading.Lock()
+        self._value: T = None
+        self._initialized = False
+
+    @property
+    def initialized(self) -> bool:
+        return self._initialized
+
+    def get(self) -> T:
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    self._value = self.factory()
+                    self._initialized = True
+        return self._value
+
+    def set(self, value: T):
+        with self._lock:
+            self._value = value
+            self._initialized = True
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self._initialized = False
+
+    @contextmanager
+    def override(self, value: T):
+        with self._lock:
+            previous = (self._value, self._initialized)
+            self._value, self._initialized = value, True
+        try:
+            yield value
+        finally:
+            with self._lock:
+                self._value, self._initialized = previous
+
+    def __repr__(self) -> str:
+        return f"LazyResource({self.name}, initialized={self._initialized})"
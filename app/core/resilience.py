@@ -0,0 +1,418 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+class ProviderUnavailableError(Exception):
+    '''The provider is not called: its circuit is open or the rate limit would make the caller wait too long.'''
+    def __init__(self, message: str, retry_after_seconds: float):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+# HTTP statuses and the names google-api-core / httpx / grpc give them
+THROTTLED = "throttled"
+SERVER_ERROR = "server_error"
+
+throttled_names = {"ResourceExhausted", "TooManyRequests", "RateLimitError"}
+server_error_names = {"ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout", "BadGateway",
+                      "ServerError", "ConnectError", "ReadTimeout", "ConnectTimeout"}
+
+def error_status(ex: BaseException) -> Optional[int]:
+    for status in (getattr(ex, "code", None), getattr(ex, "status_code", None), getattr(getattr(ex, "response", None), "status_code", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+def classify_error(ex: BaseException) -> Optional[str]:
+    '''THROTTLED (429), SERVER_ERROR (5xx, timeouts, connection errors) or None for errors a retry cannot fix.'''
+    status = error_status(ex)
+    names = {cls.__name__ for cls in type(ex).__mro__}
+    if status == 429 or names & throttled_names:
+        return THROTTLED
+    if (status is not None and status >= 500) or names & server_error_names or isinstance(ex, (TimeoutError, ConnectionError)):
+        return SERVER_ERROR
+    return None
+
+class TokenBucket:
+    '''
+    Rate limit of rate_per_minute units (requests or tokens) with bursts up to capacity.
+
+    reserve() takes the units right away and returns how long to wait before using them, so callers
+    are served in arrival order; the bucket goes into debt meanwhile. A reservation waiting longer
+    than max_wait_seconds is refused and takes nothing. charge() adds units known afterwards (e.g. the
+    output tokens of a completion) without waiting, they delay the next callers instead.
+    '''
+    def __init__(self, rate_per_minute: float, capacity: float = None, clock: Callable[[], float] = time.monotonic):
+        self.rate_per_second = rate_per_minute / 60
+        # bursts of 6 seconds of quota by default
+        self.capacity = capacity if capacity is not None else max(rate_per_minute / 10, 1)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def reserve(self, amount: float, max_wait_seconds: float) -> Optional[float]:
+        ''':return: seconds to wait before using the units, None when that would exceed max_wait_seconds'''
+        with self._lock:
+            self._refill()
+            # more than the capacity at once only needs a full bucket
+            needed = min(amount, self.capacity)
+            wait = max(0.0, (needed - self._tokens) / self.rate_per_second)
+            if wait > max_wait_seconds:
+                return None
+            self._tokens -= amount
+            return wait
+
+    def charge(self, amount: float):
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+class AdaptiveConcurrencyLimit:
+    '''
+    Concurrency limit adjusted by AIMD: every success raises it by 1/limit (about +1 per round trip
+    of limit calls), a throttled or failed call multiplies it by decrease_factor. Decreases are at
+    most one per cooldown_seconds, so a burst of errors from calls started together counts once.
+    '''
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, decrease_factor: float = 0.5,
+                 cooldown_seconds: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.clock = clock
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    async def aacquire(self, timeout: float, poll_seconds: float = 0.02) -> bool:
+        # the condition belongs to threads, the event loop polls instead of blocking on it
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(poll_seconds, remaining))
+        return True
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_overload(self):
+        with self._condition:
+            now = self.clock()
+            if now - self._last_decrease < self.cooldown_seconds:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        logger.warning(f"Provider overloaded, concurrency limit lowered to {int(self.limit)}")
+
+class RetryBudget:
+    '''
+    Retries allowed over the last window_seconds: min_retries plus ratio of the calls made. Shared by
+    the clients of a provider, so an outage adds at most that fraction of load instead of multiplying it.
+    '''
+    def __init__(self, ratio: float = 0.1, min_retries: int = 10, window_seconds: float = 10.0, clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._retries = deque()
+        self.exhausted = 0
+
+    def _expire(self, now: float):
+        for events in (self._calls, self._retries):
+            while events and now - events[0] >= self.window_seconds:
+                events.popleft()
+
+    def record_call(self):
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            self._calls.append(now)
+
+    def try_withdraw(self) -> bool:
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._calls):
+                self.exhausted += 1
+                return False
+            self._retries.append(now)
+            return True
+
+class CircuitBreaker:
+    '''
+    Opens after failure_threshold consecutive failures: calls then fail fast for reset_seconds. Once
+    that elapsed one probe call goes through (half-open), its success closes the circuit and its
+    failure opens it again.
+    '''
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self._opened_at + self.reset_seconds - self.clock()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        raise ProviderUnavailableError(f"{self.name} circuit is open", retry_after_seconds=max(remaining, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.warning(f"{self.name} circuit closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"{self.name} circuit opened after {self.failures} failures")
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+                self._probing = False
+
+    def record_ignored(self):
+        # a call that ended without telling anything about the provider (cancelled, client error)
+        with self._lock:
+            self._probing = False
+
+class ProviderGuard:
+    '''
+    Client-side protection of calls to a rate-limited provider, in this order:
+    - the circuit breaker fails fast while the provider keeps failing
+    - the request and token buckets keep under the quotas, waiting at most max_wait_seconds
+    - the adaptive concurrency limit backs off on 429 and 5xx responses
+    - throttled and server errors are retried with full-jitter exponential backoff, at most
+      max_retries times and while the shared retry budget allows
+    ProviderUnavailableError is raised instead of waiting or retrying beyond those bounds.
+    '''
+    def __init__(self, name: str,
+                 requests_bucket: TokenBucket = None,
+                 tokens_bucket: TokenBucket = None,
+                 concurrency: AdaptiveConcurrencyLimit = None,
+                 retry_budget: RetryBudget = None,
+                 breaker: CircuitBreaker = None,
+                 max_wait_seconds: float = 5.0,
+                 max_retries: int = 2,
+                 backoff_base_seconds: float = 0.5,
+                 backoff_max_seconds: float = 8.0):
+        self.name = name
+        self.requests_bucket = requests_bucket
+        self.tokens_bucket = tokens_bucket
+        self.concurrency = concurrency or AdaptiveConcurrencyLimit(initial=8)
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker(name)
+        self.max_wait_seconds = max_wait_seconds
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+
+        self.calls = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def _rejected(self, reason: str, retry_after_seconds: float) -> ProviderUnavailableError:
+        self.rejected += 1
+        return ProviderUnavailableError(f"{self.name} {reason}", retry_after_seconds=retry_after_seconds)
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+        for bucket, amount, unit in ((self.requests_bucket, 1, "requests"), (self.tokens_bucket, tokens, "tokens")):
+            if bucket is None or not amount:
+                continue
+            reserved = bucket.reserve(amount, self.max_wait_seconds)
+            if reserved is None:
+                raise self._rejected(f"{unit} per minute limit reached", retry_after_seconds=self.max_wait_seconds)
+            wait = max(wait, reserved)
+        return wait
+
+    def charge_tokens(self, tokens: int):
+        if self.tokens_bucket is not None and tokens:
+            self.tokens_bucket.charge(tokens)
+
+    def backoff(self, attempt: int, ex: BaseException) -> float:
+        delay = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+        # a Retry-After sent with the 429 is a floor
+        retry_after = getattr(ex, "retry_after_seconds", None) or getattr(ex, "retry_after", None)
+        return max(delay, retry_after) if isinstance(retry_after, (int, float)) else delay
+
+    def record_failure(self, ex: BaseException) -> bool:
+        '''Record a failed attempt, False when the error says nothing about the provider (not retried).'''
+        if classify_error(ex) is None:
+            self.breaker.record_ignored()
+            return False
+
+        self.breaker.record_failure()
+        self.concurrency.on_overload()
+        return True
+
+    def should_retry(self, attempt: int, ex: BaseException) -> bool:
+        '''Record a failed attempt, True when it is worth another one (after backoff()).'''
+        if not self.record_failure(ex):
+            return False
+        if attempt >= self.max_retries or not self.retry_budget.try_withdraw():
+            return False
+        self.retries += 1
+        return True
+
+    def record_success(self):
+        self.breaker.record_success()
+        self.concurrency.on_success()
+
+    @contextmanager
+    def permit(self, tokens: int = 0):
+        '''One attempt: breaker, rate and concurrency checks, blocking the thread while waiting.'''
+        self.breaker.before_call()
+        try:
+            wait = self._reserve(tokens)
+            if wait:
+                time.sleep(wait)
+            if not self.concurrency.acquire(timeout=self.max_wait_seconds):
+                raise self._rejected("concurrency limit reached", retry_after_seconds=self.max_wait_seconds)
+        except BaseException:
+            self.breaker.record_ignored()
+            raise
+
+        try:
+            yield
+        finally:
+            self.concurrency.release()
+
+    @asynccontextmanager
+    async def apermit(self, tokens: int = 0):
+        self.breaker.before_call()
+        try:
+            wait = self._reserve(tokens)
+            if wait:
+                await asyncio.sleep(wait)
+            if not await self.concurrency.aacquire(timeout=self.max_wait_seconds):
+                raise self._rejected("concurrency limit reached", retry_after_seconds=self.max_wait_seconds)
+        except BaseException:
+            self.breaker.record_ignored()
+            raise
+
+        try:
+            yield
+        finally:
+            self.concurrency.release()
+
+    def call(self, func: Callable[[], T], tokens: int = 0) -> T:
+        self.calls += 1
+        self.retry_budget.record_call()
+        attempt = 0
+        while True:
+            try:
+                with self.permit(tokens):
+                    result = func()
+            except ProviderUnavailableError:
+                raise
+            except Exception as ex:
+                if not self.should_retry(attempt, ex):
+                    raise
+                time.sleep(self.backoff(attempt, ex))
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.record_ignored()
+                raise
+            self.record_success()
+            return result
+
+    async def acall(self, func: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+        self.calls += 1
+        self.retry_budget.record_call()
+        attempt = 0
+        while True:
+            try:
+                async with self.apermit(tokens):
+                    result = await func()
+            except ProviderUnavailableError:
+                raise
+            except Exception as ex:
+                if not self.should_retry(attempt, ex):
+                    raise
+                await asyncio.sleep(self.backoff(attempt, ex))
+                attempt += 1
+                continue
+            except BaseException:
+                # cancelled, says nothing about the provider
+                self.breaker.record_ignored()
+                raise
+            self.record_success()
+            return result
+
+    def stats(self) -> dict:
+        return {"calls": self.calls,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "retry_budget_exhausted": self.retry_budget.exhausted,
+                "concurrency_limit": int(self.concurrency.limit),
+                "in_flight": self.concurrency.in_flight,
+                "circuit": self.breaker.state}
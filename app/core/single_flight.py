@@ -0,0 +1,79 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+class SingleFlight:
+    '''
+    Coalesces concurrent coroutine calls with the same key into one execution, a task shared by
+    the callers, whose result, or exception, every caller receives. A successful result is also
+    handed to calls arriving up to window_seconds after it completed; failures are never reused.
+
+    A cancelled caller stops waiting without affecting the others, the task is only cancelled once
+    every caller has. Used from a single event loop.
+    '''
+    def __init__(self, window_seconds: float = 0, clock: Callable[[], float] = time.monotonic):
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self._lock = asyncio.Lock()
+        # key -> [task, number of callers waiting for it]
+        self._tasks: Dict[Hashable, list] = {}
+        # key -> (task, completed_at) of successful calls, in completion order for the expiry
+        self._completed: "OrderedDict[Hashable, Tuple[asyncio.Future, float]]" = OrderedDict()
+
+        self.executions = 0
+        self.shared = 0
+
+    def _expire(self):
+        now = self.clock()
+        while self._completed:
+            key, (_, completed_at) = next(iter(self._completed.items()))
+            if now - completed_at < self.window_seconds:
+                break
+            del self._completed[key]
+
+    def _recent(self, key: Hashable):
+        self._expire()
+        entry = self._completed.get(key)
+        return entry[0] if entry is not None else None
+
+    async def ado(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        async with self._lock:
+            recent = self._recent(key)
+            entry = self._tasks.get(key)
+            if recent is not None:
+                self.shared += 1
+            elif entry is not None:
+                entry[1] += 1
+                self.shared += 1
+            else:
+                task = asyncio.ensure_future(func())
+                entry = self._tasks[key] = [task, 1]
+                task.add_done_callback(lambda done: self._complete_task(key, done))
+                self.executions += 1
+
+        if recent is not None:
+            return recent.result()
+
+        task = entry[0]
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                task.cancel()
+
+    def _complete_task(self, key: Hashable, task: asyncio.Task):
+        # runs on the event loop, like ado() between its awaits
+        entry = self._tasks.get(key)
+        if entry is not None and entry[0] is task:
+            del self._tasks[key]
+        if self.window_seconds > 0 and not task.cancelled() and task.exception() is None:
+            self._completed[key] = (task, self.clock())
+            self._completed.move_to_end(key)
+
+    def stats(self) -> dict:
+        return {"executions": self.executions,
+                "shared": self.shared,
+                "in_flight": len(self._tasks),
+                "recent": len(self._completed)}
@@ -0,0 +1,223 @@
+import contextvars
+import functools
+import inspect
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Sequence
+
+from app.core.config import settings
+
+# set per HTTP request / WebSocket connection by TelemetryMiddleware, attached to every span
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+conversation_id_var: contextvars.ContextVar = contextvars.ContextVar("conversation_id", default=None)
+
+noop_stage = nullcontext()
+
+class Telemetry:
+    '''
+    Metrics and trace spans per stage of the RAG pipeline and of the Azure, SQL and Gemini calls.
+
+    stage(name) times a block into omniqhub_stage_duration_seconds{stage, outcome}, counts it in
+    omniqhub_stage_in_progress{stage} while it runs and failures in omniqhub_stage_errors_total{stage, error}.
+    Stages nest (e.g. "embed" inside "vector_search"), so their durations are not additive.
+    With tracing each stage is also an OpenTelemetry span carrying the request and conversation ids.
+
+    register_stats() exposes the stats() of a component (caches, pools, queues) as gauges and
+    counters read at every scrape.
+
+    prometheus_client and opentelemetry-api are only imported when enabled. Disabled, stage()
+    returns a shared no-op context manager.
+    '''
+    def __init__(self, metrics_enabled: bool = False, tracing_enabled: bool = False, buckets: List[float] = None, registry=None):
+        self.metrics_enabled = metrics_enabled
+        self.tracing_enabled = tracing_enabled
+        self.enabled = metrics_enabled or tracing_enabled
+        self.registry = None
+        self.tracer = None
+        self.stats_collectors: List[StatsCollector] = []
+
+        if metrics_enabled:
+            from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+            self.registry = registry or REGISTRY
+            buckets = buckets or Histogram.DEFAULT_BUCKETS
+            self.stage_duration = Histogram("omniqhub_stage_duration_seconds", "Duration of a pipeline stage or client call",
+                                            ["stage", "outcome"], buckets=buckets, registry=self.registry)
+            self.stage_in_progress = Gauge("omniqhub_stage_in_progress", "Pipeline stages or client calls running",
+                                           ["stage"], multiprocess_mode="livesum", registry=self.registry)
+            self.stage_errors = Counter("omniqhub_stage_errors_total", "Failed pipeline stages or client calls",
+                                        ["stage", "error"], registry=self.registry)
+            self.http_duration = Histogram("omniqhub_http_request_duration_seconds", "Duration of HTTP requests and WebSocket connections",
+                                           ["method", "route", "status"], buckets=buckets, registry=self.registry)
+            self.http_in_progress = Gauge("omniqhub_http_requests_in_progress", "HTTP requests and WebSocket connections being served",
+                                          ["method"], multiprocess_mode="livesum", registry=self.registry)
+
+        if tracing_enabled:
+            from opentelemetry import trace
+
+            self.tracer = trace.get_tracer("omniqhub")
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return noop_stage
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name: str):
+        span = self.tracer.start_as_current_span(f"omniqhub.{name}", attributes=span_attributes(stage=name)) if self.tracer else nullcontext()
+
+        with span:
+            if self.metrics_enabled:
+                self.stage_in_progress.labels(name).inc()
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                yield
+            except BaseException as ex:
+                outcome = "error"
+                if self.metrics_enabled:
+                    self.stage_errors.labels(name, type(ex).__name__).inc()
+                raise
+            finally:
+                if self.metrics_enabled:
+                    self.stage_duration.labels(name, outcome).observe(time.perf_counter() - started)
+                    self.stage_in_progress.labels(name).dec()
+
+    def traced(self, name: str) -> Callable:
+        '''Decorator running a function, or coroutine function, as a stage.'''
+        def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.stage(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_stats(self, name: str, documentation: str, stats: Callable[[], dict], counters: Sequence[str] = ()):
+        '''
+        Exposes the numeric values of stats() as omniqhub_<name>_<key>, counters for the keys in
+        counters and gauges for the others. In multiprocess mode they are the serving worker's.
+        '''
+        if not self.metrics_enabled:
+            return
+        collector = StatsCollector(f"omniqhub_{name}", documentation, stats, counters)
+        self.stats_collectors.append(collector)
+        self.registry.register(collector)
+
+    def metrics_response(self) -> tuple:
+        '''(body, content type) of the Prometheus exposition, aggregated over the workers in multiprocess mode.'''
+        from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            from prometheus_client import multiprocess
+
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            for collector in self.stats_collectors:
+                registry.register(collector)
+        else:
+            registry = self.registry
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+class StatsCollector:
+    '''Prometheus collector reading a stats() dict at scrape time, its numeric values only.'''
+    def __init__(self, prefix: str, documentation: str, stats: Callable[[], dict], counters: Sequence[str] = ()):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.stats = stats
+        self.counters = set(counters)
+
+    def describe(self) -> list:
+        # without it registering would call stats(), e.g. a Redis round trip at import
+        return []
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        try:
+            stats = self.stats()
+        except Exception:
+            # e.g. Redis unreachable, the other metrics are still served
+            return
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            family = CounterMetricFamily if key in self.counters else GaugeMetricFamily
+            yield family(f"{self.prefix}_{key}", f"{self.documentation}: {key.replace('_', ' ')}", value=value)
+
+def span_attributes(**attributes) -> dict:
+    request_id = request_id_var.get()
+    conversation_id = conversation_id_var.get()
+    if request_id:
+        attributes["omniqhub.request_id"] = request_id
+    if conversation_id:
+        attributes["omniqhub.conversation_id"] = conversation_id
+    return attributes
+
+conversation_path = re.compile(r"/conversations/([^/]+)")
+
+class TelemetryMiddleware:
+    '''
+    ASGI middleware setting the request id (X-Request-ID or a new one, echoed in the response) and
+    the conversation id (X-Conversation-ID or the Direct Line conversation in the path) for the
+    spans of the request, and recording its duration by route template.
+    '''
+    def __init__(self, app, telemetry: Telemetry):
+        self.app = app
+        self.telemetry = telemetry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])}
+        request_id = headers.get("x-request-id") or uuid.uuid4().hex
+        conversation_match = conversation_path.search(scope.get("path", ""))
+        conversation_id = headers.get("x-conversation-id") or (conversation_match.group(1) if conversation_match else None)
+
+        request_token = request_id_var.set(request_id)
+        conversation_token = conversation_id_var.set(conversation_id)
+
+        method = scope.get("method", "WS")
+        status = {"code": 500 if scope["type"] == "http" else 101}
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        started = time.perf_counter()
+        span = self.telemetry.tracer.start_as_current_span(f"{method} {scope.get('path', '')}", attributes=span_attributes()) if self.telemetry.tracer else nullcontext()
+        # the route template is only known once the router matched, the in-progress gauge goes by method
+        in_progress = self.telemetry.http_in_progress.labels(method) if self.telemetry.metrics_enabled else None
+        try:
+            with span:
+                if in_progress is not None:
+                    in_progress.inc()
+                await self.app(scope, receive, send_with_request_id)
+        finally:
+            if in_progress is not None:
+                in_progress.dec()
+                route = scope.get("route")
+                self.telemetry.http_duration.labels(method, getattr(route, "path", "unmatched"), str(status["code"])).observe(time.perf_counter() - started)
+            request_id_var.reset(request_token)
+            conversation_id_var.reset(conversation_token)
+
+def create_telemetry() -> Telemetry:
+    return Telemetry(metrics_enabled=settings.METRICS_ENABLED,
+                     tracing_enabled=settings.TRACING_ENABLED,
+                     buckets=settings.METRICS_LATENCY_BUCKETS)
+
+telemetry = create_telemetry()
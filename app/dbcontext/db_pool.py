@@ -0,0 +1,188 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable
+
+import pyodbc
+from app.core.config import settings
+from app.core.telemetry import telemetry
+
+class PoolTimeoutError(Exception):
+    pass
+
+class PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+class ConnectionPool:
+    '''
+    Bounded, thread-safe pool of DB-API connections.
+    Connections older than max_lifetime_seconds are closed instead of reused and idle connections
+    are checked with health_check_query before being handed out again. A released connection is
+    rolled back first, so no open transaction or lock passes to the next borrower. Any DB-API driver works,
+    e.g. ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False)) for tests.
+    '''
+    def __init__(self, connect: Callable[[], Any], max_size: int = 10, max_lifetime_seconds: float = 1800,
+                 acquire_timeout_seconds: float = 5, health_check_query: str = "SELECT 1", health_check_idle_seconds: float = 30):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self.health_check_query = health_check_query
+        self.health_check_idle_seconds = health_check_idle_seconds
+
+        self._condition = threading.Condition()
+        self._idle: deque = deque()
+        self._size = 0
+
+        self.created = 0
+        self.closed = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+        self.health_check_failures = 0
+
+    def _is_expired(self, pooled: PooledConnection) -> bool:
+        return time.monotonic() - pooled.created_at > self.max_lifetime_seconds
+
+    def _is_healthy(self, pooled: PooledConnection) -> bool:
+        if time.monotonic() - pooled.last_used_at < self.health_check_idle_seconds:
+            return True
+        try:
+            cursor = pooled.connection.cursor()
+            cursor.execute(self.health_check_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            self.health_check_failures += 1
+            return False
+
+    def _close(self, pooled: PooledConnection):
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self.closed += 1
+            self._condition.notify()
+
+    def acquire(self) -> PooledConnection:
+        started = time.monotonic()
+        waited = False
+
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = self.acquire_timeout_seconds - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeoutError(f"Timed out after {self.acquire_timeout_seconds}s waiting for a database connection")
+                    waited = True
+                    self._condition.wait(remaining)
+
+                pooled = self._idle.pop() if self._idle else None
+                if pooled is None:
+                    # reserve the slot, the connection itself is opened outside the lock
+                    self._size += 1
+
+            if pooled is None:
+                try:
+                    pooled = PooledConnection(self.connect())
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                self.created += 1
+            elif self._is_expired(pooled) or not self._is_healthy(pooled):
+                self._close(pooled)
+                continue
+
+            waited_seconds = time.monotonic() - started
+            with self._condition:
+                self.acquisitions += 1
+                if waited:
+                    self.waits += 1
+                    self.wait_seconds_total += waited_seconds
+                    self.wait_seconds_max = max(self.wait_seconds_max, waited_seconds)
+
+            return pooled
+
+    def release(self, pooled: PooledConnection, discard: bool = False):
+        if discard or self._is_expired(pooled):
+            self._close(pooled)
+            return
+
+        try:
+            pooled.connection.rollback()
+        except Exception:
+            self._close(pooled)
+            return
+
+        pooled.last_used_at = time.monotonic()
+        with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        pooled = self.acquire()
+        try:
+            yield pooled.connection
+        except Exception:
+            # the connection state is unknown after a failure, do not hand it out again
+            self.release(pooled, discard=True)
+            raise
+        else:
+            self.release(pooled)
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+        for pooled in idle:
+            self._close(pooled)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle),
+                    "max_size": self.max_size,
+                    "created": self.created,
+                    "closed": self.closed,
+                    "acquisitions": self.acquisitions,
+                    "waits": self.waits,
+                    "wait_seconds_total": self.wait_seconds_total,
+                    "wait_seconds_max": self.wait_seconds_max,
+                    "timeouts": self.timeouts,
+                    "health_check_failures": self.health_check_failures}
+
+# dedicated threads for blocking database calls made from async routes, so they neither block
+# the event loop nor compete with Starlette's default threadpool
+db_executor = ThreadPoolExecutor(max_workers=settings.DB_EXECUTOR_MAX_WORKERS, thread_name_prefix="db")
+
+async def run_in_db_executor(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # run in a copy of the caller's context, so the request id of the trace spans follows the call
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(context.run, func, *args, **kwargs))
+
+db_pool = ConnectionPool(
+    connect=lambda: pyodbc.connect(settings.CONNECTION_STRINGS),
+    max_size=settings.DB_POOL_MAX_SIZE,
+    max_lifetime_seconds=settings.DB_POOL_MAX_LIFETIME_SECONDS,
+    acquire_timeout_seconds=settings.DB_POOL_ACQUIRE_TIMEOUT_SECONDS,
+)
+telemetry.register_stats("db_pool", "Database connection pool", db_pool.stats,
+                         counters=("created", "closed", "acquisitions", "waits", "wait_seconds_total", "timeouts", "health_check_failures"))
@@ -1,6 +1,8 @@
 import pyodbc
-import pandas as pd
 from app.core.config import settings
+from app.core.telemetry import telemetry
+from app.core.ttl_cache import TTLCache, MISSING
+from app.dbcontext.db_pool import ConnectionPool, db_pool, run_in_db_executor
 
 # Function to return the sql results as a dict. 
 # It also maps the column names and values for the dict
@@ -24,26 +26,91 @@ def convert_result2dict(cursor):
     
     return ret_result
 
+def copy_result(result):
+    return [dict(row) for row in result] if result is not None else None
+
+# consumer records change rarely, keep them (and unknown user names) in memory for a while
+api_consumer_cache = TTLCache(max_entries=settings.CONSUMER_CACHE_MAX_ENTRIES,
+                              ttl_seconds=settings.CONSUMER_CACHE_TTL_SECONDS) if settings.CONSUMER_CACHE_TTL_SECONDS > 0 else None
+
 class token_dbcontext:
 
+    sp_name = "{CALL getAPIConsumerDetails (?)}"
+
+    def __init__(self, pool: ConnectionPool = None, cache: TTLCache = MISSING, sp_name: str = None):
+        '''
+        :param sp_name: statement taking the user name as its only parameter, e.g. a SELECT for a
+                        database without the stored procedure (sqlite in tests)
+        '''
+        self.pool = pool or db_pool
+        self.cache = api_consumer_cache if cache is MISSING else cache
+        self.sp_name = sp_name or self.sp_name
+
+    @telemetry.traced("sql_consumer_lookup")
+    def query_api_consumer_details(self, user_name):
+
+        with self.pool.connection() as cnxn:
+            cursor = cnxn.cursor()
+
+            params = (user_name,)
+            
+            # Execute Stored Procedure With Parameters
+            cursor.execute(self.sp_name, params)
+
+            result = convert_result2dict(cursor)
+            
+            # Close the cursor and delete it, the connection goes back to the pool
+            cursor.close()
+            del cursor
+
+        return result
+
+    def load_api_consumer_details(self, user_name):
+
+        result = self.query_api_consumer_details(user_name)
+
+        if self.cache is not None:
+            # unknown users are cached too, but not as long
+            ttl_seconds = None if result is not None else settings.CONSUMER_CACHE_NEGATIVE_TTL_SECONDS
+            self.cache.set(user_name, result, ttl_seconds=ttl_seconds)
+
+        return copy_result(result)
+
+    def get_cached_api_consumer_details(self, user_name):
+
+        if self.cache is None:
+            return MISSING
+
+        result = self.cache.get(user_name)
+        return result if result is MISSING else copy_result(result)
+
     def get_api_consumer_details(self, user_name):
 
-        cnxn = pyodbc.connect(settings.CONNECTION_STRINGS)
-        cursor = cnxn.cursor()
+        result = self.get_cached_api_consumer_details(user_name)
+        if result is MISSING:
+            result = self.load_api_consumer_details(user_name)
 
-        sp_name = "{CALL getAPIConsumerDetails (?)}"
-        params = (user_name,)
-        
-        # Execute Stored Procedure With Parameters
-        cursor.execute(sp_name, params)
+        return result
+
+    async def get_api_consumer_details_async(self, user_name):
 
-        result = convert_result2dict(cursor)
-        
-        # Close the cursor and delete it
-        cursor.close()
-        del cursor
-        
-        # Close the database connection
-        cnxn.close()
+        # a cache hit needs no database call, so no trip through the executor either
+        result = self.get_cached_api_consumer_details(user_name)
+        if result is MISSING:
+            result = await run_in_db_executor(self.load_api_consumer_details, user_name)
 
         return result
+
+    @staticmethod
+    def invalidate_api_consumer(user_name: str = None):
+        '''
+        Drop the cached details of one user, or of every user when user_name is None.
+        To be called when consumer records (e.g. passwords, disabled flag) change.
+        '''
+        if api_consumer_cache is None:
+            return
+
+        if user_name is None:
+            api_consumer_cache.clear()
+        else:
+            api_consumer_cache.invalidate(user_name)
@@ -1,33 +1,158 @@
+import atexit
 import logging
-import pyodbc
+import queue
+import sys
+import threading
+import time
 from datetime import datetime
 from app.core.config import settings
+from app.core.telemetry import telemetry
+from app.dbcontext.db_pool import ConnectionPool, db_pool
+
+class LogDBWriter:
+    '''
+    Background writer for LogDBHandler. Log rows are put on a bounded queue and a daemon thread
+    writes them with one executemany per batch, when batch_size rows are queued or every
+    flush_interval_seconds. When the queue is full the overflow policy decides what is dropped:
+    "drop_newest" (the incoming row), "drop_oldest" (the oldest queued row) or "block" (wait up to
+    flush_interval_seconds for room, then drop the incoming row).
+    '''
+    sp_name = "{CALL exception_log (?,?,?,?)}"
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = 100, flush_interval_seconds: float = 1.0,
+                 max_queue_size: int = 10000, overflow_policy: str = "drop_newest"):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.overflow_policy = overflow_policy
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+        self._start_lock = threading.Lock()
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="log-db-writer", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, row: tuple) -> bool:
+        if self._stop.is_set():
+            # stopped at shutdown, no thread would write the row
+            self.dropped += 1
+            return False
+        # started on first use, restarted if the thread died
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+
+        try:
+            if self.overflow_policy == "block":
+                self._queue.put(row, timeout=self.flush_interval_seconds)
+            else:
+                self._queue.put_nowait(row)
+        except queue.Full:
+            if self.overflow_policy != "drop_oldest":
+                self.dropped += 1
+                return False
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+                self._queue.put_nowait(row)
+            except (queue.Empty, queue.Full):
+                self.dropped += 1
+                return False
+
+        self.enqueued += 1
+        return True
+
+    def _drain(self, batch: list, wait_seconds: float):
+        deadline = time.monotonic() + wait_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        try:
+            with telemetry.stage("sql_log_write"), self.pool.connection() as cnxn:
+                cursor = cnxn.cursor()
+                cursor.executemany(self.sp_name, batch)
+                cnxn.commit()
+                cursor.close()
+            self.written += len(batch)
+        except Exception as ex:
+            # never log through the logging module here, the handler would feed on itself
+            self.failed += len(batch)
+            sys.stderr.write(f"LogDBWriter: failed to write {len(batch)} log records: {ex}\n")
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = []
+            self._drain(batch, self.flush_interval_seconds)
+            with self._write_lock:
+                self._write(batch)
+
+    def flush(self):
+        '''Write everything queued so far from the calling thread.'''
+        with self._write_lock:
+            while True:
+                batch = []
+                self._drain(batch, 0)
+                if not batch:
+                    break
+                self._write(batch)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval_seconds * 2)
+        self.flush()
+
+    def stats(self) -> dict:
+        return {"enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "queued": self._queue.qsize()}
+
+log_db_writer = LogDBWriter(
+    pool=db_pool,
+    batch_size=settings.LOG_DB_BATCH_SIZE,
+    flush_interval_seconds=settings.LOG_DB_FLUSH_INTERVAL_SECONDS,
+    max_queue_size=settings.LOG_DB_QUEUE_SIZE,
+    overflow_policy=settings.LOG_DB_OVERFLOW_POLICY,
+)
+atexit.register(log_db_writer.stop)
+# dropped and failed records would otherwise go unnoticed, the handler cannot log its own losses
+telemetry.register_stats("log_db_writer", "Database log writer", log_db_writer.stats,
+                         counters=("enqueued", "written", "dropped", "failed"))
 
 class LogDBHandler(logging.Handler):
     '''
     Customized logging handler that puts logs to the database.
+    Records are only queued here, log_db_writer writes them in bulk on a background thread.
     pyodbc required
     '''
-    def __init__(self):
+    def __init__(self, writer: LogDBWriter = None):
         logging.Handler.__init__(self)
+        self.writer = writer or log_db_writer
 
     def emit(self, record):
-        
-        try:
-            cnxn = pyodbc.connect(settings.CONNECTION_STRINGS)
-            cursor = cnxn.cursor()
-
-            sp_name = "{CALL exception_log (?,?,?,?)}"
-            params = (datetime.utcnow().replace(microsecond=0), record.levelname, record.msg, record.name,)
-            
-            # Execute Stored Procedure With Parameters
-            cursor.execute(sp_name, params)
-            cnxn.commit()
-            # Close the cursor and delete it
-            cursor.close()
-            del cursor
-            
-            # Close the database connection
-            cnxn.close()
-        except pyodbc.Error as ex:
-            raise ex
+
+        params = (datetime.utcfromtimestamp(record.created).replace(microsecond=0), record.levelname, str(record.msg), record.name,)
+        self.writer.enqueue(params)
+
+    def flush(self):
+        self.writer.flush()
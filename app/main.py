@@ -1,10 +1,21 @@
-import azure.functions as func
+import logging
+import os
+import time
+
+# IMPORT_PROFILE=1 logs the slowest imports of the application at startup
+from app.core.import_profiler import import_profiler
+if os.environ.get("IMPORT_PROFILE"):
+    import_profiler.start()
+import_started = time.perf_counter()
 
-import uvicorn
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 from app.core.config import settings
 from app.api.api_v1.api import api_router
+from app.api import metrics
+from app.core.telemetry import TelemetryMiddleware, telemetry
+from app.handlers.log_database_handler import log_db_writer
+from app.services.langchain_service import lexical_index
 
 app = FastAPI(
     title="Fast API",
@@ -32,5 +43,24 @@ if settings.BACKEND_CORS_ORIGINS:
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
+# request/conversation ids for the spans and per-route durations, nothing is added when telemetry is off
+if telemetry.enabled:
+    app.add_middleware(TelemetryMiddleware, telemetry=telemetry)
+
+if settings.METRICS_ENABLED:
+    app.include_router(metrics.router)
+
+# write the log records still queued before the worker exits
+app.router.add_event_handler("shutdown", log_db_writer.stop)
+
+# hybrid retrieval falls back to the vector search until the BM25 index is built
+if settings.LEXICAL_INDEX_BUILD_AT_STARTUP:
+    app.router.add_event_handler("startup", lexical_index.start)
+
+if os.environ.get("IMPORT_PROFILE"):
+    import_profiler.stop()
+    logging.getLogger(__name__).warning(f"Application imported in {(time.perf_counter() - import_started) * 1000:.1f} ms\n"
+                                        f"{import_profiler.report(int(os.environ.get('IMPORT_PROFILE_TOP', '25')))}")
+
 # if __name__ == '__main__':
 #     uvicorn.run(app, host='127.0.0.1', port=8080, log_level='info')
\ No newline at end of file
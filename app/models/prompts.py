@@ -15,6 +15,21 @@ which might reference context in the chat history, formulate a standalone questi
 which can be understood without the chat history. Do NOT answer the question, \
 just reformulate it if needed and otherwise return it as is."""
 
+history_summary_prompt = """Summary of the earlier conversation:
+{summary}"""
+
+summarize_history_prompt = """Progressively summarize the conversation between a user and an assistant. \
+Extend the current summary with the new turns below and return the new summary only. \
+Keep the names, topics, documents and facts the user may refer to later, in at most {max_words} words.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}
+
+New summary:"""
+
 qa_system_prompt = """You are an assistant for question-answering tasks. \
 Use the following pieces of retrieved context to answer the question. \
 If you don't know the answer, just say that you don't know. \
@@ -1,4 +1,5 @@
 from typing import Union, Optional, List
+from enum import Enum, IntEnum
 
 from uuid import UUID
 from pydantic import BaseModel, Field, validator, AnyHttpUrl
@@ -48,9 +49,20 @@ class RequestItem(BaseModel):
     user: str
     bot: Optional[str]
 
+class RetrievalMode(IntEnum):
+    Text = 0
+    Vector = 1
+    Hybrid = 2
+
+class FollowupQuestionsMode(str, Enum):
+    # in the same generation as the answer, in a separate call next to it, or in a separate call once it is done
+    Inline = "inline"
+    Concurrent = "concurrent"
+    After = "after"
+
 class RequestOverrides(BaseModel):
     semanticRanker: Optional[bool]
-    retrievalMode: int
+    retrievalMode: RetrievalMode
     semanticCaptions: Optional[str]
     excludeCategory: Optional[str]
     top: int
@@ -59,12 +71,21 @@ class RequestOverrides(BaseModel):
     promptTemplatePrefix: Optional[str]
     promptTemplateSuffix: Optional[str]
     suggestFollowupQuestions: bool
+    # maximal marginal relevance re-ranking of mmrCandidates retrieved chunks down to top
+    useMmr: Optional[bool] = None
+    mmrCandidates: Optional[int] = None
+    mmrLambda: Optional[float] = None
+    # how follow-up questions are generated when suggestFollowupQuestions, FOLLOWUP_QUESTIONS_MODE by default
+    followupQuestionsMode: Optional[FollowupQuestionsMode] = None
 
 class RequestModel(BaseModel):
-    history: List[RequestItem]
+    # may be left out with a conversationId, the server keeps the turns
+    history: List[RequestItem] = Field(default_factory=list)
     overrides: RequestOverrides
     lastUserQuestion: str
     approach: int
+    # as issued by /directline/conversations, keys the stored turns and the summary of the earlier ones
+    conversationId: Optional[str] = None
 
 class ResponseModel(BaseModel):
     answer: str
@@ -78,6 +99,9 @@ class ChatResponseModel(pydantic_v1.BaseModel):
     answer: str = pydantic_v1.Field(description="the answer to the question, If no source available, put the answer as I don't know.")
     thoughts: str = pydantic_v1.Field(description="""brief thoughts on how you came up with the answer, e.g. what sources you used, what you thought about, etc.""")
 
+class ChatResponseWithFollowupsModel(ChatResponseModel):
+    followup_questions: List[str] = pydantic_v1.Field(description="""three short questions the user could ask next, answerable from the same context and using its keywords, without numbering or "-" before them""")
+
 class LineListOutputParser(BaseOutputParser[List[str]]):
     """Output parser for a list of lines."""
 
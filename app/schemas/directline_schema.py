@@ -0,0 +1,30 @@
+from typing import Any, Optional, List
+
+from pydantic import BaseModel, Field, ConfigDict
+
+class ChannelAccount(BaseModel):
+    id: str
+    name: Optional[str] = None
+    role: Optional[str] = None
+
+class ConversationAccount(BaseModel):
+    id: str
+
+class Activity(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    type: str
+    id: Optional[str] = None
+    timestamp: Optional[str] = None
+    channelId: str = "directline"
+    from_: Optional[ChannelAccount] = Field(default=None, alias="from")
+    conversation: Optional[ConversationAccount] = None
+    replyToId: Optional[str] = None
+    text: Optional[str] = None
+    name: Optional[str] = None
+    value: Optional[Any] = None
+    channelData: Optional[dict] = None
+
+class ActivitySet(BaseModel):
+    activities: List[Activity]
+    watermark: Optional[str] = None
@@ -11,8 +11,11 @@ from azure.storage.blob import (
     UserDelegationKey,
     generate_container_sas,
     generate_blob_sas,
-    ContentSettings
+    ContentSettings,
+    BlobBlock
 )
+from azure.core import MatchConditions
+from azure.storage.blob.aio import ContainerClient as AsyncContainerClient
 # from azure.identity import DefaultAzureCredential
 from aiohttp import web
 import asyncio
@@ -21,9 +24,16 @@ from typing import AsyncIterable, Dict
 from urllib.parse import urljoin
 from dataclasses import dataclass
 import datetime
+import base64
+import functools
+import time
 
 from fastapi import UploadFile
 
+from app.core.config import settings
+from app.core.telemetry import telemetry
+from app.services.sas_url_cache import sas_url_cache
+
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
@@ -43,36 +53,103 @@ class DocumentResponse:
         self.embedding_type = embedding_type
 
 class AzureBlobStorageService:
-    def __init__(self, blob_service_client: BlobServiceClient, container_client: ContainerClient):
+    def __init__(self, blob_service_client: BlobServiceClient, container_client: ContainerClient, async_container_client: AsyncContainerClient = None):
         self.blob_service_client = blob_service_client
         self.container_client = container_client
+        self.async_container_client = async_container_client
         # self.default_credential = DefaultAzureCredential()
 
     async def upload_files_async(self, files: list[UploadFile]):
         try:
-            uploaded_files = []
-            for file in files:
-                file_name = file.filename
-                if file_name.lower().endswith('.pdf'):
+            pdf_files = [file for file in files if file.filename.lower().endswith('.pdf')]
+
+            # files are uploaded in parallel, at most UPLOAD_MAX_CONCURRENT_FILES at a time
+            file_semaphore = asyncio.Semaphore(settings.UPLOAD_MAX_CONCURRENT_FILES)
 
-                    # Create a blob client using the local file name as the name for the blob
-                    blob_client = self.blob_service_client.get_blob_client(container=os.environ["AZURE_STORAGE_BLOB_CONTAINERS"], blob=file_name)
+            async def upload(file: UploadFile) -> dict:
+                async with file_semaphore:
+                    return await self.upload_file_async(file, content_settings=ContentSettings(content_type="application/pdf"))
 
-                    file_content = await self.read_file_content(file)
-                    content_settings = ContentSettings(content_type="application/pdf")
-                    
-                    blob_client.upload_blob(file_content, blob_type="BlockBlob")
-                    blob_client.set_http_headers(content_settings=content_settings)
+            started = time.perf_counter()
+            upload_report = await asyncio.gather(*(upload(file) for file in pdf_files))
+            elapsed = time.perf_counter() - started
 
-                    uploaded_files.append(file_name)
+            uploaded_files = [report["name"] for report in upload_report]
+            total_bytes = sum(report["size"] for report in upload_report)
+            upload_stats = {"files": upload_report,
+                            "total_bytes": total_bytes,
+                            "seconds": round(elapsed, 3),
+                            "mb_per_second": round(total_bytes / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0}
 
             if not uploaded_files:
-                return {"uploaded_files": uploaded_files, "is_successful": False, "error": "No files were uploaded. Either the files already exist or the files are not PDFs or images."}
+                return {"uploaded_files": uploaded_files, "is_successful": False, "error": "No files were uploaded. Either the files already exist or the files are not PDFs or images.", "upload_stats": upload_stats}
             
-            return {"uploaded_files": uploaded_files, "is_successful": True, "error": ""}
+            return {"uploaded_files": uploaded_files, "is_successful": True, "error": "", "upload_stats": upload_stats}
         except Exception as ex:
             raise ex
 
+    @telemetry.traced("blob_upload")
+    async def upload_file_async(self, file: UploadFile, content_settings: ContentSettings) -> dict:
+        '''
+        Streams an upload from its spooled file into a block blob: blocks of UPLOAD_BLOCK_SIZE_MB are
+        staged concurrently (at most UPLOAD_MAX_CONCURRENT_BLOCKS in memory) and committed in one call
+        that also sets the content settings. Existing blobs are not overwritten.
+        '''
+        block_size = settings.UPLOAD_BLOCK_SIZE_MB * 1024 * 1024
+        block_semaphore = asyncio.Semaphore(settings.UPLOAD_MAX_CONCURRENT_BLOCKS)
+
+        if self.async_container_client is not None:
+            blob_client = self.async_container_client.get_blob_client(file.filename)
+            stage_block = blob_client.stage_block
+            commit_block_list = blob_client.commit_block_list
+        else:
+            blob_client = self.container_client.get_blob_client(file.filename)
+            stage_block = functools.partial(asyncio.to_thread, blob_client.stage_block)
+            commit_block_list = functools.partial(asyncio.to_thread, blob_client.commit_block_list)
+
+        async def stage(block_id: str, data: bytes):
+            try:
+                await stage_block(block_id=block_id, data=data, length=len(data))
+            finally:
+                block_semaphore.release()
+
+        started = time.perf_counter()
+        block_ids = []
+        stage_tasks = []
+        size = 0
+        try:
+            await file.seek(0)
+            while True:
+                # wait for a free slot before reading, so no more than the cap of blocks is held in memory
+                await block_semaphore.acquire()
+                data = await file.read(block_size)
+                if not data:
+                    block_semaphore.release()
+                    break
+
+                block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+                block_ids.append(block_id)
+                size += len(data)
+                stage_tasks.append(asyncio.create_task(stage(block_id, data)))
+
+            await asyncio.gather(*stage_tasks)
+        except BaseException:
+            for task in stage_tasks:
+                task.cancel()
+            raise
+
+        await commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                                content_settings=content_settings,
+                                etag="*",
+                                match_condition=MatchConditions.IfMissing)
+
+        elapsed = time.perf_counter() - started
+        return {"name": file.filename,
+                "size": size,
+                "blocks": len(block_ids),
+                "seconds": round(elapsed, 3),
+                "mb_per_second": round(size / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0}
+
     @staticmethod
     def blob_name_from_file_page(filename: str, page: int = 0) -> str:
         if filename.lower().endswith('.pdf'):
@@ -88,58 +165,55 @@ class AzureBlobStorageService:
         response_list = []
         response_struc: typing.Dict[str, typing.Any] = {}
 
-        blob_list = self.container_client.list_blobs(include=["metadata"])
+        # the listing already carries size, content type and last modified, no per-blob
+        # get_blob_properties round trip is needed and the async client keeps the event loop free
+        if self.async_container_client is not None:
+            blob_list = self.async_container_client.list_blobs(include=["metadata"])
+        else:
+            blob_list = self.iterate_async(self.container_client.list_blobs(include=["metadata"]))
 
-        for blob in blob_list:
-            
-            # Get a BlobClient for a specific blob
-            blob_client = self.container_client.get_blob_client(blob.name)
-
-            # Create a SAS token that's valid for one day, as an example
-            start_time = datetime.datetime.now(datetime.timezone.utc)
-            expiry_time = start_time + datetime.timedelta(minutes=30)
-
-            sas_token = generate_blob_sas(
-                account_name=blob_client.account_name,
-                container_name=blob_client.container_name,
-                blob_name=blob_client.blob_name,
-                account_key=os.environ["AZURE_STORAGE_ACCOUNT_KEY"],
-                permission=BlobSasPermissions(read=True),
-                expiry=expiry_time,
-                start=start_time
-            )
-            sas_url = f"{blob_client.url}?{sas_token}"
-            
-            properties = blob_client.get_blob_properties()
-            response_struc['name'] = str(blob.name)
-            response_struc['content_type'] = str(properties.content_settings.content_type)
-            response_struc['size'] = int(properties.size)
-            response_struc['last_modified'] = properties.last_modified.astimezone(None)
-            response_struc['status'] = DocumentProcessingStatus.Succeeded
-            response_struc['url'] = sas_url
-
-            response_list.append(response_struc.copy())
+        with telemetry.stage("blob_list"):
+            async for blob in blob_list:
+
+                sas_url = await self.aget_sas_url(blob_name=blob.name)
+
+                response_struc['name'] = str(blob.name)
+                response_struc['content_type'] = str(blob.content_settings.content_type)
+                response_struc['size'] = int(blob.size)
+                response_struc['last_modified'] = blob.last_modified.astimezone(None)
+                response_struc['status'] = DocumentProcessingStatus.Succeeded
+                response_struc['url'] = sas_url
+
+                response_list.append(response_struc.copy())
             
         return response_list
+
+    @staticmethod
+    async def iterate_async(items: typing.Iterable) -> typing.AsyncIterator:
+        # one worker thread hop per page of a paged listing (ItemPaged.by_page()), not per item
+        pages = items.by_page() if hasattr(items, "by_page") else iter([items])
+
+        def next_page():
+            page = next(pages, None)
+            return list(page) if page is not None else None
+
+        while True:
+            page = await asyncio.to_thread(next_page)
+            if page is None:
+                break
+            for item in page:
+                yield item
     
-    def get_sas_url_async(self, blob_name) -> str:
+    def get_sas_url(self, blob_name) -> str:
         # Get a BlobClient for a specific blob
         blob_client = self.container_client.get_blob_client(blob_name)
 
-        # Create a SAS token that's valid for one day, as an example
-        start_time = datetime.datetime.now(datetime.timezone.utc)
-        expiry_time = start_time + datetime.timedelta(minutes=30)
-
-        sas_token = generate_blob_sas(
-            account_name=blob_client.account_name,
-            container_name=blob_client.container_name,
-            blob_name=blob_client.blob_name,
-            account_key=os.environ["AZURE_STORAGE_ACCOUNT_KEY"],
-            permission=BlobSasPermissions(read=True),
-            expiry=expiry_time,
-            start=start_time
-        )
-        sas_url = f"{blob_client.url}?{sas_token}"
+        # the URL is reused until shortly before it expires, see SasUrlCache
+        sas_url = sas_url_cache.get_blob_sas_url(blob_client, permission=BlobSasPermissions(read=True))
 
         return sas_url
-            
\ No newline at end of file
+
+    async def aget_sas_url(self, blob_name) -> str:
+        blob_client = self.container_client.get_blob_client(blob_name)
+
+        return await sas_url_cache.aget_blob_sas_url(blob_client, permission=BlobSasPermissions(read=True))
@@ -0,0 +1,31 @@
+import hashlib
+import json
+import re
+from typing import Optional
+
+from app.core.config import settings
+from app.core.single_flight import SingleFlight
+from app.schemas.conversations_schema import RequestModel
+
+whitespace = re.compile(r"\s+")
+
+def normalize_text(text: Optional[str]) -> str:
+    # case, spacing and closing punctuation do not change the answer
+    return whitespace.sub(" ", text or "").strip().rstrip("?!. ").lower()
+
+def chat_request_key(request: RequestModel, owner: Optional[str] = None) -> str:
+    '''
+    Requests with the same key get the same answer: same conversation and owner, normalized
+    question and history, same overrides.
+    '''
+    # a conversation's answer is recorded in it, only a repeated request of the same conversation shares it
+    payload = {"conversation": request.conversationId,
+               "owner": owner,
+               "question": normalize_text(request.lastUserQuestion),
+               "history": [[normalize_text(item.user), normalize_text(item.bot)] for item in request.history],
+               "overrides": request.overrides.model_dump(mode="json"),
+               "approach": request.approach}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+# identical /chat requests in flight share one pipeline execution
+chat_single_flight = SingleFlight(window_seconds=settings.CHAT_COALESCING_WINDOW_SECONDS) if settings.CHAT_COALESCING_ENABLED else None
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+from app.core.ttl_cache import TTLCache
+from app.schemas.conversations_schema import RequestItem
+from app.services.context_packing import approximate_token_count
+from app.services.provider_guard import is_provider_failure
+
+logger = logging.getLogger(__name__)
+
+# (previous summary, turns to fold into it) -> new summary
+Summarizer = Callable[[str, List[RequestItem]], str]
+AsyncSummarizer = Callable[[str, List[RequestItem]], Awaitable[str]]
+
+def turn_text(turn: RequestItem) -> str:
+    return f"User: {turn.user}\nAssistant: {turn.bot or ''}"
+
+def history_fingerprint(turns: Sequence[RequestItem]) -> str:
+    digest = hashlib.sha256()
+    for turn in turns:
+        digest.update(turn_text(turn).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+@dataclass
+class RollingSummary:
+    summary: str
+    # the first `turns` turns of the conversation are in the summary, fingerprint is theirs
+    turns: int
+    fingerprint: str
+
+@dataclass
+class HistoryWindow:
+    summary: str
+    turns: List[RequestItem]
+
+class ChatHistoryManager:
+    '''
+    Bounds the chat history sent to the model, whatever the length of the conversation.
+
+    The last recent_turns turns are kept verbatim and older ones folded into a rolling summary,
+    cached per conversation. Folding is incremental: only the turns not yet in the cached summary are
+    sent to the summarizer along with it, fold_turns of them at a time, so a summarization call
+    happens every fold_turns turns instead of every turn. The cached summary is only reused while
+    the history still starts with the turns it covers.
+
+    Summary and verbatim turns stay within token_budget: turns that do not fit are folded too, and
+    the newest turn, always kept, is cut if it alone exceeds the budget.
+    '''
+    def __init__(self, cache: TTLCache, recent_turns: int = 4, fold_turns: int = 4, token_budget: int = 1500,
+                 summary_max_tokens: int = 300, count_tokens: Callable[[str], int] = approximate_token_count):
+        self.cache = cache
+        self.recent_turns = recent_turns
+        self.fold_turns = fold_turns
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.count_tokens = count_tokens
+
+        self.folds = 0
+
+    def _key(self, conversation_id: Optional[str], history: Sequence[RequestItem]) -> str:
+        # without a conversation id the first turn identifies the conversation, the fingerprint guards against collisions
+        return conversation_id or "first-turn:" + history_fingerprint(history[:1])
+
+    def _cached(self, key: str, history: Sequence[RequestItem]) -> RollingSummary:
+        rolling = self.cache.get(key, None)
+        if rolling is not None and rolling.turns <= len(history) and rolling.fingerprint == history_fingerprint(history[:rolling.turns]):
+            return rolling
+        return RollingSummary(summary="", turns=0, fingerprint=history_fingerprint([]))
+
+    def _cut(self, text: str, budget: int) -> str:
+        if self.count_tokens(text) <= budget:
+            return text
+        words = []
+        for word in text.split():
+            if self.count_tokens(" ".join(words + [word])) > budget:
+                break
+            words.append(word)
+        return " ".join(words)
+
+    def _turn_tokens(self, turn: RequestItem) -> int:
+        return self.count_tokens(turn_text(turn))
+
+    def _cut_turn(self, turn: RequestItem, budget: int) -> RequestItem:
+        user = self._cut(turn.user, budget // 2)
+        bot = self._cut(turn.bot, budget - self.count_tokens(user)) if turn.bot else turn.bot
+        return RequestItem(user=user, bot=bot)
+
+    def plan(self, conversation_id: Optional[str], history: Sequence[RequestItem]) -> Tuple[str, RollingSummary, List[RequestItem], List[RequestItem]]:
+        '''
+        :return: (cache key, cached summary, turns to fold into it, turns to keep verbatim)
+        '''
+        key = self._key(conversation_id, history)
+        rolling = self._cached(key, history)
+        pending = list(history[rolling.turns:])
+
+        # turns past the recent window wait verbatim until there are fold_turns of them
+        outside = max(0, len(pending) - self.recent_turns)
+        fold_count = outside if outside >= self.fold_turns else 0
+
+        # the summary is budgeted at its maximum size when it is about to be regenerated
+        summary_tokens = self.summary_max_tokens if fold_count or rolling.summary else 0
+        budget = self.token_budget - summary_tokens
+        kept_tokens = 0
+        first_kept = len(pending)
+        for index in range(len(pending) - 1, fold_count - 1, -1):
+            tokens = self._turn_tokens(pending[index])
+            if kept_tokens + tokens > budget and first_kept < len(pending):
+                break
+            kept_tokens += tokens
+            first_kept = index
+
+        fold, kept = pending[:first_kept], pending[first_kept:]
+        if kept and self._turn_tokens(kept[-1]) > budget:
+            kept[-1] = self._cut_turn(kept[-1], budget)
+        return key, rolling, fold, kept
+
+    def recall(self, conversation_id: str) -> Optional[RollingSummary]:
+        return self.cache.get(conversation_id, None)
+
+    def remember(self, conversation_id: str, rolling: RollingSummary):
+        # e.g. the summary stored with the conversation, unless this worker already has a more recent one
+        current = self.recall(conversation_id)
+        if current is None or current.turns < rolling.turns:
+            self.cache.set(conversation_id, rolling)
+
+    def _folded(self, key: str, rolling: RollingSummary, history: Sequence[RequestItem], fold: List[RequestItem], summary: str) -> str:
+        summary = self._cut(summary.strip(), self.summary_max_tokens)
+        turns = rolling.turns + len(fold)
+        self.cache.set(key, RollingSummary(summary=summary, turns=turns, fingerprint=history_fingerprint(history[:turns])))
+        self.folds += 1
+        return summary
+
+    def _not_folded(self, rolling: RollingSummary, ex: Exception) -> str:
+        # the turns that did not fit are dropped for this request, the next one folds them again
+        logger.warning(f"Chat history summarization failed, {rolling.turns} turns summarized: {ex}")
+        return rolling.summary
+
+    def window(self, conversation_id: Optional[str], history: Sequence[RequestItem], summarize: Summarizer) -> HistoryWindow:
+        key, rolling, fold, kept = self.plan(conversation_id, history)
+        summary = rolling.summary
+        if fold:
+            try:
+                summary = self._folded(key, rolling, history, fold, summarize(rolling.summary, fold))
+            except Exception as ex:
+                if not is_provider_failure(ex):
+                    raise
+                summary = self._not_folded(rolling, ex)
+        return HistoryWindow(summary=summary, turns=kept)
+
+    async def awindow(self, conversation_id: Optional[str], history: Sequence[RequestItem], summarize: AsyncSummarizer) -> HistoryWindow:
+        key, rolling, fold, kept = self.plan(conversation_id, history)
+        summary = rolling.summary
+        if fold:
+            try:
+                summary = self._folded(key, rolling, history, fold, await summarize(rolling.summary, fold))
+            except Exception as ex:
+                if not is_provider_failure(ex):
+                    raise
+                summary = self._not_folded(rolling, ex)
+        return HistoryWindow(summary=summary, turns=kept)
+
+def create_chat_history_manager() -> ChatHistoryManager:
+    # a summary is worth keeping as long as the conversation token is valid
+    ttl_seconds = settings.CHAT_HISTORY_SUMMARY_TTL_SECONDS or settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    return ChatHistoryManager(cache=TTLCache(max_entries=settings.CHAT_HISTORY_SUMMARY_MAX_ENTRIES, ttl_seconds=ttl_seconds),
+                              recent_turns=settings.CHAT_HISTORY_RECENT_TURNS,
+                              fold_turns=settings.CHAT_HISTORY_FOLD_TURNS,
+                              token_budget=settings.CHAT_HISTORY_TOKEN_BUDGET,
+                              summary_max_tokens=settings.CHAT_HISTORY_SUMMARY_MAX_TOKENS)
+
+chat_history_manager = create_chat_history_manager()
@@ -0,0 +1,176 @@
+import json
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from app.models.conversations_response import SupportingContentRecord, ApproachResponse
+from app.schemas.conversations_schema import RequestModel, ResponseModel
+from app.schemas.directline_schema import Activity, ActivitySet, ChannelAccount, ConversationAccount
+from app.services.langchain_service import LangchainService
+from app.services.azure_blob_storage import AzureBlobStorageService
+from app.services.conversation_store import ConversationState, record_conversation_turn
+from app.services.provider_guard import is_provider_failure
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CITATION_BASE_URL = "http://127.0.0.1:10000/"
+
+class ChatStreamEvent:
+    ANSWER = "answer"
+    CITATIONS = "citations"
+    FOLLOWUPS = "followups"
+    FINAL = "final"
+    ERROR = "error"
+
+class ChatStreamService:
+    '''
+    Streams a /chat answer as a sequence of events: partial "answer" events (answer/thoughts
+    growing token by token), then "citations", then "followups" (when suggestFollowupQuestions) and
+    a "final" event holding the same ResponseModel the blocking /chat endpoint returns. The answered
+    turn is recorded in the conversation, if any, before the "final" event.
+    '''
+    def __init__(self, langchain_service: LangchainService, blob_storage: AzureBlobStorageService):
+        self.langchain_service = langchain_service
+        self.blob_storage = blob_storage
+
+    async def stream(self, request: RequestModel, conversation: ConversationState = None) -> AsyncIterator[Tuple[str, dict]]:
+
+        context = []
+        answer = {}
+        last_partial = None
+
+        try:
+            async for chunk in self.langchain_service.astream_chat_response_with_history(request):
+
+                if chunk.get("context"):
+                    context = chunk["context"]
+
+                if isinstance(chunk.get("answer"), dict):
+                    answer = chunk["answer"]
+                    partial = {"answer": str(answer.get("answer") or ""),
+                               "thoughts": str(answer.get("thoughts") or "")}
+
+                    # the parser re-emits the whole object for every token, only send actual progress
+                    if partial != last_partial and (partial["answer"] or partial["thoughts"]):
+                        last_partial = partial
+                        yield ChatStreamEvent.ANSWER, partial
+
+            chat_answer = str(answer.get("answer") or "")
+            thoughts = answer.get("thoughts")
+
+            if context:
+
+                source_doc_list = self.langchain_service.get_source_doc_list(context)
+                sas_url = await self.blob_storage.aget_sas_url(blob_name=source_doc_list[0])
+                data_points = self.langchain_service.get_data_points_response(context)
+
+                yield ChatStreamEvent.CITATIONS, {"sources": source_doc_list,
+                                                  "data_points": jsonable_encoder(data_points),
+                                                  "citation_base_url": sas_url}
+
+                chat_answer = chat_answer + " " + self.langchain_service.format_source_docs(source_doc_list)
+
+                if request.overrides.suggestFollowupQuestions:
+                    follow_up_q_list = self.langchain_service.get_followup_questions(request, answer)
+
+                    yield ChatStreamEvent.FOLLOWUPS, {"questions": follow_up_q_list}
+
+                    if follow_up_q_list:
+                        chat_answer = chat_answer + " " + self.langchain_service.format_follow_up_questions(follow_up_q_list)
+
+                final_response = ApproachResponse(
+                    answer=chat_answer,
+                    thoughts=thoughts,
+                    data_points=data_points,
+                    citation_base_url=sas_url
+                )
+            else:
+
+                final_response = ApproachResponse(
+                    answer=chat_answer,
+                    thoughts=thoughts,
+                    data_points=[
+                        SupportingContentRecord(title="", content="")
+                    ],
+                    citation_base_url=DEFAULT_CITATION_BASE_URL
+                )
+
+            await record_conversation_turn(conversation, request.lastUserQuestion, answer,
+                                           standalone_question=self.langchain_service.standalone_question,
+                                           sources=self.langchain_service.get_source_doc_list(context))
+
+            response = ResponseModel(
+                answer=final_response.answer,
+                thoughts=final_response.thoughts,
+                data_points=final_response.data_points,
+                images=final_response.images,
+                citation_base_url=final_response.citation_base_url,
+                error=final_response.error
+            )
+
+            yield ChatStreamEvent.FINAL, jsonable_encoder(response)
+
+        except Exception as ex:
+            # the details stay in the server log, they may hold prompts, keys or internal addresses
+            logger.exception(f"Streaming the chat answer failed: {ex}")
+            if is_provider_failure(ex):
+                yield ChatStreamEvent.ERROR, {"error": "The language model is unavailable, please retry later.", "code": "provider_unavailable"}
+            else:
+                yield ChatStreamEvent.ERROR, {"error": "An error occurred while generating the answer.", "code": "internal_error"}
+
+def to_server_sent_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def to_directline_activity(event: str, payload: dict, conversation_id: str, sequence: int, reply_to_id: str = None) -> Activity:
+    '''
+    Map a chat stream event to a Direct Line activity. Partial answers are sent as "typing"
+    activities carrying the cumulative text (streamType "streaming"), citations and follow-up
+    questions as named "event" activities and the complete answer as the final "message".
+    '''
+    activity = Activity(
+        type="event",
+        id=f"{conversation_id}|{sequence:07d}",
+        timestamp=datetime.now(timezone.utc).isoformat(),
+        from_=ChannelAccount(id="omniqhub", role="bot"),
+        conversation=ConversationAccount(id=conversation_id),
+        replyToId=reply_to_id,
+    )
+
+    if event == ChatStreamEvent.ANSWER:
+        activity.type = "typing"
+        activity.text = payload["answer"]
+        activity.channelData = {"streamType": "streaming", "streamSequence": sequence, "thoughts": payload["thoughts"]}
+    elif event == ChatStreamEvent.FINAL:
+        activity.type = "message"
+        activity.text = payload["answer"]
+        activity.value = payload
+        activity.channelData = {"streamType": "final", "streamSequence": sequence}
+    else:
+        activity.name = event
+        activity.value = payload
+
+    return activity
+
+def to_directline_activity_set(activity: Activity, watermark: int) -> dict:
+    activity_set = ActivitySet(activities=[activity], watermark=str(watermark))
+    return activity_set.model_dump(by_alias=True, exclude_none=True)
+
+def parse_directline_request(data: Any) -> Tuple[RequestModel, str]:
+    '''
+    Read a chat request from an incoming WebSocket payload, either a Direct Line "message"
+    activity carrying the RequestModel in its value or a bare RequestModel.
+    :return: (request, activity id to reply to) or (None, None) if the payload is not a chat request
+    '''
+    if not isinstance(data, dict):
+        return None, None
+
+    if data.get("type") == "message" and isinstance(data.get("value"), dict):
+        return RequestModel.model_validate(data["value"]), data.get("id") or str(uuid.uuid4())
+
+    if "lastUserQuestion" in data:
+        return RequestModel.model_validate(data), str(uuid.uuid4())
+
+    return None, None
@@ -0,0 +1,163 @@
+import re
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+from langchain_core.documents import Document
+
+from app.core.config import settings
+
+sentence_boundary = re.compile(r"((?<=[.!?])\s+|\n{2,})")
+whitespace = re.compile(r"\s+")
+
+def approximate_token_count(text: str) -> int:
+    '''About 4 characters per token, the usual estimate for English text with Gemini and GPT tokenizers.'''
+    return (len(text) + 3) // 4
+
+def create_token_counter(tokenizer: str) -> Callable[[str], int]:
+    if tokenizer == "approximate":
+        return approximate_token_count
+    if tokenizer == "tiktoken":
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    raise ValueError(f"Unknown context tokenizer {tokenizer}, expected \"approximate\" or \"tiktoken\"")
+
+def split_sentences(text: str) -> List[Tuple[str, str]]:
+    '''
+    The sentences of text as (separator, sentence) pairs, the separator being the whitespace in
+    front of the sentence ("" for the first), so that joining them keeps the line breaks of lists
+    and tables.
+    '''
+    sentences = []
+    separator = ""
+    # the boundaries are captured, parts alternate between text and separator
+    parts = sentence_boundary.split(text)
+    for i in range(0, len(parts), 2):
+        part = parts[i]
+        sentence = part.strip()
+        if sentence:
+            leading = part[:len(part) - len(part.lstrip())]
+            sentences.append((separator + leading if sentences else "", sentence))
+            separator = part[len(part.rstrip()):]
+        else:
+            separator += part
+        if i + 1 < len(parts):
+            separator += parts[i + 1]
+    return sentences
+
+def join_sentences(sentences: List[Tuple[str, str]]) -> str:
+    return "".join(sentence if i == 0 else separator + sentence for i, (separator, sentence) in enumerate(sentences))
+
+def stronger_separator(separator: str, other: str) -> str:
+    # a paragraph or line break wins over a space
+    return other if other.count("\n") >= separator.count("\n") else separator
+
+def normalize(text: str) -> str:
+    return whitespace.sub(" ", text).strip().lower()
+
+def suffix_prefix_overlap(previous: str, text: str, min_overlap: int) -> int:
+    '''Length of the longest end of previous that text starts with, 0 when shorter than min_overlap.'''
+    for length in range(min(len(previous), len(text)), min_overlap - 1, -1):
+        if previous.endswith(text[:length]):
+            return length
+    return 0
+
+class ContextPacker:
+    '''
+    Packs retrieved chunks into the prompt context within a token budget.
+
+    Chunks are ordered by score (stable, documents without a score keep their order). The overlap
+    text splitters leave between consecutive chunks of a source is cut off, and sentences already
+    packed are skipped, so chunks adding nothing new are dropped. Chunks are then added while they
+    fit; the first one that does not is truncated at a sentence boundary and packing stops. The
+    kept sentences are joined with their original separators, lists and tables keep their lines.
+
+    Packed chunks are new Documents with the metadata of the chunk they come from, so the sources
+    cited are exactly the ones in the prompt.
+    '''
+    def __init__(self, token_budget: int, count_tokens: Callable[[str], int] = approximate_token_count,
+                 separator: str = "\n\n", min_overlap_chars: int = 30):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.separator = separator
+        self.min_overlap_chars = min_overlap_chars
+
+    def _deduplicate(self, text: str, previous_text: Optional[str], seen_sentences: set) -> List[Tuple[str, str]]:
+        if previous_text:
+            text = text[suffix_prefix_overlap(previous_text, text, self.min_overlap_chars):]
+
+        sentences = []
+        # the separators of skipped sentences are merged, a skipped paragraph leaves a paragraph break
+        separator = ""
+        for sentence_separator, sentence in split_sentences(text):
+            separator = stronger_separator(separator, sentence_separator)
+            key = normalize(sentence)
+            if key and key not in seen_sentences:
+                seen_sentences.add(key)
+                sentences.append((separator, sentence))
+                separator = ""
+        return sentences
+
+    def _truncate(self, sentences: List[Tuple[str, str]], budget: int, cut_words: bool) -> List[Tuple[str, str]]:
+        kept = []
+        used = 0
+        for separator, sentence in sentences:
+            tokens = self.count_tokens(sentence) + (self.count_tokens(separator) if kept else 0)
+            if used + tokens > budget:
+                break
+            kept.append((separator, sentence))
+            used += tokens
+
+        # a first sentence longer than the whole budget is cut by words rather than leaving no context
+        if not kept and sentences and cut_words:
+            words = []
+            for word in sentences[0][1].split():
+                if self.count_tokens(" ".join(words + [word])) > budget:
+                    break
+                words.append(word)
+            kept = [("", " ".join(words))] if words else []
+        return kept
+
+    def pack(self, docs: Sequence[Union[Document, Tuple[Document, Optional[float]]]]) -> List[Document]:
+        '''
+        :param docs: Documents, or (document, score) pairs as returned by the retrieval
+        :return: the documents to put in the prompt, in prompt order
+        '''
+        scored = [item if isinstance(item, tuple) else (item, None) for item in docs]
+        scored = sorted(scored, key=lambda item: -item[1] if item[1] is not None else 0.0) if any(score is not None for _, score in scored) else scored
+
+        packed: List[Document] = []
+        previous_text_by_source = {}
+        seen_sentences = set()
+        separator_tokens = self.count_tokens(self.separator)
+        remaining = self.token_budget
+
+        for doc, _ in scored:
+            source = doc.metadata.get("source")
+            sentences = self._deduplicate(doc.page_content, previous_text_by_source.get(source), seen_sentences)
+            previous_text_by_source[source] = doc.page_content
+            if not sentences:
+                continue
+
+            budget = remaining - (separator_tokens if packed else 0)
+            text = join_sentences(sentences)
+            tokens = self.count_tokens(text)
+            if tokens > budget:
+                sentences = self._truncate(sentences, budget, cut_words=not packed)
+                if sentences:
+                    packed.append(Document(page_content=join_sentences(sentences), metadata=dict(doc.metadata)))
+                break
+
+            packed.append(Document(page_content=text, metadata=dict(doc.metadata)))
+            remaining = budget - tokens
+
+        return packed
+
+    def format(self, docs: Sequence[Union[Document, Tuple[Document, Optional[float]]]]) -> str:
+        return self.separator.join(doc.page_content for doc in self.pack(docs))
+
+def create_context_packer(model: str = None) -> ContextPacker:
+    model = model or settings.CHAT_MODEL
+    return ContextPacker(token_budget=settings.CONTEXT_TOKEN_BUDGETS.get(model, settings.CONTEXT_TOKEN_BUDGET),
+                         count_tokens=create_token_counter(settings.CONTEXT_TOKENIZER),
+                         min_overlap_chars=settings.CONTEXT_MIN_OVERLAP_CHARS)
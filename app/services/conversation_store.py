@@ -0,0 +1,254 @@
+import asyncio
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.ttl_cache import TTLCache
+from app.schemas.conversations_schema import RequestItem, RequestModel
+from app.services.chat_history import RollingSummary, chat_history_manager
+
+# current serialized state (None when missing) -> (new serialized state, its TTL), None to leave it as is
+Mutation = Callable[[Optional[str]], Optional[Tuple[str, float]]]
+
+class ConversationNotFoundError(Exception):
+    pass
+
+@dataclass
+class ConversationTurn:
+    user: str
+    bot: str
+    # the question as searched and the documents the answer came from
+    standalone_question: Optional[str] = None
+    sources: List[str] = field(default_factory=list)
+
+@dataclass
+class ConversationState:
+    conversation_id: str
+    expires_at: float
+    # sub of the token the conversation was created with, only its holder can resolve it
+    owner: Optional[str] = None
+    turns: List[ConversationTurn] = field(default_factory=list)
+    # rolling summary of the first turns, see ChatHistoryManager
+    summary: Optional[RollingSummary] = None
+
+    def history(self) -> List[RequestItem]:
+        return [RequestItem(user=turn.user, bot=turn.bot) for turn in self.turns]
+
+    def ttl_seconds(self) -> float:
+        return self.expires_at - time.time()
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, value) -> "ConversationState":
+        data = json.loads(value)
+        return cls(conversation_id=data["conversation_id"],
+                   expires_at=data["expires_at"],
+                   owner=data.get("owner"),
+                   turns=[ConversationTurn(**turn) for turn in data["turns"]],
+                   summary=RollingSummary(**data["summary"]) if data.get("summary") else None)
+
+class ConversationBackend:
+    '''
+    Storage of serialized conversation states, each expiring after its own TTL. blocking tells
+    whether calls do network I/O and must be kept off the event loop.
+    '''
+    blocking = False
+
+    def get(self, conversation_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, conversation_id: str, value: str, ttl_seconds: float):
+        raise NotImplementedError
+
+    def delete(self, conversation_id: str):
+        raise NotImplementedError
+
+    def update(self, conversation_id: str, mutate: Mutation):
+        '''Read-modify-write of one conversation, atomic against concurrent updates.'''
+        # without await in between, atomic for the callers sharing this process' event loop
+        updated = mutate(self.get(conversation_id))
+        if updated is not None:
+            self.set(conversation_id, *updated)
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+class InMemoryConversationBackend(ConversationBackend):
+    '''Process-local LRU backend, for a single worker or when the clients stick to one.'''
+    def __init__(self, max_entries: int):
+        self.cache = TTLCache(max_entries=max_entries, ttl_seconds=0)
+
+    def get(self, conversation_id):
+        return self.cache.get(conversation_id, None)
+
+    def set(self, conversation_id, value, ttl_seconds):
+        self.cache.set(conversation_id, value, ttl_seconds=ttl_seconds)
+
+    def delete(self, conversation_id):
+        self.cache.invalidate(conversation_id)
+
+    def __len__(self):
+        return len(self.cache)
+
+class RedisConversationBackend(ConversationBackend):
+    '''Shared backend for several workers/instances, one string per conversation expiring with it.'''
+    blocking = True
+
+    def __init__(self, redis_client, key_prefix: str = "omniqhub:conversation"):
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+
+    def _key(self, conversation_id: str) -> str:
+        return f"{self.key_prefix}:{conversation_id}"
+
+    def get(self, conversation_id):
+        return self.redis.get(self._key(conversation_id))
+
+    def set(self, conversation_id, value, ttl_seconds):
+        self.redis.set(self._key(conversation_id), value, ex=max(1, int(ttl_seconds)))
+
+    def delete(self, conversation_id):
+        self.redis.delete(self._key(conversation_id))
+
+    def update(self, conversation_id, mutate):
+        from redis.exceptions import WatchError
+
+        # optimistic transaction: the write is dropped and the mutation redone if another worker wrote meanwhile
+        key = self._key(conversation_id)
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    updated = mutate(pipe.get(key))
+                    if updated is None:
+                        pipe.unwatch()
+                        return
+                    value, ttl_seconds = updated
+                    pipe.multi()
+                    pipe.set(key, value, ex=max(1, int(ttl_seconds)))
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def __len__(self):
+        return sum(1 for _ in self.redis.scan_iter(match=f"{self.key_prefix}:*"))
+
+class ConversationStore:
+    '''
+    Server-side state of the conversations issued by /directline/conversations: their turns, the
+    standalone question and sources of each, and the rolling summary of the history. A conversation
+    expires with its access token.
+
+    With a conversationId, /chat only needs the new question: resolve() fills the history from the
+    store (a history sent by the client still takes precedence) and hands the stored summary to the
+    ChatHistoryManager, record() appends the answered turn.
+    '''
+    def __init__(self, backend: ConversationBackend, max_turns: int = 100):
+        self.backend = backend
+        self.max_turns = max_turns
+
+    def create(self, conversation_id: str, expires_at: float, owner: str = None) -> ConversationState:
+        state = ConversationState(conversation_id=conversation_id, expires_at=expires_at, owner=owner)
+        self.save(state)
+        return state
+
+    def get(self, conversation_id: str) -> Optional[ConversationState]:
+        value = self.backend.get(conversation_id)
+        if value is None:
+            return None
+        state = ConversationState.from_json(value)
+        return state if state.ttl_seconds() > 0 else None
+
+    def save(self, state: ConversationState):
+        ttl_seconds = state.ttl_seconds()
+        if ttl_seconds > 0:
+            self.backend.set(state.conversation_id, state.to_json(), ttl_seconds)
+
+    def resolve(self, request: RequestModel, owner: str = None) -> Tuple[RequestModel, Optional[ConversationState]]:
+        '''
+        :param owner: sub of the caller's token, None for an anonymous caller
+        :return: the request with its history and the conversation state, None without a conversationId
+        :raises ConversationNotFoundError: unknown, expired or someone else's conversation and no history sent
+        '''
+        if not request.conversationId:
+            return request, None
+
+        state = self.get(request.conversationId)
+        # someone else's conversation is reported as not found, its existence is not disclosed either
+        if state is not None and state.owner is not None and state.owner != owner:
+            state = None
+        if state is None:
+            if request.history:
+                return request, None
+            raise ConversationNotFoundError(f"Conversation {request.conversationId} not found or expired")
+
+        if not request.history:
+            request = request.model_copy(update={"history": state.history()})
+        if state.summary is not None:
+            chat_history_manager.remember(state.conversation_id, state.summary)
+        return request, state
+
+    def record(self, state: ConversationState, question: str, answer: str, standalone_question: str = None, sources: List[str] = None):
+        turn = ConversationTurn(user=question, bot=answer, standalone_question=standalone_question, sources=list(sources or []))
+
+        def append(value: Optional[str]) -> Optional[Tuple[str, float]]:
+            # appended to the stored state, other workers may have recorded turns since it was resolved
+            current = ConversationState.from_json(value if value is not None else state.to_json())
+            current.turns.append(turn)
+            current.summary = chat_history_manager.recall(current.conversation_id) or current.summary
+
+            # the summary covers a prefix of the turns, dropping turns invalidates it
+            if len(current.turns) > self.max_turns:
+                current.turns = current.turns[-self.max_turns:]
+                current.summary = None
+            ttl_seconds = current.ttl_seconds()
+            return (current.to_json(), ttl_seconds) if ttl_seconds > 0 else None
+
+        self.backend.update(state.conversation_id, append)
+
+    async def aresolve(self, request: RequestModel, owner: str = None) -> Tuple[RequestModel, Optional[ConversationState]]:
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.resolve, request, owner)
+        return self.resolve(request, owner)
+
+    async def arecord(self, state: ConversationState, question: str, answer: str, standalone_question: str = None, sources: List[str] = None):
+        if self.backend.blocking:
+            await asyncio.to_thread(self.record, state, question, answer, standalone_question, sources)
+        else:
+            self.record(state, question, answer, standalone_question, sources)
+
+    async def acreate(self, conversation_id: str, expires_at: float, owner: str = None) -> ConversationState:
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.create, conversation_id, expires_at, owner)
+        return self.create(conversation_id, expires_at, owner)
+
+def create_conversation_store() -> Optional[ConversationStore]:
+
+    if not settings.CONVERSATION_STORE_ENABLED:
+        return None
+
+    if settings.CONVERSATION_STORE_BACKEND == "redis":
+        import redis
+        backend = RedisConversationBackend(redis_client=redis.Redis.from_url(settings.REDIS_URL))
+    else:
+        backend = InMemoryConversationBackend(max_entries=settings.CONVERSATION_STORE_MAX_ENTRIES)
+
+    return ConversationStore(backend=backend, max_turns=settings.CONVERSATION_MAX_TURNS)
+
+conversation_store = create_conversation_store()
+
+async def resolve_conversation(request: RequestModel, owner: str = None) -> Tuple[RequestModel, Optional[ConversationState]]:
+    if conversation_store is None:
+        return request, None
+    return await conversation_store.aresolve(request, owner)
+
+async def record_conversation_turn(state: Optional[ConversationState], question: str, answer: dict, standalone_question: str = None, sources: List[str] = None):
+    # degraded answers are not part of the conversation
+    if state is None or conversation_store is None or answer.get("degraded"):
+        return
+    await conversation_store.arecord(state, question, str(answer.get("answer") or ""), standalone_question, sources)
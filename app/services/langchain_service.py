@@ -1,102 +1,169 @@
 import os
+import re
+import logging
+import asyncio
+import contextvars
 import getpass
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import TextLoader
-from langchain import hub
+from langchain_core.vectorstores import VectorStore
 from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langchain_core.runnables import RunnablePassthrough, RunnableParallel
-from langchain_core.prompts import PromptTemplate, HumanMessagePromptTemplate
-from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain.tools.retriever import create_retriever_tool
-from langchain.agents import AgentExecutor, create_react_agent
-from langchain.agents.format_scratchpad import format_log_to_str
-from langchain.schema.document import Document
+from langchain_core.prompts import PromptTemplate
+from langchain_core.documents import Document
 from langchain_core.messages import AIMessage, HumanMessage
-# from langchain_text_splitters import CharacterTextSplitter
-
-from langchain_community.document_loaders import AzureBlobStorageContainerLoader
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain_core.language_models import BaseChatModel
 
 from app.models.conversations_response import SupportingContentRecord, SupportingImageRecord, ApproachResponse
-from app.schemas.conversations_schema import Conversations, RequestModel, ResponseModel, ChatResponseModel, LineListOutputParser
-from app.models.prompts import template, contextualize_q_system_prompt, qa_system_prompt, generate_queries_prompt
+from app.schemas.conversations_schema import Conversations, RequestItem, RequestModel, ResponseModel, ChatResponseModel, ChatResponseWithFollowupsModel, LineListOutputParser, RetrievalMode, FollowupQuestionsMode
+from app.models.prompts import template, contextualize_q_system_prompt, qa_system_prompt, generate_queries_prompt, history_summary_prompt, summarize_history_prompt
+from app.core.config import settings
+from app.core.lazy import LazyResource
+from app.core.telemetry import telemetry
+from app.services.cached_embeddings import CachedEmbeddings, DiskEmbeddingStore
+from app.services.chat_history import HistoryWindow, chat_history_manager, turn_text
+from app.services.context_packing import create_context_packer
+from app.services.lexical_index import LexicalIndexProvider, load_vector_store_corpus, load_vector_store_revision
+from app.services.provider_guard import guard_chat_model, guard_embeddings, is_provider_failure
+from app.services.retrieval_context import RetrievalContext
+from app.services.semantic_cache import create_semantic_cache
+from app.services.vector_index import NumpyVectorStore
 
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
-vector_store_address: str = os.environ["AZURE_SEARCH_ENDPOINT"]
-vector_store_password: str = os.environ["AZURE_SEARCH_ADMIN_KEY"]
+logger = logging.getLogger(__name__)
+
+# The clients below are created on first use, not at import: building them loads the Google and
+# Azure SDKs and AzureSearch checks its index over the network. Tests can swap them with override().
+
+def ensure_google_api_key():
+    if "GOOGLE_API_KEY" not in os.environ:
+        os.environ["GOOGLE_API_KEY"] = getpass.getpass("Provide your Google API key here")
+
+def create_embeddings() -> CachedEmbeddings:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    ensure_google_api_key()
+    return CachedEmbeddings(
+        underlying=guard_embeddings(GoogleGenerativeAIEmbeddings(model=settings.EMBEDDING_MODEL)),
+        max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+        disk_store=DiskEmbeddingStore(settings.EMBEDDING_CACHE_DIR, settings.EMBEDDING_MODEL,
+                                      max_bytes=settings.EMBEDDING_CACHE_MAX_BYTES) if settings.EMBEDDING_CACHE_DIR else None,
+        stage=telemetry.stage,
+    )
+
+def create_vector_store() -> VectorStore:
+    embeddings = embeddings_resource.get()
+
+    if settings.VECTOR_STORE_BACKEND == "numpy":
+        return NumpyVectorStore(
+            embedding_function=embeddings.embed_query,
+            directory=settings.VECTOR_STORE_DIR,
+            mode=settings.VECTOR_INDEX_MODE,
+            ivf_nlist=settings.VECTOR_INDEX_IVF_NLIST,
+            ivf_nprobe=settings.VECTOR_INDEX_IVF_NPROBE,
+            reload_interval_seconds=settings.VECTOR_STORE_RELOAD_INTERVAL_SECONDS,
+        )
 
-if "GOOGLE_API_KEY" not in os.environ:
-    os.environ["GOOGLE_API_KEY"] = getpass("Provide your Google API key here")
+    from langchain_community.vectorstores.azuresearch import AzureSearch
 
-# print(os.environ["GOOGLE_API_KEY"])
-    
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+    return AzureSearch(
+        azure_search_endpoint=os.environ["AZURE_SEARCH_ENDPOINT"],
+        azure_search_key=os.environ["AZURE_SEARCH_ADMIN_KEY"],
+        index_name=os.environ["AZURE_SEARCH_ENDPOINT_INDEX_NAME"],
+        embedding_function=embeddings.embed_query,
+    )
+
+def create_manifest_container_client():
+    # the ingestion function rewrites the manifest of every blob it indexes, its last change tells the index changed
+    if settings.VECTOR_STORE_BACKEND == "numpy" or not settings.AZURE_STORAGE_MANIFEST_CONTAINER:
+        return None
+
+    from azure.storage.blob import ContainerClient
+
+    return ContainerClient.from_connection_string(os.environ["AZURE_STORAGE_CONNECTION_STRING"], settings.AZURE_STORAGE_MANIFEST_CONTAINER)
 
-index_name: str = os.environ["AZURE_SEARCH_ENDPOINT_INDEX_NAME"]
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=vector_store_address,
-    azure_search_key=vector_store_password,
-    index_name=index_name,
-    embedding_function=embeddings.embed_query,
-)
+def create_llm() -> BaseChatModel:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    ensure_google_api_key()
+    # retries are left to the guard, the client's own would bypass its budget
+    return guard_chat_model(ChatGoogleGenerativeAI(model=settings.CHAT_MODEL, convert_system_message_to_human=True,
+                                                   max_retries=1 if settings.GEMINI_GUARD_ENABLED else 6))
 
 # Retrieve and generate using the relevant snippets of the blog.
-retriever = vector_store.as_retriever(search_type="similarity_score_threshold", search_kwargs={"k": 3, "score_threshold": 0.5})
-prompt = hub.pull("rlm/rag-prompt")
-llm = ChatGoogleGenerativeAI(model="gemini-pro", convert_system_message_to_human=True)
+search_kwargs = {"k": 3, "score_threshold": 0.5}
+
+embeddings_resource: LazyResource[CachedEmbeddings] = LazyResource(create_embeddings)
+vector_store_resource: LazyResource[VectorStore] = LazyResource(create_vector_store)
+retriever_resource = LazyResource(lambda: vector_store_resource.get().as_retriever(search_type="similarity_score_threshold", search_kwargs=search_kwargs),
+                                  name="retriever")
+llm_resource: LazyResource[BaseChatModel] = LazyResource(create_llm)
+manifest_container_resource = LazyResource(create_manifest_container_client)
+
+# runs the separate follow-up question call next to the answer of blocking requests ("concurrent" mode)
+followup_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="followups")
+
+# numbering or bullets models put in front of questions despite the instructions
+followup_question_prefix = re.compile(r"^\s*(?:[-*\u2022]+|\d+[.)]|\(\d+\))\s*")
+
+# bounds the prompt context to the token budget of the chat model
+context_packer = create_context_packer(settings.CHAT_MODEL)
+
+def load_index_revision():
+    # changes whenever the indexed chunks do, see load_vector_store_revision
+    return load_vector_store_revision(vector_store_resource.get(), manifest_container_resource.get())
+
+lexical_index = LexicalIndexProvider(corpus_loader=lambda: load_vector_store_corpus(vector_store_resource.get(), manifest_container_resource.get()),
+                                     revision_loader=load_index_revision,
+                                     refresh_interval_seconds=settings.LEXICAL_INDEX_REFRESH_SECONDS,
+                                     k1=settings.BM25_K1,
+                                     b=settings.BM25_B)
+
+# answers are only served while the indexed chunks are unchanged
+semantic_cache = create_semantic_cache(revision_loader=load_index_revision)
 
 class LangchainService:
     def __init__(self):
-        pass
+        self.standalone_question = None
 
     def format_docs(self, docs):
-        return "\n\n".join(doc.page_content for doc in docs)
+        # the documents are packed already (pack_context), packing them again would only redo the work
+        return context_packer.separator.join(doc.page_content for doc in docs)
 
-    def get_chat_response(self, request: RequestModel):
+    def pack_context(self) -> List[Document]:
+        # the packed chunks of the retrieval are both the prompt context and the cited sources
+        with telemetry.stage("pack_context"):
+            return context_packer.pack(self.retrieval_context.docs_and_scores)
 
-        # Set up a parser + inject instructions into the prompt template.
-        parser = JsonOutputParser(pydantic_object=ChatResponseModel)
+    def degraded_answer(self, ex: Exception) -> dict:
+        # the sources retrieved, if any, are still returned, only the generation is skipped
+        logger.warning(f"Answer generation unavailable, degraded answer returned: {ex}")
+        return {"answer": settings.DEGRADED_ANSWER, "thoughts": "", "degraded": True}
 
-        # custom_rag_prompt = PromptTemplate.from_template(template)
-        custom_rag_prompt = PromptTemplate(
-            template=template,
-            input_variables=["question"],
-            partial_variables={"format_instructions": parser.get_format_instructions()},
-        )
+    def unanswerable_response(self, request: RequestModel, ex: Exception) -> dict:
+        # the question could not be contextualized or embedded, nothing was retrieved
+        return {"context": [], "question": request.lastUserQuestion, "answer": self.degraded_answer(ex)}
 
-        rag_chain_from_docs = (
-            RunnablePassthrough.assign(context=(lambda x: self.format_docs(x["context"])))
-            | custom_rag_prompt
-            | llm
-            | parser
-        )
+    def get_chat_response(self, request: RequestModel):
 
         rag_chain_with_source = RunnableParallel(
-            {"context": retriever, "question": RunnablePassthrough()}
-        ).assign(answer=rag_chain_from_docs)
+            {"context": retriever_resource.get() | context_packer.pack, "question": RunnablePassthrough()}
+        ).assign(answer=self.get_rag_chain())
 
         result = rag_chain_with_source.invoke(request.lastUserQuestion)
         # print(result)
 
         return result
     
-    def get_chat_response_with_history(self, request: RequestModel):
-        
-        self.request = request
-
-        # contextualize_query = self.get_contextualize_query()
-        # print(contextualize_query)
+    def get_rag_chain(self, include_followups: bool = False):
 
         # Set up a parser + inject instructions into the prompt template.
-        parser = JsonOutputParser(pydantic_object=ChatResponseModel)
+        # with include_followups the same generation also returns the follow-up questions
+        parser = JsonOutputParser(pydantic_object=ChatResponseWithFollowupsModel if include_followups else ChatResponseModel)
 
          # custom_rag_prompt = PromptTemplate.from_template(template)
         custom_rag_prompt = PromptTemplate(
@@ -105,41 +172,338 @@ class LangchainService:
             partial_variables={"format_instructions": parser.get_format_instructions()},
         )
 
-        rag_chain_with_history = (
-            RunnablePassthrough.assign(
-                context=self.contextualized_question | retriever | self.format_docs
-            )
+        # the context is retrieved once per request by the RetrievalContext and passed in as documents
+        rag_chain = (
+            RunnablePassthrough.assign(context=(lambda x: self.format_docs(x["context"])))
             | custom_rag_prompt
-            | llm
+            | llm_resource.get()
             | parser
         )
 
-        rag_chain_with_source = RunnableParallel(
-            {"context": retriever, "question": RunnablePassthrough()}
-        ).assign(answer=rag_chain_with_history)
+        return rag_chain
 
+    def create_retrieval_context(self, request: RequestModel) -> RetrievalContext:
 
-        # result = rag_chain_with_source.invoke({"question": request.lastUserQuestion, "chat_history": self.prepare_chat_history(request=request)})
-        result = rag_chain_with_source.invoke(request.lastUserQuestion)
-        # print(result)
+        overrides = request.overrides
+        use_mmr = overrides.useMmr if overrides.useMmr is not None else settings.MMR_ENABLED
+        # MMR runs on the vectors returned by the search, chunks found by the text search alone are embedded
+        # through the embedding cache shared with the ingestion function
+        mmr_candidates = (overrides.mmrCandidates or settings.MMR_CANDIDATES) if use_mmr else None
 
-        return result
+        return RetrievalContext(vector_store=vector_store_resource.get(),
+                                search_kwargs=search_kwargs,
+                                embedding_function=embeddings_resource.get().embed_query,
+                                async_embedding_function=embeddings_resource.get().aembed_query,
+                                retrieval_mode=overrides.retrievalMode,
+                                lexical_index=lexical_index,
+                                candidates=settings.RETRIEVAL_CANDIDATES,
+                                rrf_k=settings.RETRIEVAL_RRF_K,
+                                mmr_candidates=mmr_candidates,
+                                mmr_top=overrides.top,
+                                mmr_lambda=overrides.mmrLambda if overrides.mmrLambda is not None else settings.MMR_LAMBDA,
+                                document_embedding_function=embeddings_resource.get().embed_documents)
+
+    def get_standalone_question(self, request: RequestModel) -> str:
+        # kept with the turn in the conversation store
+        with telemetry.stage("contextualize"):
+            self.standalone_question = self.contextualized_question({"question": request.lastUserQuestion, "chat_history": request.history})
+        return self.standalone_question
+
+    def cache_variant(self) -> tuple:
+        # the overrides changing what is retrieved or answered, requests differing in them do not share answers
+        context, overrides = self.retrieval_context, self.request.overrides
+        return (context.retrieval_mode.name, overrides.top, overrides.suggestFollowupQuestions,
+                context.mmr_candidates, context.mmr_lambda if context.mmr_candidates else None)
+
+    def get_cached_response(self, question: str):
+
+        # the cache is keyed by the question embedding, text retrieval must not embed at all
+        if semantic_cache is None or self.retrieval_context.retrieval_mode == RetrievalMode.Text:
+            return None
+
+        with telemetry.stage("semantic_cache_lookup"):
+            cached = semantic_cache.lookup(self.retrieval_context.embed(question), self.cache_variant())
+        if cached is None:
+            return None
+
+        return {"context": cached["context"], "question": self.request.lastUserQuestion, "answer": cached["answer"]}
+
+    def update_cached_response(self, question: str, response: dict):
+
+        # answers without any source document are not worth serving again
+        if semantic_cache is None or not response["context"] or self.retrieval_context.retrieval_mode == RetrievalMode.Text:
+            return
+
+        semantic_cache.update(self.retrieval_context.embed(question), question, response, self.cache_variant())
+
+    async def aget_standalone_question(self, request: RequestModel) -> str:
+        with telemetry.stage("contextualize"):
+            self.standalone_question = await self.acontextualized_question({"question": request.lastUserQuestion, "chat_history": request.history})
+        return self.standalone_question
+
+    async def aget_cached_response(self, question: str):
+
+        if semantic_cache is None or self.retrieval_context.retrieval_mode == RetrievalMode.Text:
+            return None
+
+        # the Redis backend does network I/O, keep it off the event loop
+        with telemetry.stage("semantic_cache_lookup"):
+            cached = await asyncio.to_thread(semantic_cache.lookup, await self.retrieval_context.aembed(question), self.cache_variant())
+        if cached is None:
+            return None
+
+        return {"context": cached["context"], "question": self.request.lastUserQuestion, "answer": cached["answer"]}
+
+    async def aupdate_cached_response(self, question: str, response: dict):
+
+        if semantic_cache is None or not response["context"] or self.retrieval_context.retrieval_mode == RetrievalMode.Text:
+            return
+
+        await asyncio.to_thread(semantic_cache.update, await self.retrieval_context.aembed(question), question, response, self.cache_variant())
+
+    def get_chat_response_with_history(self, request: RequestModel):
+        
+        self.request = request
+        self.retrieval_context = self.create_retrieval_context(request)
+
+        # the chat model and the embeddings are called before the generation too
+        try:
+            question = self.get_standalone_question(request)
+
+            cached_response = self.get_cached_response(question)
+            if cached_response is not None:
+                return cached_response
+
+            self.retrieval_context.retrieve(question)
+        except Exception as ex:
+            if not is_provider_failure(ex):
+                raise
+            return self.unanswerable_response(request, ex)
+        documents = self.pack_context()
+
+        followup_mode = self.get_followup_mode(request)
+        rag_chain = self.get_rag_chain(include_followups=followup_mode == FollowupQuestionsMode.Inline)
+
+        # follow-up questions need sources, a separate call runs next to the answer or after it
+        followups = None
+        if documents and followup_mode == FollowupQuestionsMode.Concurrent:
+            followups = followup_executor.submit(contextvars.copy_context().run, self.generate_queries, request.lastUserQuestion, documents)
+
+        try:
+            with telemetry.stage("generate"):
+                answer = rag_chain.invoke({"question": request.lastUserQuestion, "context": documents})
+        except Exception as ex:
+            if followups is not None:
+                followups.cancel()
+            if not is_provider_failure(ex):
+                raise
+            return {"context": documents, "question": request.lastUserQuestion, "answer": self.degraded_answer(ex)}
+
+        if followups is not None:
+            answer["followup_questions"] = followups.result()
+        elif documents and followup_mode == FollowupQuestionsMode.After:
+            answer["followup_questions"] = self.generate_queries(request.lastUserQuestion, documents)
+
+        response = {"context": documents, "question": request.lastUserQuestion, "answer": answer}
+        self.update_cached_response(question, response)
+
+        return response
+
+    async def aget_chat_response_with_history(self, request: RequestModel):
+        """
+        Same pipeline as get_chat_response_with_history, with the async clients throughout
+        """
+
+        self.request = request
+        self.retrieval_context = self.create_retrieval_context(request)
+
+        try:
+            question = await self.aget_standalone_question(request)
+
+            cached_response = await self.aget_cached_response(question)
+            if cached_response is not None:
+                return cached_response
+
+            await self.retrieval_context.aretrieve(question)
+        except Exception as ex:
+            if not is_provider_failure(ex):
+                raise
+            return self.unanswerable_response(request, ex)
+        documents = self.pack_context()
+
+        followup_mode = self.get_followup_mode(request)
+        rag_chain = self.get_rag_chain(include_followups=followup_mode == FollowupQuestionsMode.Inline)
+
+        followups = None
+        if documents and followup_mode == FollowupQuestionsMode.Concurrent:
+            followups = asyncio.create_task(self.agenerate_queries(request.lastUserQuestion, documents))
+
+        try:
+            with telemetry.stage("generate"):
+                answer = await rag_chain.ainvoke({"question": request.lastUserQuestion, "context": documents})
+        except BaseException as ex:
+            if followups is not None:
+                followups.cancel()
+            if not isinstance(ex, Exception) or not is_provider_failure(ex):
+                raise
+            # not cached, the next request tries the provider again
+            return {"context": documents, "question": request.lastUserQuestion, "answer": self.degraded_answer(ex)}
+
+        if followups is not None:
+            answer["followup_questions"] = await followups
+        elif documents and followup_mode == FollowupQuestionsMode.After:
+            answer["followup_questions"] = await self.agenerate_queries(request.lastUserQuestion, documents)
+
+        response = {"context": documents, "question": request.lastUserQuestion, "answer": answer}
+        await self.aupdate_cached_response(question, response)
+
+        return response
+
+    async def astream_chat_response_with_history(self, request: RequestModel):
+        """
+        Stream the chat response as it is generated
+        :param request: Chat request
+        :return: async iterator of chunks, the "context" chunk first and then
+                 the partially parsed "answer" dict ({"answer", "thoughts"}) growing token by token
+        """
+
+        self.request = request
+        self.retrieval_context = self.create_retrieval_context(request)
+
+        try:
+            question = await self.aget_standalone_question(request)
+
+            # a cached answer, or the degraded one, is sent whole
+            response = await self.aget_cached_response(question)
+            if response is None:
+                await self.retrieval_context.aretrieve(question)
+        except Exception as ex:
+            if not is_provider_failure(ex):
+                raise
+            response = self.unanswerable_response(request, ex)
+
+        if response is not None:
+            yield {"context": response["context"], "question": request.lastUserQuestion}
+            yield {"answer": response["answer"]}
+            return
+
+        documents = self.pack_context()
+
+        yield {"context": documents, "question": request.lastUserQuestion}
+
+        followup_mode = self.get_followup_mode(request)
+        rag_chain = self.get_rag_chain(include_followups=followup_mode == FollowupQuestionsMode.Inline)
+
+        followups = None
+        if documents and followup_mode == FollowupQuestionsMode.Concurrent:
+            followups = asyncio.create_task(self.agenerate_queries(request.lastUserQuestion, documents))
+
+        answer = {}
+        try:
+            with telemetry.stage("generate"):
+                async for answer in rag_chain.astream({"question": request.lastUserQuestion, "context": documents}):
+                    yield {"answer": answer}
+        except BaseException as ex:
+            if followups is not None:
+                followups.cancel()
+            # once part of the answer is out, the error is reported as such
+            if answer or not isinstance(ex, Exception) or not is_provider_failure(ex):
+                raise
+            yield {"answer": self.degraded_answer(ex)}
+            return
+
+        # "after" starts the separate call only once the whole answer has been streamed
+        if followups is not None:
+            answer = {**answer, "followup_questions": await followups}
+            yield {"answer": answer}
+        elif documents and followup_mode == FollowupQuestionsMode.After:
+            answer = {**answer, "followup_questions": await self.agenerate_queries(request.lastUserQuestion, documents)}
+            yield {"answer": answer}
+
+        await self.aupdate_cached_response(question, {"context": documents, "question": request.lastUserQuestion, "answer": answer})
     
-    def generate_queries(self, question: str) -> List[str]:
+    def get_followup_mode(self, request: RequestModel) -> Optional[FollowupQuestionsMode]:
+        if not request.overrides.suggestFollowupQuestions:
+            return None
+        return request.overrides.followupQuestionsMode or FollowupQuestionsMode(settings.FOLLOWUP_QUESTIONS_MODE)
+
+    def get_followup_questions(self, request: RequestModel, answer: dict) -> List[str]:
+
+        if not request.overrides.suggestFollowupQuestions:
+            return []
+
+        questions = (self.clean_follow_up_question(q) for q in answer.get("followup_questions") or [] if isinstance(q, str))
+        return [q for q in questions if q]
+
+    def generate_queries(self, question: str, documents: List[Document] = None) -> List[str]:
+
+        chain = self.get_generate_queries_chain(documents)
+
+        # follow-up questions are optional, none rather than failing the answer
+        try:
+            with telemetry.stage("followups"):
+                response = chain.invoke(question)
+        except Exception as ex:
+            if not is_provider_failure(ex):
+                raise
+            return []
+        return response
+
+    async def agenerate_queries(self, question: str, documents: List[Document] = None) -> List[str]:
+
+        chain = self.get_generate_queries_chain(documents)
+
+        try:
+            with telemetry.stage("followups"):
+                response = await chain.ainvoke(question)
+        except Exception as ex:
+            if not is_provider_failure(ex):
+                raise
+            return []
+        return response
+
+    def get_generate_queries_chain(self, documents: List[Document] = None):
 
         output_parser = LineListOutputParser()
 
         prompt = ChatPromptTemplate.from_template(generate_queries_prompt)
 
+        # reuse the documents already retrieved for the answer instead of searching again
+        if documents is not None:
+            context = lambda _: self.format_docs(documents)
+        else:
+            context = retriever_resource.get() | context_packer.pack | self.format_docs
+
         chain = (
-            {"context": retriever | self.format_docs, "question": RunnablePassthrough()}
+            {"context": context, "question": RunnablePassthrough()}
             | prompt
-            | llm
+            | llm_resource.get()
             | output_parser
         )
 
-        response = chain.invoke(question)
-        return response
+        return chain
+
+    def format_source_docs(self, source_doc_list: List[str]) -> str:
+
+        str_doc = ""
+        for singdoc in source_doc_list:
+            str_doc += "["+singdoc+"]"
+
+        return str_doc
+
+    def format_follow_up_questions(self, follow_up_q_list: List[str]) -> str:
+
+        str_follow_up_q = ""
+        for sing_q in follow_up_q_list:
+            sing_q = self.clean_follow_up_question(sing_q)
+            str_follow_up_q += "<<"+sing_q+">>"
+
+        return str_follow_up_q
+
+    def clean_follow_up_question(self, question: str) -> str:
+
+        # only the leading numbering goes, digits in the question itself ("90 days") stay
+        return followup_question_prefix.sub("", question).strip()
                 
     def get_data_points_response(self, documents):
 
@@ -173,34 +537,67 @@ class LangchainService:
 
         contextualize_q_chain = self.get_contextualize_q_chain()
 
-        contextualize_query =   contextualize_q_chain.invoke(
-                                    {
-                                        "chat_history": self.prepare_chat_history(),
-                                        "question": self.request.lastUserQuestion,
-                                    }
-                                )
+        # the last turns verbatim and a rolling summary of the older ones, see ChatHistoryManager
+        with telemetry.stage("history_window"):
+            window = chat_history_manager.window(self.request.conversationId, self.request.history, self.summarize_history)
+
+        contextualize_query =   contextualize_q_chain.invoke(self.get_contextualize_input(window))
         
         return contextualize_query
+
+    async def aget_contextualize_query(self):
+
+        with telemetry.stage("history_window"):
+            window = await chat_history_manager.awindow(self.request.conversationId, self.request.history, self.asummarize_history)
+
+        return await self.get_contextualize_q_chain().ainvoke(self.get_contextualize_input(window))
+
+    def get_contextualize_input(self, window: HistoryWindow) -> dict:
+        return {
+            "chat_history": self.prepare_chat_history(window.turns),
+            "history_summary": history_summary_prompt.format(summary=window.summary) if window.summary else "",
+            "question": self.request.lastUserQuestion,
+        }
+
+    def get_summarize_history_chain(self):
+
+        prompt = PromptTemplate.from_template(summarize_history_prompt)
+
+        return prompt | llm_resource.get() | StrOutputParser()
+
+    def get_summarize_history_input(self, summary: str, turns: List[RequestItem]) -> dict:
+        # about 0.75 words per token
+        return {"summary": summary or "(none)",
+                "turns": "\n\n".join(turn_text(turn) for turn in turns),
+                "max_words": settings.CHAT_HISTORY_SUMMARY_MAX_TOKENS * 3 // 4}
+
+    def summarize_history(self, summary: str, turns: List[RequestItem]) -> str:
+        with telemetry.stage("summarize_history"):
+            return self.get_summarize_history_chain().invoke(self.get_summarize_history_input(summary, turns))
+
+    async def asummarize_history(self, summary: str, turns: List[RequestItem]) -> str:
+        with telemetry.stage("summarize_history"):
+            return await self.get_summarize_history_chain().ainvoke(self.get_summarize_history_input(summary, turns))
     
     def get_contextualize_q_chain(self):
 
         contextualize_q_prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", contextualize_q_system_prompt),
+                ("system", contextualize_q_system_prompt + "\n\n{history_summary}"),
                 MessagesPlaceholder(variable_name="chat_history"),
                 ("human", "{question}"),
             ]
         )
 
-        contextualize_q_chain = contextualize_q_prompt | llm | StrOutputParser()
+        contextualize_q_chain = contextualize_q_prompt | llm_resource.get() | StrOutputParser()
 
         return contextualize_q_chain
     
-    def prepare_chat_history(self):
+    def prepare_chat_history(self, turns: List[RequestItem] = None):
 
         chat_history = []
 
-        for history in self.request.history:
+        for history in (self.request.history if turns is None else turns):
 
             human_message = HumanMessage(content=history.user)
             ai_message = AIMessage(content=history.bot if history.bot is not None else "")
@@ -212,6 +609,22 @@ class LangchainService:
     
     def contextualized_question(self, input: dict):
         if input.get("chat_history"):
-            return self.get_contextualize_query()
+            # without the provider the question is searched as asked
+            try:
+                return self.get_contextualize_query()
+            except Exception as ex:
+                if not is_provider_failure(ex):
+                    raise
+                return input["question"]
+        else:
+            return input["question"]
+    async def acontextualized_question(self, input: dict):
+        if input.get("chat_history"):
+            try:
+                return await self.aget_contextualize_query()
+            except Exception as ex:
+                if not is_provider_failure(ex):
+                    raise
+                return input["question"]
         else:
-            return input["question"]
\ No newline at end of file
+            return input["question"]
@@ -0,0 +1,216 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Hashable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from app.services.vector_index import NumpyVectorStore
+
+logger = logging.getLogger(__name__)
+
+token_pattern = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text: str) -> List[str]:
+    return token_pattern.findall(text.lower())
+
+class Bm25Index:
+    '''
+    In-memory Okapi BM25 inverted index: every term maps to the rows of the chunks containing it
+    and the term frequencies there, so a query only touches the postings of its own terms.
+    '''
+    def __init__(self, documents: List[Document], k1: float = 1.5, b: float = 0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for row, doc in enumerate(documents):
+            terms = tokenize(doc.page_content)
+            lengths[row] = len(terms)
+            for term, frequency in Counter(terms).items():
+                rows, frequencies = postings[term]
+                rows.append(row)
+                frequencies.append(frequency)
+
+        average_length = float(lengths.mean()) if len(documents) else 0.0
+        # length normalisation of every chunk, precomputed once
+        self._norms = k1 * (1 - b + b * lengths / average_length) if average_length else np.full(len(documents), k1, dtype=np.float32)
+        self._postings = {term: (np.array(rows, dtype=np.int64), np.array(frequencies, dtype=np.float32))
+                          for term, (rows, frequencies) in postings.items()}
+        self._idf = {term: float(np.log(1 + (len(documents) - len(rows) + 0.5) / (len(rows) + 0.5)))
+                     for term, (rows, _) in self._postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def search(self, query: str, k: int) -> List[Tuple[Document, float]]:
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self._postings:
+                continue
+            rows, frequencies = self._postings[term]
+            scores[rows] += self._idf[term] * frequencies * (self.k1 + 1) / (frequencies + self._norms[rows])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched) or k <= 0:
+            return []
+
+        top = matched[np.argpartition(-scores[matched], min(k, len(matched)) - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.documents[row], float(scores[row])) for row in top]
+
+def load_vector_store_revision(vector_store: VectorStore, manifest_container_client=None) -> Hashable:
+    '''
+    Revision of the chunks of the vector store, told without reading them. None when it cannot be
+    told, the chunks are then read on every refresh.
+
+    For Azure Search: the document count of the index and the last change of the ingestion
+    manifests (manifest_container_client), which the ingestion function rewrites for every blob it
+    indexes or removes. The count alone misses a blob re-indexed into as many chunks.
+    '''
+    if isinstance(vector_store, NumpyVectorStore):
+        return vector_store.revision
+
+    from langchain_community.vectorstores import azuresearch
+
+    if not isinstance(vector_store, azuresearch.AzureSearch):
+        return None
+
+    last_modified = None
+    if manifest_container_client is not None:
+        try:
+            last_modified = max((blob.last_modified for blob in manifest_container_client.list_blobs()), default=None)
+        except Exception as ex:
+            logger.warning(f"Listing the ingestion manifests failed, the BM25 index revision is the document count only: {ex}")
+    return vector_store.client.get_document_count(), last_modified
+
+def azure_search_document(result: dict) -> Document:
+    '''
+    The chunk of an Azure AI Search result, with the metadata the AzureSearch vector store gives it.
+    '''
+    from langchain_community.vectorstores import azuresearch
+
+    metadata = result.get(azuresearch.FIELDS_METADATA) or "{}"
+    metadata = json.loads(metadata) if isinstance(metadata, str) else metadata
+    return Document(page_content=result[azuresearch.FIELDS_CONTENT],
+                    metadata={azuresearch.FIELDS_ID: result[azuresearch.FIELDS_ID], **metadata})
+
+def load_vector_store_corpus(vector_store: VectorStore, manifest_container_client=None) -> Tuple[Hashable, List[Document]]:
+    '''
+    Reads every chunk of the vector store. Returns a revision (None when it cannot be told
+    without reading the chunks) and the chunks.
+    '''
+    if isinstance(vector_store, NumpyVectorStore):
+        # the same revision as load_vector_store_revision(), read before the chunks
+        revision = vector_store.revision
+        return revision, vector_store.get_documents()[1]
+
+    # only loaded when the Azure Search backend is in use
+    from langchain_community.vectorstores import azuresearch
+
+    if isinstance(vector_store, azuresearch.AzureSearch):
+        # read before the chunks, a change meanwhile is picked up by the next refresh
+        revision = load_vector_store_revision(vector_store, manifest_container_client)
+        results = vector_store.client.search(search_text="*", select=[azuresearch.FIELDS_ID, azuresearch.FIELDS_CONTENT, azuresearch.FIELDS_METADATA])
+        documents = [azure_search_document(result) for result in results]
+        return revision, documents
+
+    raise TypeError(f"Cannot read the chunks of a {type(vector_store).__name__}")
+
+class LexicalIndexProvider:
+    '''
+    Keeps a Bm25Index over the chunks of the vector store, built and rebuilt in a background thread
+    so that no search waits for it: get_index() is None until the first build completed and the
+    retrieval falls back to the vector search meanwhile. start() begins the first build, e.g. at
+    application startup, a failed build is retried after retry_seconds.
+
+    The index is rebuilt when it is older than refresh_interval_seconds and the corpus revision
+    changed. With a revision_loader the revision is checked first and the chunks are only read when
+    it changed.
+    '''
+    def __init__(self, corpus_loader: Callable[[], Tuple[Hashable, List[Document]]], refresh_interval_seconds: float = 300,
+                 k1: float = 1.5, b: float = 0.75, revision_loader: Callable[[], Hashable] = None, retry_seconds: float = 30):
+        self.corpus_loader = corpus_loader
+        self.revision_loader = revision_loader
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.retry_seconds = retry_seconds
+        self.k1 = k1
+        self.b = b
+
+        self._lock = threading.Lock()
+        self._index: Bm25Index = None
+        self._revision: Hashable = None
+        self._built_at: Optional[float] = None
+        self._refreshing = False
+
+    def _unchanged(self) -> bool:
+        if self._index is None or self.revision_loader is None:
+            return False
+        revision = self.revision_loader()
+        return revision is not None and revision == self._revision
+
+    def _build(self):
+        if self._unchanged():
+            return
+        revision, documents = self.corpus_loader()
+        if revision is not None and revision == self._revision and self._index is not None:
+            return
+        index = Bm25Index(documents, k1=self.k1, b=self.b)
+        self._index, self._revision = index, revision
+        logger.info(f"Built BM25 index over {len(index)} chunks")
+
+    def _refresh(self):
+        try:
+            self._build()
+        except Exception as ex:
+            logger.error(f"Building the BM25 index failed: {ex}")
+        finally:
+            self._built_at = time.monotonic()
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="bm25-refresh", daemon=True).start()
+
+    def start(self):
+        '''Begin building the index in the background, so the first hybrid search finds it ready.'''
+        if self._index is None:
+            self._refresh_in_background()
+
+    def build(self):
+        '''Build the index from the calling thread, whatever the revision, e.g. before a benchmark run.'''
+        with self._lock:
+            self._index, self._revision = None, None
+            self._build()
+            self._built_at = time.monotonic()
+
+    @property
+    def ready(self) -> bool:
+        return self._index is not None
+
+    def get_index(self) -> Optional[Bm25Index]:
+        '''The current index, None while the first one is being built.'''
+        stale_after = self.refresh_interval_seconds if self._index is not None else self.retry_seconds
+        if self._built_at is None or time.monotonic() - self._built_at >= stale_after:
+            self._refresh_in_background()
+        return self._index
+
+    def invalidate(self):
+        '''Drop the index, the next search starts rebuilding it, e.g. after the vector store was replaced.'''
+        with self._lock:
+            self._index, self._revision, self._built_at = None, None, None
+
+    def search(self, query: str, k: int) -> List[Tuple[Document, float]]:
+        '''BM25 results, empty while the index is being built.'''
+        index = self.get_index()
+        return index.search(query, k) if index is not None else []
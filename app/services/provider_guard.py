@@ -0,0 +1,171 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from app.core.config import settings
+from app.core.resilience import (AdaptiveConcurrencyLimit, CircuitBreaker, ProviderGuard, ProviderUnavailableError, RetryBudget,
+                                 TokenBucket, classify_error)
+from app.services.context_packing import approximate_token_count
+
+def prompt_tokens(messages: List[BaseMessage]) -> int:
+    return sum(approximate_token_count(str(message.content)) for message in messages)
+
+def completion_tokens(result: ChatResult) -> int:
+    tokens = 0
+    for generation in result.generations:
+        usage = getattr(generation.message, "usage_metadata", None)
+        tokens += usage["output_tokens"] if usage else approximate_token_count(generation.text)
+    return tokens
+
+def is_provider_failure(ex: BaseException) -> bool:
+    '''The provider could not answer (fail fast, quota or outage), as opposed to a bug or a bad request.'''
+    return isinstance(ex, ProviderUnavailableError) or classify_error(ex) is not None
+
+class GuardedChatModel(BaseChatModel):
+    '''
+    Chat model calling the underlying one through a ProviderGuard. The prompt tokens are estimated
+    before the call, the completion tokens charged after it. A stream is retried only until its first
+    chunk, past that the partial answer has been sent.
+    '''
+    underlying: BaseChatModel
+    guard: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return f"guarded-{self.underlying._llm_type}"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        result = self.guard.call(lambda: self.underlying._generate(messages, stop=stop, run_manager=run_manager, **kwargs),
+                                 tokens=prompt_tokens(messages))
+        self.guard.charge_tokens(completion_tokens(result))
+        return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        result = await self.guard.acall(lambda: self.underlying._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+                                        tokens=prompt_tokens(messages))
+        self.guard.charge_tokens(completion_tokens(result))
+        return result
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self.guard.calls += 1
+        self.guard.retry_budget.record_call()
+        attempt = 0
+        while True:
+            streamed = False
+            try:
+                with self.guard.permit(prompt_tokens(messages)):
+                    output_tokens = 0
+                    for chunk in self.underlying._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                        streamed = True
+                        output_tokens += approximate_token_count(chunk.text)
+                        yield chunk
+            except ProviderUnavailableError:
+                raise
+            except Exception as ex:
+                if streamed:
+                    # not retried, the partial answer has been sent, but a failure of the provider all the same
+                    self.guard.record_failure(ex)
+                    raise
+                if not self.guard.should_retry(attempt, ex):
+                    raise
+                time.sleep(self.guard.backoff(attempt, ex))
+                attempt += 1
+                continue
+            except BaseException:
+                # closed by the consumer or cancelled
+                self.guard.breaker.record_ignored()
+                raise
+            self.guard.record_success()
+            self.guard.charge_tokens(output_tokens)
+            return
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self.guard.calls += 1
+        self.guard.retry_budget.record_call()
+        attempt = 0
+        while True:
+            streamed = False
+            try:
+                async with self.guard.apermit(prompt_tokens(messages)):
+                    output_tokens = 0
+                    async for chunk in self.underlying._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                        streamed = True
+                        output_tokens += approximate_token_count(chunk.text)
+                        yield chunk
+            except ProviderUnavailableError:
+                raise
+            except Exception as ex:
+                if streamed:
+                    # not retried, the partial answer has been sent, but a failure of the provider all the same
+                    self.guard.record_failure(ex)
+                    raise
+                if not self.guard.should_retry(attempt, ex):
+                    raise
+                await asyncio.sleep(self.guard.backoff(attempt, ex))
+                attempt += 1
+                continue
+            except BaseException:
+                # closed by the consumer or cancelled
+                self.guard.breaker.record_ignored()
+                raise
+            self.guard.record_success()
+            self.guard.charge_tokens(output_tokens)
+            return
+
+class GuardedEmbeddings(Embeddings):
+    '''Embeddings calling the underlying ones through a ProviderGuard, one request per call.'''
+    def __init__(self, underlying: Embeddings, guard: ProviderGuard):
+        self.underlying = underlying
+        self.guard = guard
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.guard.call(lambda: self.underlying.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.guard.call(lambda: self.underlying.embed_query(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.guard.acall(lambda: self.underlying.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.guard.acall(lambda: self.underlying.aembed_query(text))
+
+def create_provider_guard(name: str, requests_per_minute: int, tokens_per_minute: int, retry_budget: RetryBudget) -> ProviderGuard:
+    return ProviderGuard(name=name,
+                         requests_bucket=TokenBucket(requests_per_minute) if requests_per_minute else None,
+                         tokens_bucket=TokenBucket(tokens_per_minute) if tokens_per_minute else None,
+                         concurrency=AdaptiveConcurrencyLimit(initial=settings.GEMINI_CONCURRENCY_INITIAL,
+                                                              minimum=settings.GEMINI_CONCURRENCY_MIN,
+                                                              maximum=settings.GEMINI_CONCURRENCY_MAX),
+                         retry_budget=retry_budget,
+                         breaker=CircuitBreaker(name,
+                                                failure_threshold=settings.GEMINI_CIRCUIT_FAILURE_THRESHOLD,
+                                                reset_seconds=settings.GEMINI_CIRCUIT_RESET_SECONDS),
+                         max_wait_seconds=settings.GEMINI_MAX_WAIT_SECONDS,
+                         max_retries=settings.GEMINI_MAX_RETRIES,
+                         backoff_base_seconds=settings.GEMINI_BACKOFF_BASE_SECONDS,
+                         backoff_max_seconds=settings.GEMINI_BACKOFF_MAX_SECONDS)
+
+# one retry budget for both clients, the chat model and the embeddings have separate quotas and circuits
+if settings.GEMINI_GUARD_ENABLED:
+    retry_budget = RetryBudget(ratio=settings.GEMINI_RETRY_BUDGET_RATIO, min_retries=settings.GEMINI_RETRY_BUDGET_MIN_RETRIES)
+    chat_guard = create_provider_guard("gemini-chat", settings.GEMINI_CHAT_REQUESTS_PER_MINUTE, settings.GEMINI_CHAT_TOKENS_PER_MINUTE, retry_budget)
+    embedding_guard = create_provider_guard("gemini-embeddings", settings.GEMINI_EMBEDDING_REQUESTS_PER_MINUTE, 0, retry_budget)
+else:
+    retry_budget = chat_guard = embedding_guard = None
+
+def guard_chat_model(model: BaseChatModel) -> BaseChatModel:
+    return GuardedChatModel(underlying=model, guard=chat_guard) if chat_guard is not None else model
+
+def guard_embeddings(embeddings: Embeddings) -> Embeddings:
+    return GuardedEmbeddings(embeddings, embedding_guard) if embedding_guard is not None else embeddings
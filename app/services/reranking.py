@@ -0,0 +1,34 @@
+from typing import List
+
+import numpy as np
+
+def maximal_marginal_relevance(query_embedding: List[float], embeddings: List[List[float]], k: int, lambda_mult: float = 0.5) -> List[int]:
+    '''
+    Maximal marginal relevance selection of k of the candidate embeddings, returns their indexes in
+    selection order. The similarity matrix is computed once and the highest similarity of every
+    candidate to the selection is kept up to date, so each step is a single vector operation.
+    '''
+    if not len(embeddings) or k <= 0:
+        return []
+
+    candidates = np.asarray(embeddings, dtype=np.float32)
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < min(k, len(candidates)):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * max_similarity, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+
+    return selected
@@ -0,0 +1,224 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from app.core.telemetry import telemetry
+from app.schemas.conversations_schema import RetrievalMode
+from app.services.lexical_index import LexicalIndexProvider, azure_search_document
+from app.services.reranking import maximal_marginal_relevance
+
+# runs the BM25 search next to the vector search of synchronous hybrid retrievals
+lexical_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bm25")
+
+def document_key(doc: Document) -> tuple:
+    return (doc.metadata.get("source"), doc.page_content)
+
+def reciprocal_rank_fusion(result_lists: List[List[Tuple[Document, float]]], k: int, rrf_k: int = 60) -> List[Tuple[Document, float]]:
+    '''
+    Fuses ranked lists by summing 1 / (rrf_k + rank) over the lists a chunk appears in.
+    Returns the k best chunks with their fused score.
+    '''
+    fused = {}
+    for results in result_lists:
+        for rank, (doc, _) in enumerate(results, start=1):
+            key = document_key(doc)
+            best_doc, score = fused.get(key, (doc, 0.0))
+            fused[key] = (best_doc, score + 1.0 / (rrf_k + rank))
+
+    return sorted(fused.values(), key=lambda item: item[1], reverse=True)[:k]
+
+def azure_search_by_vector(vector_store: VectorStore, embedding: List[float], k: int,
+                           filters: str = None) -> List[Tuple[Document, float, Optional[List[float]]]]:
+    '''
+    AzureSearch vector search run on its search client, the query being embedded already. The hits
+    carry their content_vector and the @search.score the store reports as relevance score.
+    '''
+    from azure.search.documents.models import VectorizedQuery
+    from langchain_community.vectorstores.azuresearch import FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, FIELDS_ID, FIELDS_METADATA
+
+    hits = vector_store.client.search(
+        search_text=None,
+        vector_queries=[VectorizedQuery(vector=embedding, k_nearest_neighbors=k, fields=FIELDS_CONTENT_VECTOR)],
+        filter=filters,
+        select=[FIELDS_ID, FIELDS_CONTENT, FIELDS_METADATA, FIELDS_CONTENT_VECTOR],
+        top=k,
+    )
+    return [(azure_search_document(hit), float(hit["@search.score"]), hit.get(FIELDS_CONTENT_VECTOR)) for hit in hits]
+
+def search_by_vector(vector_store: VectorStore, embedding: List[float], k: int, score_threshold: float = None,
+                     **kwargs) -> List[Tuple[Document, float, Optional[List[float]]]]:
+    '''
+    Vector search with the question embedded beforehand, the relevance scores of
+    similarity_search_with_relevance_scores without it embedding the question again. Every chunk
+    comes with its stored vector, None when the store does not return it.
+    '''
+    if hasattr(vector_store, "similarity_search_by_vector_with_vectors"):
+        results = vector_store.similarity_search_by_vector_with_vectors(embedding, k=k, **kwargs)
+    elif hasattr(vector_store, "similarity_search_by_vector_with_relevance_scores"):
+        results = [(doc, score, None) for doc, score in vector_store.similarity_search_by_vector_with_relevance_scores(embedding, k=k, **kwargs)]
+    else:
+        results = azure_search_by_vector(vector_store, embedding, k, filters=kwargs.get("filters"))
+
+    return results if score_threshold is None else [result for result in results if result[1] >= score_threshold]
+
+class RetrievalContext:
+    '''
+    Request-scoped retrieval result. The standalone question is embedded and searched once and
+    the documents are shared by the answer chain, the source list, the data points and the
+    follow-up question generation.
+
+    retrieval_mode picks vector search, BM25 text search (no embedding call) or both, run
+    concurrently with candidates results each and fused by reciprocal rank fusion. Until the BM25
+    index is built the text and hybrid modes fall back to the vector search.
+
+    With mmr_candidates that many chunks are retrieved and re-ranked by maximal marginal relevance
+    down to mmr_top, dropping near-duplicates. The re-ranking uses the vectors returned by the vector
+    search, only chunks found by the text search alone are embedded. Not applied to text retrieval.
+    '''
+    def __init__(self, vector_store: VectorStore, search_kwargs: dict, embedding_function: Callable[[str], List[float]] = None,
+                 retrieval_mode: RetrievalMode = RetrievalMode.Vector, lexical_index: LexicalIndexProvider = None,
+                 candidates: int = 10, rrf_k: int = 60, mmr_candidates: int = None, mmr_top: int = None, mmr_lambda: float = 0.5,
+                 document_embedding_function: Callable[[List[str]], List[List[float]]] = None,
+                 async_embedding_function: Callable[[str], Awaitable[List[float]]] = None):
+        self.vector_store = vector_store
+        self.search_kwargs = search_kwargs
+        self.embedding_function = embedding_function
+        self.retrieval_mode = retrieval_mode
+        self.lexical_index = lexical_index
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.mmr_candidates = mmr_candidates if retrieval_mode != RetrievalMode.Text else None
+        self.mmr_top = mmr_top or search_kwargs.get("k", 4)
+        self.mmr_lambda = mmr_lambda
+        self.document_embedding_function = document_embedding_function
+        self.async_embedding_function = async_embedding_function
+        self.question: str = None
+        self.docs_and_scores: List[Tuple[Document, float]] = None
+        self._embeddings = {}
+        # stored vectors of the chunks returned by the vector search, by document_key
+        self._chunk_vectors = {}
+
+        if retrieval_mode != RetrievalMode.Vector and lexical_index is None:
+            raise ValueError(f"Retrieval mode {retrieval_mode.name} requires a lexical index")
+
+    @property
+    def documents(self) -> List[Document]:
+        if self.docs_and_scores is None:
+            raise RuntimeError("retrieve() must be called before reading the retrieved documents")
+        return [doc for doc, _ in self.docs_and_scores]
+
+    @property
+    def k(self) -> int:
+        if self.mmr_candidates:
+            return self.mmr_candidates
+        return self.search_kwargs.get("k", 4)
+
+    def _effective_mode(self) -> RetrievalMode:
+        # vector search only while the BM25 index is being built, see LexicalIndexProvider
+        if self.retrieval_mode != RetrievalMode.Vector and self.lexical_index.get_index() is None:
+            return RetrievalMode.Vector
+        return self.retrieval_mode
+
+    def _vector_search_kwargs(self, mode: RetrievalMode) -> dict:
+        if mode == RetrievalMode.Hybrid:
+            return {**self.search_kwargs, "k": max(self.k, self.candidates)}
+        return {**self.search_kwargs, "k": self.k}
+
+    def _lexical_search(self, question: str, mode: RetrievalMode) -> List[Tuple[Document, float]]:
+        k = max(self.k, self.candidates) if mode == RetrievalMode.Hybrid else self.k
+        with telemetry.stage("lexical_search"):
+            return self.lexical_index.search(question, k)
+
+    def _fuse(self, lexical_results: List[Tuple[Document, float]], vector_results: List[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+        return reciprocal_rank_fusion([vector_results, lexical_results], k=self.k, rrf_k=self.rrf_k)
+
+    def _rerank(self, question: str, docs_and_scores: List[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+        if not self.mmr_candidates or len(docs_and_scores) <= 1:
+            return docs_and_scores[:self.mmr_top] if self.mmr_candidates else docs_and_scores
+
+        with telemetry.stage("rerank"):
+            embeddings = self._candidate_embeddings([doc for doc, _ in docs_and_scores])
+            selected = maximal_marginal_relevance(self.embed(question), embeddings, k=self.mmr_top, lambda_mult=self.mmr_lambda)
+        return [docs_and_scores[i] for i in selected]
+
+    def _candidate_embeddings(self, docs: List[Document]) -> List[List[float]]:
+        embeddings = [self._chunk_vectors.get(document_key(doc)) for doc in docs]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for i, embedding in zip(missing, self.document_embedding_function([docs[i].page_content for i in missing])):
+                embeddings[i] = embedding
+        return embeddings
+
+    def _keep_vectors(self, results: List[Tuple[Document, float, Optional[List[float]]]]) -> List[Tuple[Document, float]]:
+        self._chunk_vectors.update((document_key(doc), vector) for doc, _, vector in results if vector is not None)
+        return [(doc, score) for doc, score, _ in results]
+
+    def _vector_search(self, question: str, mode: RetrievalMode) -> List[Tuple[Document, float]]:
+        # the embedding is shared with the semantic cache and the re-ranking
+        embedding = self.embed(question)
+        with telemetry.stage("vector_search"):
+            return self._keep_vectors(search_by_vector(self.vector_store, embedding, **self._vector_search_kwargs(mode)))
+
+    async def _avector_search(self, question: str, mode: RetrievalMode) -> List[Tuple[Document, float]]:
+        embedding = await self.aembed(question)
+        with telemetry.stage("vector_search"):
+            return self._keep_vectors(await asyncio.to_thread(search_by_vector, self.vector_store, embedding, **self._vector_search_kwargs(mode)))
+
+    def retrieve(self, question: str) -> List[Document]:
+
+        if self.docs_and_scores is None or self.question != question:
+            mode = self._effective_mode()
+            with telemetry.stage("retrieve"):
+                if mode == RetrievalMode.Text:
+                    self.docs_and_scores = self._lexical_search(question, mode)
+                elif mode == RetrievalMode.Hybrid:
+                    lexical_future = lexical_executor.submit(contextvars.copy_context().run, self._lexical_search, question, mode)
+                    vector_results = self._vector_search(question, mode)
+                    self.docs_and_scores = self._fuse(lexical_future.result(), vector_results)
+                else:
+                    self.docs_and_scores = self._vector_search(question, mode)
+                self.docs_and_scores = self._rerank(question, self.docs_and_scores)
+            self.question = question
+
+        return self.documents
+
+    async def aretrieve(self, question: str) -> List[Document]:
+
+        if self.docs_and_scores is None or self.question != question:
+            mode = self._effective_mode()
+            with telemetry.stage("retrieve"):
+                if mode == RetrievalMode.Text:
+                    self.docs_and_scores = await asyncio.to_thread(self._lexical_search, question, mode)
+                elif mode == RetrievalMode.Hybrid:
+                    lexical_results, vector_results = await asyncio.gather(
+                        asyncio.to_thread(self._lexical_search, question, mode),
+                        self._avector_search(question, mode),
+                    )
+                    self.docs_and_scores = self._fuse(lexical_results, vector_results)
+                else:
+                    self.docs_and_scores = await self._avector_search(question, mode)
+                if self.mmr_candidates:
+                    self.docs_and_scores = await asyncio.to_thread(self._rerank, question, self.docs_and_scores)
+            self.question = question
+
+        return self.documents
+
+    def embed(self, question: str) -> List[float]:
+
+        if question not in self._embeddings:
+            self._embeddings[question] = self.embedding_function(question)
+
+        return self._embeddings[question]
+
+    async def aembed(self, question: str) -> List[float]:
+
+        if question not in self._embeddings:
+            if self.async_embedding_function is None:
+                return await asyncio.to_thread(self.embed, question)
+            self._embeddings[question] = await self.async_embedding_function(question)
+
+        return self._embeddings[question]
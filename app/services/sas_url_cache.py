@@ -0,0 +1,108 @@
+import asyncio
+import datetime
+import os
+import threading
+
+from azure.storage.blob import BlobClient, BlobSasPermissions, BlobServiceClient, UserDelegationKey, generate_blob_sas
+
+from app.core.config import settings
+from app.core.telemetry import telemetry
+from app.core.ttl_cache import TTLCache, MISSING
+
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+class UserDelegationKeyProvider:
+    '''
+    Hands out a cached user delegation key (requires a BlobServiceClient authenticated with
+    Azure AD) and requests a new one once it would expire before min_remaining.
+    '''
+    def __init__(self, blob_service_client: BlobServiceClient, validity: datetime.timedelta):
+        self.blob_service_client = blob_service_client
+        self.validity = validity
+        self._lock = threading.Lock()
+        self._key: UserDelegationKey = None
+        self._expiry: datetime.datetime = None
+
+    def get_key(self, min_remaining: datetime.timedelta) -> UserDelegationKey:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            if self._key is None or self._expiry - now < min_remaining:
+                self._expiry = now + self.validity
+                with telemetry.stage("blob_user_delegation_key"):
+                    self._key = self.blob_service_client.get_user_delegation_key(key_start_time=now, key_expiry_time=self._expiry)
+            return self._key
+
+class SasUrlCache:
+    '''
+    Reuses the SAS URL of a blob (per permission) until refresh_margin before it expires, so
+    repeated citations get the same URL, which browsers and CDNs can cache. URLs are signed with
+    the account key, or with a cached user delegation key when a key provider is given.
+    '''
+    def __init__(self, validity: datetime.timedelta, refresh_margin: datetime.timedelta, max_entries: int,
+                 account_key: str = None, delegation_key_provider: UserDelegationKeyProvider = None):
+        self.validity = validity
+        self.refresh_margin = refresh_margin
+        self.account_key = account_key
+        self.delegation_key_provider = delegation_key_provider
+        self.cache = TTLCache(max_entries=max_entries, ttl_seconds=(validity - refresh_margin).total_seconds())
+
+    @staticmethod
+    def _key(blob_client: BlobClient, permission: BlobSasPermissions) -> tuple:
+        return blob_client.account_name, blob_client.container_name, blob_client.blob_name, str(permission)
+
+    def get_blob_sas_url(self, blob_client: BlobClient, permission: BlobSasPermissions = None) -> str:
+        permission = permission or BlobSasPermissions(read=True)
+        key = self._key(blob_client, permission)
+
+        sas_url = self.cache.get(key)
+        if sas_url is MISSING:
+            sas_url = f"{blob_client.url}?{self.generate_sas_token(blob_client, permission)}"
+            self.cache.set(key, sas_url)
+
+        return sas_url
+
+    async def aget_blob_sas_url(self, blob_client: BlobClient, permission: BlobSasPermissions = None) -> str:
+        # signing with the account key is local, fetching a user delegation key is a network call,
+        # a cached URL is returned without leaving the event loop either way
+        permission = permission or BlobSasPermissions(read=True)
+        if self.delegation_key_provider is not None and self.cache.get(self._key(blob_client, permission)) is MISSING:
+            return await asyncio.to_thread(self.get_blob_sas_url, blob_client, permission)
+        return self.get_blob_sas_url(blob_client, permission)
+
+    @telemetry.traced("sas_sign")
+    def generate_sas_token(self, blob_client: BlobClient, permission: BlobSasPermissions) -> str:
+        start_time = datetime.datetime.now(datetime.timezone.utc)
+        expiry_time = start_time + self.validity
+
+        if self.delegation_key_provider is not None:
+            credential = {"user_delegation_key": self.delegation_key_provider.get_key(min_remaining=self.validity)}
+        else:
+            credential = {"account_key": self.account_key}
+
+        return generate_blob_sas(
+            account_name=blob_client.account_name,
+            container_name=blob_client.container_name,
+            blob_name=blob_client.blob_name,
+            permission=permission,
+            expiry=expiry_time,
+            start=start_time,
+            **credential
+        )
+
+def create_sas_url_cache() -> SasUrlCache:
+
+    delegation_key_provider = None
+    if settings.SAS_USE_USER_DELEGATION_KEY:
+        from azure.identity import DefaultAzureCredential
+        blob_service_client = BlobServiceClient(account_url=os.environ["AZURE_STORAGE_ACCOUNT_URL"], credential=DefaultAzureCredential())
+        delegation_key_provider = UserDelegationKeyProvider(blob_service_client=blob_service_client,
+                                                            validity=datetime.timedelta(hours=settings.SAS_USER_DELEGATION_KEY_VALIDITY_HOURS))
+
+    return SasUrlCache(validity=datetime.timedelta(minutes=settings.SAS_URL_VALIDITY_MINUTES),
+                       refresh_margin=datetime.timedelta(minutes=settings.SAS_URL_REFRESH_MARGIN_MINUTES),
+                       max_entries=settings.SAS_URL_CACHE_MAX_ENTRIES,
+                       account_key=os.environ.get("AZURE_STORAGE_ACCOUNT_KEY"),
+                       delegation_key_provider=delegation_key_provider)
+
+sas_url_cache = create_sas_url_cache()
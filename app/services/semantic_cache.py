@@ -0,0 +1,349 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.core.config import settings
+from app.core.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+def normalize(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+@dataclass
+class SemanticCacheEntry:
+    question: str
+    embedding: np.ndarray
+    value: dict
+    # only matched by lookups of the same partition, see SemanticAnswerCache.partition()
+    partition: str
+    expires_at: float
+
+class SemanticCacheBackend:
+    '''
+    Storage for semantic cache entries. lookup() returns the best entry of the partition whose
+    cosine similarity to the (normalized) embedding is at least the threshold, together with the
+    similarity. get_index_version() changes with invalidate().
+    '''
+    def lookup(self, embedding: np.ndarray, threshold: float, partition: str) -> Optional[Tuple[SemanticCacheEntry, float]]:
+        raise NotImplementedError
+
+    def add(self, entry: SemanticCacheEntry):
+        raise NotImplementedError
+
+    def get_index_version(self) -> str:
+        raise NotImplementedError
+
+    def invalidate(self):
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+class InMemorySemanticCacheBackend(SemanticCacheBackend):
+    '''
+    Process-local backend. Embeddings live in one preallocated matrix so a lookup is a single
+    matrix-vector product; the OrderedDict keeps the LRU order of the occupied rows. Entries of
+    other partitions are not matched and age out of the LRU order.
+    '''
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, SemanticCacheEntry]" = OrderedDict()
+        self._vectors: np.ndarray = None
+        self._active: np.ndarray = np.zeros(max_entries, dtype=bool)
+        self._index_version = str(uuid.uuid4())
+
+    def lookup(self, embedding, threshold, partition):
+        with self._lock:
+            if not self._entries:
+                return None
+
+            now = time.time()
+            for slot in [slot for slot, entry in self._entries.items() if entry.expires_at <= now]:
+                self._remove(slot)
+
+            matching = np.zeros(self.max_entries, dtype=bool)
+            matching[[slot for slot, entry in self._entries.items() if entry.partition == partition]] = True
+            if not matching.any():
+                return None
+
+            similarities = np.where(matching, self._vectors @ embedding, -1.0)
+            slot = int(np.argmax(similarities))
+            similarity = float(similarities[slot])
+
+            if similarity < threshold:
+                return None
+
+            self._entries.move_to_end(slot)
+            return self._entries[slot], similarity
+
+    def add(self, entry):
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != entry.embedding.shape[0]:
+                self._vectors = np.zeros((self.max_entries, entry.embedding.shape[0]), dtype=np.float32)
+                self._active[:] = False
+                self._entries.clear()
+
+            if len(self._entries) >= self.max_entries:
+                slot, _ = self._entries.popitem(last=False)
+                self._active[slot] = False
+                self.evictions += 1
+
+            slot = int(np.argmin(self._active))
+            self._vectors[slot] = entry.embedding
+            self._active[slot] = True
+            self._entries[slot] = entry
+
+    def get_index_version(self):
+        return self._index_version
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._active[:] = False
+            self._index_version = str(uuid.uuid4())
+
+    def _remove(self, slot: int):
+        del self._entries[slot]
+        self._active[slot] = False
+
+    def __len__(self):
+        return len(self._entries)
+
+class RedisSemanticCacheBackend(SemanticCacheBackend):
+    '''
+    Shared backend for several workers/instances, requires the RediSearch module (Redis Stack).
+    Every entry is a Redis hash with its own expiry, indexed by an HNSW vector index so a lookup
+    is a single KNN query whatever the number of entries, filtered by the partition tag. A sorted set
+    keeps the LRU order (score = last access) to bound the size and a version counter, bumped by
+    the ingestion function, lets any worker invalidate the entries of every worker.
+    '''
+    def __init__(self, redis_client, max_entries: int, ttl_seconds: int, key_prefix: str = "omniqhub:semantic_cache"):
+        self.redis = redis_client
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        self.evictions = 0
+        # dimension of the index this worker made sure exists
+        self._index_dimension = None
+
+    def _entry_key(self, entry_id: str) -> str:
+        return f"{self.key_prefix}:entry:{entry_id}"
+
+    @property
+    def _lru_key(self) -> str:
+        return f"{self.key_prefix}:lru"
+
+    @property
+    def _version_key(self) -> str:
+        return f"{self.key_prefix}:version"
+
+    @property
+    def _index_name(self) -> str:
+        return f"{self.key_prefix}:index"
+
+    def _ensure_index(self, dimension: int):
+        from redis.exceptions import ResponseError
+
+        if self._index_dimension == dimension:
+            return
+        try:
+            self.redis.execute_command("FT.CREATE", self._index_name, "ON", "HASH", "PREFIX", "1", self._entry_key(""),
+                                       "SCHEMA", "partition", "TAG",
+                                       "embedding", "VECTOR", "HNSW", "6", "TYPE", "FLOAT32", "DIM", dimension, "DISTANCE_METRIC", "COSINE")
+        except ResponseError as ex:
+            # created by another worker
+            if "already exists" not in str(ex).lower():
+                raise
+        self._index_dimension = dimension
+
+    def lookup(self, embedding, threshold, partition):
+        from redis.exceptions import ResponseError
+
+        try:
+            result = self.redis.execute_command("FT.SEARCH", self._index_name,
+                                                f"(@partition:{{{partition}}})=>[KNN 1 @embedding $vector AS distance]",
+                                                "PARAMS", "2", "vector", np.asarray(embedding, dtype=np.float32).tobytes(),
+                                                "SORTBY", "distance",
+                                                "RETURN", "5", "distance", "embedding", "question", "value", "expires_at",
+                                                "DIALECT", "2")
+        except ResponseError as ex:
+            # nothing added yet, the index does not exist
+            if "no such index" in str(ex).lower():
+                return None
+            raise
+
+        # [total, key, [field, value, ...]]
+        if not result or not result[0]:
+            return None
+        entry_id = _to_str(result[1])[len(self._entry_key("")):]
+        fields = {_to_str(name): value for name, value in zip(result[2][::2], result[2][1::2])}
+
+        # cosine distance
+        similarity = 1.0 - float(fields["distance"])
+        now = time.time()
+        if similarity < threshold or float(fields["expires_at"]) <= now:
+            return None
+
+        self.redis.zadd(self._lru_key, {entry_id: now})
+
+        entry = SemanticCacheEntry(question=_to_str(fields["question"]),
+                                   embedding=np.frombuffer(fields["embedding"], dtype=np.float32),
+                                   value=json.loads(fields["value"]),
+                                   partition=partition,
+                                   expires_at=float(fields["expires_at"]))
+        return entry, similarity
+
+    def add(self, entry):
+        self._ensure_index(entry.embedding.shape[0])
+        entry_id = str(uuid.uuid4())
+
+        pipe = self.redis.pipeline()
+        pipe.hset(self._entry_key(entry_id), mapping={
+            "embedding": entry.embedding.astype(np.float32).tobytes(),
+            "question": entry.question,
+            "value": json.dumps(entry.value),
+            "partition": entry.partition,
+            "expires_at": entry.expires_at,
+        })
+        pipe.expire(self._entry_key(entry_id), self.ttl_seconds)
+        pipe.zadd(self._lru_key, {entry_id: time.time()})
+        pipe.execute()
+
+        overflow = self.redis.zcard(self._lru_key) - self.max_entries
+        if overflow > 0:
+            evicted = [_to_str(entry_id) for entry_id, _ in self.redis.zpopmin(self._lru_key, overflow)]
+            if evicted:
+                self.redis.delete(*[self._entry_key(entry_id) for entry_id in evicted])
+                self.evictions += len(evicted)
+
+    def get_index_version(self):
+        return _to_str(self.redis.get(self._version_key) or b"0")
+
+    def invalidate(self):
+        self.redis.incr(self._version_key)
+
+    def __len__(self):
+        return int(self.redis.zcard(self._lru_key))
+
+def _to_str(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+class SemanticAnswerCache:
+    '''
+    Answer cache keyed on the embedding of the standalone question. A lookup hits when a cached
+    question is at least `similarity_threshold` cosine-similar, entries expire after `ttl_seconds`.
+
+    Entries are partitioned by the revision of the indexed documents (revision_loader, checked
+    every revision_check_seconds), the backend's version (see invalidate()) and the request
+    overrides shaping the answer, so an answer is never served once its documents changed nor to
+    a request retrieving or answering differently.
+    '''
+    def __init__(self, backend: SemanticCacheBackend, similarity_threshold: float, ttl_seconds: int,
+                 revision_loader: Callable[[], Hashable] = None, revision_check_seconds: float = 30):
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.revision_loader = revision_loader
+        self.revision_check_seconds = revision_check_seconds
+        self._revision: Hashable = None
+        self._revision_checked_at: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    def revision(self) -> Hashable:
+        # e.g. an Azure Search round trip, not made on every lookup
+        now = time.monotonic()
+        if self.revision_loader is not None and (self._revision_checked_at is None or now - self._revision_checked_at >= self.revision_check_seconds):
+            try:
+                self._revision = self.revision_loader()
+            except Exception as ex:
+                logger.warning(f"Reading the index revision failed, the semantic cache keeps the previous one: {ex}")
+            self._revision_checked_at = now
+        return self._revision
+
+    def partition(self, variant: Hashable = None) -> str:
+        '''Digest of the index revision, the backend version and the request variant, a valid Redis tag.'''
+        return hashlib.sha256(repr((self.revision(), self.backend.get_index_version(), variant)).encode("utf-8")).hexdigest()[:32]
+
+    def lookup(self, embedding: List[float], variant: Hashable = None) -> Optional[dict]:
+        found = self.backend.lookup(normalize(embedding), self.similarity_threshold, self.partition(variant))
+
+        if found is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry, _ = found
+        return self.deserialize(entry.value)
+
+    def update(self, embedding: List[float], question: str, value: dict, variant: Hashable = None):
+        entry = SemanticCacheEntry(question=question,
+                                   embedding=normalize(embedding),
+                                   value=self.serialize(value),
+                                   partition=self.partition(variant),
+                                   expires_at=time.time() + self.ttl_seconds)
+        self.backend.add(entry)
+        self.stores += 1
+
+    def invalidate(self):
+        '''Drop every cached answer, to be called whenever the indexed documents change.'''
+        self.backend.invalidate()
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": getattr(self.backend, "evictions", 0),
+                "invalidations": self.invalidations,
+                "size": len(self.backend)}
+
+    @staticmethod
+    def serialize(value: dict) -> dict:
+        return {"answer": value["answer"],
+                "context": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in value["context"]]}
+
+    @staticmethod
+    def deserialize(value: dict) -> dict:
+        return {"answer": value["answer"],
+                "context": [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in value["context"]]}
+
+def create_semantic_cache(revision_loader: Callable[[], Hashable] = None) -> Optional[SemanticAnswerCache]:
+
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
+
+    if settings.SEMANTIC_CACHE_BACKEND == "redis":
+        import redis
+        backend = RedisSemanticCacheBackend(redis_client=redis.Redis.from_url(settings.REDIS_URL),
+                                            max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+                                            ttl_seconds=settings.SEMANTIC_CACHE_TTL_SECONDS)
+    else:
+        backend = InMemorySemanticCacheBackend(max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES)
+
+    cache = SemanticAnswerCache(backend=backend,
+                                similarity_threshold=settings.SEMANTIC_CACHE_SIMILARITY_THRESHOLD,
+                                ttl_seconds=settings.SEMANTIC_CACHE_TTL_SECONDS,
+                                revision_loader=revision_loader,
+                                revision_check_seconds=settings.SEMANTIC_CACHE_REVISION_CHECK_SECONDS)
+    telemetry.register_stats("semantic_cache", "Semantic answer cache", cache.stats,
+                             counters=("hits", "misses", "stores", "evictions", "invalidations"))
+    return cache
@@ -0,0 +1,162 @@
+'''
+Latency and throughput benchmark of the API, offline and deterministic.
+
+    python -m app.tests.benchmarks
+    python -m app.tests.benchmarks --scenarios chat --concurrency 1,8,32 --requests 200 --llm-ms 1500
+    python -m app.tests.benchmarks --compare app/tests/benchmarks/results/<previous run>.json
+    python -m app.tests.benchmarks --scenarios chat --concurrency 32 --llm-quota 5
+
+Every scenario runs through the real FastAPI application; Gemini, the embeddings, the vector
+store, blob storage and SQL Server are fakes waiting the configured latencies. Results (p50/p95/p99,
+requests/s and the time per request spent in each fake) are printed and saved as JSON.
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, List
+
+import httpx
+
+from app.tests.benchmarks import fakes
+from app.tests.benchmarks.harness import BenchmarkEnvironment, ScenarioResult, compare, format_results, run_level, run_metadata, save_results
+
+retrieval_modes = {"text": 0, "vector": 1, "hybrid": 2}
+
+def chat_request(index: int, retrieval_mode: int) -> dict:
+    return {"history": [],
+            "overrides": {"semanticRanker": None,
+                          "retrievalMode": retrieval_mode,
+                          "semanticCaptions": None,
+                          "excludeCategory": None,
+                          "top": 3,
+                          "temperature": None,
+                          "promptTemplate": None,
+                          "promptTemplatePrefix": None,
+                          "promptTemplateSuffix": None,
+                          "suggestFollowupQuestions": True},
+            "lastUserQuestion": fakes.questions[index % len(fakes.questions)],
+            "approach": 0}
+
+def create_scenarios(client: httpx.AsyncClient, environment: BenchmarkEnvironment, api_prefix: str, retrieval_mode: int) -> Dict[str, Callable]:
+
+    async def chat(index: int):
+        response = await client.post(f"{api_prefix}/chat", json=chat_request(index, retrieval_mode))
+        response.raise_for_status()
+
+    async def chat_stream(index: int):
+        response = await client.post(f"{api_prefix}/chat/stream", json=chat_request(index, retrieval_mode))
+        response.raise_for_status()
+        if "event: final" not in response.text:
+            raise RuntimeError(f"The stream ended without a final event: {response.text[-200:]}")
+
+    async def documents(index: int):
+        response = await client.get(f"{api_prefix}/documents")
+        response.raise_for_status()
+
+    async def conversations(index: int):
+        response = await client.post(f"{api_prefix}/directline/conversations",
+                                     headers={"Authorization": f"Bearer {environment.access_token}"})
+        response.raise_for_status()
+
+    return {"chat": chat, "chat_stream": chat_stream, "documents": documents, "conversations": conversations}
+
+async def run_benchmark(args: argparse.Namespace, environment: BenchmarkEnvironment) -> List[dict]:
+    from app.core.config import settings
+
+    results = []
+    transport = httpx.ASGITransport(app=environment.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        scenarios = create_scenarios(client, environment, settings.API_V1_STR, retrieval_modes[args.retrieval_mode])
+
+        for name in args.scenarios:
+            send = scenarios[name]
+
+            # first requests build the lazy clients, the BM25 index and the caches
+            await run_level(send, requests=args.warmup, concurrency=1)
+
+            for concurrency in args.concurrency:
+                fakes.recorder.reset()
+                latencies_ms, errors, seconds = await run_level(send, requests=args.requests, concurrency=concurrency)
+                result = ScenarioResult(scenario=name,
+                                        concurrency=concurrency,
+                                        requests=args.requests,
+                                        errors=errors,
+                                        seconds=seconds,
+                                        latencies_ms=latencies_ms,
+                                        stages=fakes.recorder.snapshot()).to_dict()
+                results.append(result)
+                print(format_results([result])[-1], flush=True)
+
+    return results
+
+def parse_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    defaults = fakes.FakeLatencies()
+    parser = argparse.ArgumentParser(prog="python -m app.tests.benchmarks", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", type=parse_list, default=["chat", "chat_stream", "documents", "conversations"],
+                        help="comma separated: chat, chat_stream, documents, conversations")
+    parser.add_argument("--concurrency", type=lambda value: [int(item) for item in parse_list(value)], default=[1, 4, 16],
+                        help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=3, help="requests per scenario before measuring")
+    parser.add_argument("--retrieval-mode", choices=sorted(retrieval_modes), default="vector")
+    parser.add_argument("--corpus-chunks", type=int, default=200)
+    parser.add_argument("--blobs", type=int, default=50, help="documents listed by GET /documents")
+    parser.add_argument("--llm-ms", type=float, default=defaults.llm_ms, help="latency of one Gemini call")
+    parser.add_argument("--llm-token-ms", type=float, default=defaults.llm_token_ms, help="latency per streamed token")
+    parser.add_argument("--llm-quota", type=float, default=defaults.llm_quota_per_second,
+                        help="Gemini calls per second the fake accepts before answering 429, 0 for no quota")
+    parser.add_argument("--embed-ms", type=float, default=defaults.embed_ms)
+    parser.add_argument("--vector-search-ms", type=float, default=defaults.vector_search_ms)
+    parser.add_argument("--blob-ms", type=float, default=defaults.blob_ms)
+    parser.add_argument("--sql-ms", type=float, default=defaults.sql_ms)
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(__file__), "results", f"{time.strftime('%Y%m%d-%H%M%S')}.json"),
+                        help="JSON file the run is saved to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios) - {"chat", "chat_stream", "documents", "conversations"}
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    latencies = fakes.FakeLatencies(llm_ms=args.llm_ms,
+                                    llm_token_ms=args.llm_token_ms,
+                                    embed_ms=args.embed_ms,
+                                    vector_search_ms=args.vector_search_ms,
+                                    blob_ms=args.blob_ms,
+                                    sql_ms=args.sql_ms,
+                                    llm_quota_per_second=args.llm_quota)
+
+    print(format_results([])[0], flush=True)
+    with BenchmarkEnvironment(latencies=latencies, corpus_chunks=args.corpus_chunks, blobs=args.blobs) as environment:
+        results = asyncio.run(run_benchmark(args, environment))
+
+    run = {"metadata": run_metadata(latencies,
+                                    requests=args.requests,
+                                    warmup=args.warmup,
+                                    retrieval_mode=args.retrieval_mode,
+                                    corpus_chunks=args.corpus_chunks,
+                                    blobs=args.blobs),
+           "results": results}
+    save_results(args.output, run)
+    print(f"\nSaved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            previous = json.load(file)
+        print(f"\nCompared to {args.compare} ({previous['metadata'].get('git_revision')}):")
+        print("\n".join(compare(previous, run)))
+
+    return 1 if any(result["errors"] for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
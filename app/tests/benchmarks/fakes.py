@@ -0,0 +1,349 @@
+'''
+Deterministic offline stand-ins for the services the API calls (Gemini, embeddings, vector store,
+blob storage, SQL Server), each with a configurable latency and recording the time spent in it
+per stage, so the benchmark measures the service itself.
+'''
+import asyncio
+import datetime
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from app.services.lexical_index import tokenize
+from app.services.vector_index import NumpyVectorStore
+
+@dataclass
+class FakeLatencies:
+    llm_ms: float = 800
+    llm_token_ms: float = 5
+    embed_ms: float = 80
+    vector_search_ms: float = 100
+    blob_ms: float = 30
+    sql_ms: float = 10
+    # Gemini calls accepted per second, beyond that they fail with 429 (0: no quota)
+    llm_quota_per_second: float = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+class StageRecorder:
+    '''Thread-safe count and total time per stage (llm, embed, vector_search, blob, sql).'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, tuple] = {}
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            calls, total = self._stages.get(stage, (0, 0.0))
+            self._stages[stage] = (calls + 1, total + seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def snapshot(self) -> Dict[str, tuple]:
+        with self._lock:
+            return dict(self._stages)
+
+recorder = StageRecorder()
+
+def sleep(milliseconds: float):
+    if milliseconds > 0:
+        time.sleep(milliseconds / 1000)
+
+async def asleep(milliseconds: float):
+    if milliseconds > 0:
+        await asyncio.sleep(milliseconds / 1000)
+
+# LLM
+
+class FakeQuotaExceeded(Exception):
+    '''What the Gemini client raises on 429 RESOURCE_EXHAUSTED.'''
+    code = 429
+
+class FakeQuota:
+    '''Provider-side quota of per_second calls, counted in fixed one second windows.'''
+    def __init__(self, per_second: float):
+        self.per_second = per_second
+        self._lock = threading.Lock()
+        self._window = 0
+        self._calls = 0
+        self.rejected = 0
+
+    def check(self):
+        with self._lock:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window, self._calls = window, 0
+            self._calls += 1
+            if self._calls > self.per_second:
+                self.rejected += 1
+                raise FakeQuotaExceeded("429 Resource has been exhausted (e.g. check quota).")
+
+answer_text = "The deductible of the Northwind Standard plan is $500 per year. Thanks for asking!"
+followup_questions = ["What does the Northwind Health Plus plan cover?", "How do I submit a claim?", "What is the co-pay for specialists?"]
+
+class FakeChatModel(BaseChatModel):
+    '''
+    Answers the prompts of LangchainService: JSON answers for the RAG prompt, one question per line
+    for the follow-up prompt and the question itself otherwise. Waits latency_ms per call (and
+    token_latency_ms per streamed token). With a quota, calls beyond it fail right away with a 429.
+    '''
+    latency_ms: float = 800
+    token_latency_ms: float = 5
+    quota: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark-chat"
+
+    @staticmethod
+    def respond(messages: List[BaseMessage]) -> str:
+        prompt = str(messages[-1].content)
+        if "JSON" in prompt:
+            return json.dumps({"answer": answer_text, "thoughts": "Taken from the benefit documents.", "followup_questions": followup_questions})
+        if "alternative questions" in prompt:
+            return "\n".join(followup_questions)
+        return prompt
+
+    def check_quota(self):
+        if self.quota is not None:
+            self.quota.check()
+
+    @staticmethod
+    def tokens(text: str) -> List[str]:
+        return [text[i:i + 8] for i in range(0, len(text), 8)]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self.check_quota()
+        with recorder.timed("llm"):
+            sleep(self.latency_ms)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.respond(messages)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self.check_quota()
+        with recorder.timed("llm"):
+            await asleep(self.latency_ms)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.respond(messages)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self.check_quota()
+        started = time.perf_counter()
+        sleep(self.latency_ms)
+        for token in self.tokens(self.respond(messages)):
+            sleep(self.token_latency_ms)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        recorder.record("llm", time.perf_counter() - started)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self.check_quota()
+        started = time.perf_counter()
+        await asleep(self.latency_ms)
+        for token in self.tokens(self.respond(messages)):
+            await asleep(self.token_latency_ms)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        recorder.record("llm", time.perf_counter() - started)
+
+# embeddings and vector store
+
+class FakeEmbeddings(Embeddings):
+    '''
+    Hashed bag-of-words embeddings: texts sharing words are similar, so retrieval behaves like
+    it does with real embeddings. One call waits latency_ms, whatever the number of texts.
+    '''
+    def __init__(self, dimensions: int = 768, latency_ms: float = 80):
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+        self._token_vectors: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def _token_vector(self, token: str) -> np.ndarray:
+        vector = self._token_vectors.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+            with self._lock:
+                self._token_vectors[token] = vector
+        return vector
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token in tokenize(text):
+            vector += self._token_vector(token)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with recorder.timed("embed"):
+            sleep(self.latency_ms)
+            return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with recorder.timed("embed"):
+            await asleep(self.latency_ms)
+            return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+class FakeVectorStore(NumpyVectorStore):
+    '''NumpyVectorStore that waits latency_ms per search, like a round trip to Azure AI Search.'''
+    def __init__(self, *args, latency_ms: float = 100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency_ms = latency_ms
+
+    def similarity_search_by_vector_with_vectors(self, embedding: List[float], k: int = 4, **kwargs: Any):
+        with recorder.timed("vector_search"):
+            sleep(self.latency_ms)
+            return super().similarity_search_by_vector_with_vectors(embedding, k=k, **kwargs)
+
+corpus_topics = [
+    ("Benefit_Options.pdf", "Northwind Standard plan deductible is $500 per year and covers medical vision and dental services"),
+    ("Benefit_Options.pdf", "Northwind Health Plus plan covers prescription drugs mental health and out of network emergency services"),
+    ("Northwind_Health_Plus_Benefits_Details.pdf", "Specialist visits have a co-pay of $50 and primary care visits a co-pay of $30"),
+    ("Northwind_Standard_Benefits_Details.pdf", "Claims are submitted online within 90 days of the service with the itemized receipt"),
+    ("PerksPlus.pdf", "PerksPlus reimburses gym memberships fitness classes and ski lessons up to $1000 per year"),
+    ("employee_handbook.pdf", "Employees accrue vacation days monthly and can carry over up to five unused days"),
+    ("employee_handbook.pdf", "The workplace safety policy requires reporting incidents to the manager within 24 hours"),
+    ("role_library.pdf", "The product manager role owns the roadmap and works with engineering and design"),
+]
+
+def create_corpus(chunks: int) -> List[tuple]:
+    '''chunks (text, metadata) pairs built from the topics, with some repeated pages.'''
+    corpus = []
+    for i in range(chunks):
+        source, text = corpus_topics[i % len(corpus_topics)]
+        corpus.append((f"{text}. Section {i // len(corpus_topics)} page {i % 7}.", {"source": f"https://bench.blob.core.windows.net/documents/{source}"}))
+    return corpus
+
+questions = [
+    "What is the deductible of the Northwind Standard plan?",
+    "Does Northwind Health Plus cover prescription drugs?",
+    "What is the co-pay for specialist visits?",
+    "How do I submit a claim?",
+    "What does PerksPlus reimburse?",
+    "How many vacation days can I carry over?",
+    "How do I report a workplace safety incident?",
+    "What does a product manager do?",
+]
+
+# blob storage
+
+class FakeAsyncBlobClient:
+    def __init__(self, container: "FakeAsyncContainerClient", name: str):
+        self.container = container
+        self.name = name
+        self.blocks: Dict[str, int] = {}
+
+    async def stage_block(self, block_id: str, data: bytes, length: int = None, **kwargs):
+        with recorder.timed("blob"):
+            await asleep(self.container.latency_ms)
+            self.blocks[block_id] = len(data)
+
+    async def commit_block_list(self, block_list, content_settings=None, **kwargs):
+        with recorder.timed("blob"):
+            await asleep(self.container.latency_ms)
+            self.container.add_blob(self.name, sum(self.blocks.values()), content_settings.content_type if content_settings else None)
+
+class FakeAsyncContainerClient:
+    '''Async container client for listing and uploads, waits latency_ms per page and per call.'''
+    def __init__(self, blobs: int = 50, page_size: int = 5000, latency_ms: float = 30):
+        self.page_size = page_size
+        self.latency_ms = latency_ms
+        self.blobs: Dict[str, SimpleNamespace] = {}
+        for i in range(blobs):
+            self.add_blob(f"document-{i}.pdf", 1024 * (i + 1), "application/pdf")
+
+    def add_blob(self, name: str, size: int, content_type: str):
+        self.blobs[name] = SimpleNamespace(name=name,
+                                           size=size,
+                                           content_settings=SimpleNamespace(content_type=content_type),
+                                           last_modified=datetime.datetime.now(datetime.timezone.utc),
+                                           metadata={})
+
+    async def list_blobs(self, include=None, **kwargs):
+        blobs = list(self.blobs.values())
+        for start in range(0, max(len(blobs), 1), self.page_size):
+            with recorder.timed("blob"):
+                await asleep(self.latency_ms)
+            for blob in blobs[start:start + self.page_size]:
+                yield blob
+
+    def get_blob_client(self, blob: str) -> FakeAsyncBlobClient:
+        return FakeAsyncBlobClient(self, blob)
+
+    async def close(self):
+        pass
+
+# SQL Server
+
+class FakeCursor:
+    consumer_columns = ("client_id", "user_name", "full_name", "email", "disabled")
+
+    def __init__(self, connection: "FakeSqlConnection"):
+        self.connection = connection
+        self.description = None
+        self._rows: List[tuple] = []
+
+    def execute(self, sql: str, params: tuple = ()):
+        with recorder.timed("sql"):
+            sleep(self.connection.latency_ms)
+        if "getAPIConsumerDetails" in sql:
+            user_name = params[0]
+            self.description = [(column,) for column in self.consumer_columns]
+            self._rows = [("bench-client", user_name, "Benchmark User", f"{user_name}@example.com", False)]
+        else:
+            self.description = [("value",)]
+            self._rows = [(1,)]
+        return self
+
+    def executemany(self, sql: str, rows: List[tuple]):
+        with recorder.timed("sql"):
+            sleep(self.connection.latency_ms)
+
+    def fetchall(self) -> List[tuple]:
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+class FakeSqlConnection:
+    '''Stands in for a pyodbc connection: consumer lookups, log inserts and health checks.'''
+    def __init__(self, latency_ms: float = 10):
+        self.latency_ms = latency_ms
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,224 @@
+'''
+Drives the real FastAPI application in process (httpx ASGITransport, no sockets) with the
+external services replaced by the fakes of app.tests.benchmarks.fakes, and measures latency and
+throughput per scenario and concurrency level.
+'''
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+from unittest import mock
+
+from app.tests.benchmarks import fakes
+
+# the endpoint modules read these at import, the values only have to be well formed: every client
+# that would use them over the network is replaced before the first request
+offline_environment = {
+    "AZURE_STORAGE_CONNECTION_STRING": "DefaultEndpointsProtocol=https;AccountName=bench;AccountKey=YmVuY2htYXJrLWFjY291bnQta2V5;EndpointSuffix=core.windows.net",
+    "AZURE_STORAGE_BLOB_CONTAINERS": "documents",
+    "AZURE_STORAGE_ACCOUNT_KEY": "YmVuY2htYXJrLWFjY291bnQta2V5",
+    "GOOGLE_API_KEY": "benchmark",
+}
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    '''Linear interpolation between the closest ranks, as numpy.percentile does by default.'''
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    seconds: float
+    latencies_ms: List[float] = field(repr=False)
+    stages: Dict[str, tuple] = field(repr=False)
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies_ms)
+        completed = len(latencies)
+        mean_ms = statistics.fmean(latencies) if latencies else 0.0
+
+        # stage times are summed over concurrent requests, per request they add up to the time
+        # spent waiting on dependencies; the rest of the latency is the service itself
+        stages = {}
+        for stage, (calls, total_seconds) in sorted(self.stages.items()):
+            stages[stage] = {"calls_per_request": round(calls / completed, 3) if completed else 0.0,
+                             "ms_per_request": round(total_seconds * 1000 / completed, 3) if completed else 0.0}
+        dependencies_ms = sum(stage["ms_per_request"] for stage in stages.values())
+
+        return {"scenario": self.scenario,
+                "concurrency": self.concurrency,
+                "requests": self.requests,
+                "errors": self.errors,
+                "seconds": round(self.seconds, 3),
+                "requests_per_second": round(completed / self.seconds, 2) if self.seconds > 0 else 0.0,
+                "latency_ms": {"mean": round(mean_ms, 3),
+                               "min": round(latencies[0], 3) if latencies else 0.0,
+                               "p50": round(percentile(latencies, 0.50), 3),
+                               "p95": round(percentile(latencies, 0.95), 3),
+                               "p99": round(percentile(latencies, 0.99), 3),
+                               "max": round(latencies[-1], 3) if latencies else 0.0},
+                "stages": stages,
+                # negative when dependencies ran concurrently within a request (e.g. hybrid retrieval)
+                "service_ms_per_request": round(mean_ms - dependencies_ms, 3)}
+
+class BenchmarkEnvironment:
+    '''
+    Imports the application with offline settings and swaps in the fakes: the Gemini model,
+    embeddings (behind the production CachedEmbeddings), the vector store (filled with a corpus of
+    corpus_chunks chunks), the async blob container of /documents and the SQL connection pool.
+    Use as a context manager, everything is restored on exit.
+    '''
+    def __init__(self, latencies: fakes.FakeLatencies = None, corpus_chunks: int = 200, blobs: int = 50):
+        self.latencies = latencies or fakes.FakeLatencies()
+        self.corpus_chunks = corpus_chunks
+        self.blobs = blobs
+        self.app = None
+        self.access_token: str = None
+        self._stack: ExitStack = None
+
+    def __enter__(self) -> "BenchmarkEnvironment":
+        self._stack = ExitStack()
+        self._stack.enter_context(mock.patch.dict(os.environ, {key: value for key, value in offline_environment.items() if key not in os.environ}))
+
+        from app.main import app
+        from app.api.api_v1.endpoints import documents
+        from app.api.auth import auth_jwt
+        from app.core.config import settings
+        from app.core.telemetry import telemetry
+        from app.dbcontext.db_pool import db_pool
+        from app.dbcontext.db_token import token_dbcontext
+        from app.services import langchain_service
+        from app.services.cached_embeddings import CachedEmbeddings
+        from app.services.provider_guard import guard_chat_model, guard_embeddings
+
+        latencies = self.latencies
+        # the fakes sit behind the same rate limits, retries and circuits as Gemini
+        embeddings = CachedEmbeddings(underlying=guard_embeddings(fakes.FakeEmbeddings(latency_ms=latencies.embed_ms)),
+                                      max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+                                      stage=telemetry.stage)
+        vector_store = fakes.FakeVectorStore(embedding_function=embeddings.embed_query, latency_ms=latencies.vector_search_ms)
+        corpus = fakes.create_corpus(self.corpus_chunks)
+        texts = [text for text, _ in corpus]
+        # one batch call, like the ingestion function, instead of one embed_query per chunk
+        vector_store.add_embeddings(zip(texts, embeddings.embed_documents(texts)), metadatas=[metadata for _, metadata in corpus])
+
+        self._stack.enter_context(langchain_service.embeddings_resource.override(embeddings))
+        self._stack.enter_context(langchain_service.vector_store_resource.override(vector_store))
+        self._stack.enter_context(langchain_service.llm_resource.override(guard_chat_model(
+            fakes.FakeChatModel(latency_ms=latencies.llm_ms,
+                                token_latency_ms=latencies.llm_token_ms,
+                                quota=fakes.FakeQuota(latencies.llm_quota_per_second) if latencies.llm_quota_per_second else None))))
+        self._stack.callback(langchain_service.lexical_index.invalidate)
+
+        self._stack.enter_context(mock.patch.object(documents, "async_container_client",
+                                                    fakes.FakeAsyncContainerClient(blobs=self.blobs, latency_ms=latencies.blob_ms)))
+
+        db_pool.close()
+        self._stack.enter_context(mock.patch.object(db_pool, "connect", lambda: fakes.FakeSqlConnection(latency_ms=latencies.sql_ms)))
+        self._stack.callback(db_pool.close)
+        self._stack.callback(token_dbcontext.invalidate_api_consumer)
+
+        self.app = app
+        self.access_token = auth_jwt.create_access_token([{"client_id": "bench-client", "user_name": "bench-user"}])
+        # the vector store was filled after the lexical index may have been built by an earlier run, built
+        # now so the hybrid runs do not measure the vector search alone while it is built in the background
+        langchain_service.lexical_index.build()
+        token_dbcontext.invalidate_api_consumer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self.app = None
+
+async def run_level(send: Callable[[int], Awaitable[None]], requests: int, concurrency: int) -> tuple:
+    '''
+    Closed loop: concurrency workers send the next request as soon as their previous one completed,
+    until requests were sent. Returns (latencies of the successful requests in ms, errors, seconds).
+    '''
+    latencies_ms: List[float] = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal errors, next_request
+        while next_request < requests:
+            index = next_request
+            next_request += 1
+            started = time.perf_counter()
+            try:
+                await send(index)
+            except Exception:
+                errors += 1
+                continue
+            latencies_ms.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies_ms, errors, time.perf_counter() - started
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_metadata(latencies: fakes.FakeLatencies, **options) -> dict:
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "fake_latencies_ms": latencies.to_dict(),
+            **options}
+
+def compare(previous: dict, current: dict) -> List[str]:
+    '''One line per scenario and concurrency level present in both runs, with the relative change.'''
+    def index(run: dict) -> dict:
+        return {(result["scenario"], result["concurrency"]): result for result in run["results"]}
+
+    def change(before: float, after: float) -> str:
+        return f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+
+    lines = [f"{'scenario':<14} {'conc':>4}  {'p50 ms':>18}  {'p95 ms':>18}  {'req/s':>16}"]
+    previous_results = index(previous)
+    for key, after in index(current).items():
+        before = previous_results.get(key)
+        if before is None:
+            continue
+        columns = []
+        for before_value, after_value in ((before["latency_ms"]["p50"], after["latency_ms"]["p50"]),
+                                          (before["latency_ms"]["p95"], after["latency_ms"]["p95"]),
+                                          (before["requests_per_second"], after["requests_per_second"])):
+            columns.append(f"{after_value:>9.1f} {change(before_value, after_value):>8}")
+        lines.append(f"{key[0]:<14} {key[1]:>4}  {columns[0]}  {columns[1]}  {columns[2]}")
+    return lines
+
+def format_results(results: List[dict]) -> List[str]:
+    lines = [f"{'scenario':<14} {'conc':>4} {'req':>5} {'err':>4} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  stages ms/request"]
+    for result in results:
+        stages = " ".join(f"{stage}={values['ms_per_request']:.0f}" for stage, values in result["stages"].items())
+        latency = result["latency_ms"]
+        lines.append(f"{result['scenario']:<14} {result['concurrency']:>4} {result['requests']:>5} {result['errors']:>4} "
+                     f"{result['requests_per_second']:>8.1f} {latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f}  "
+                     f"{stages} service={result['service_ms_per_request']:.0f}")
+    return lines
+
+def save_results(path: str, run: dict):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(run, file, indent=2)
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+
+from app.services.cached_embeddings import DiskEmbeddingStore
+from app.tests.test_resilience import FakeClock
+
+# 4 float32 values, 16 bytes per file
+vector = np.ones(4, dtype=np.float32)
+
+def test_store_is_pruned_to_max_bytes(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), "models/embedding-001", max_bytes=64, prune_ratio=0.5, clock=FakeClock())
+    for i in range(5):
+        store.put("query", f"question {i}", vector)
+
+    # over 64 bytes with the fifth vector, pruned down to 32
+    assert store.pruned == 3
+    assert sum(store.get("query", f"question {i}") is not None for i in range(5)) == 2
+
+def test_least_recently_read_vectors_are_pruned_first(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), "models/embedding-001", max_bytes=48, prune_ratio=1.0, clock=FakeClock())
+    for i in range(3):
+        store.put("query", f"question {i}", vector)
+        path = store._path("query", f"question {i}")
+        os.utime(path, (i, i))
+
+    store.get("query", "question 0")
+    store.put("query", "question 3", vector)
+
+    assert store.get("query", "question 0") is not None
+    assert store.get("query", "question 1") is None
+
+def test_unbounded_store_is_never_scanned(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), "models/embedding-001")
+    for i in range(5):
+        store.put("query", f"question {i}", vector)
+
+    assert store.pruned == 0
+    assert store._size is None
@@ -0,0 +1,20 @@
+from langchain_core.documents import Document
+
+from app.services.context_packing import ContextPacker, split_sentences
+
+def test_split_sentences_keeps_the_separators():
+    assert split_sentences("Plans:\n\n- Standard.\n- Plus.  Both cover it.") == [
+        ("", "Plans:"), ("\n\n", "- Standard."), ("\n", "- Plus."), ("  ", "Both cover it.")]
+
+def test_packed_chunk_keeps_list_and_table_lines():
+    text = "Deductibles:\n\n| Plan | Deductible |\n| Standard | 500 USD. |\n| Plus | 250 USD. |\n\nBoth include vision."
+    packed = ContextPacker(token_budget=1000).pack([Document(page_content=text, metadata={"source": "Benefit_Options.pdf"})])
+
+    assert packed[0].page_content == text
+
+def test_skipped_sentence_leaves_the_stronger_separator():
+    first = Document(page_content="The deductible is 500 USD.", metadata={"source": "a.pdf"})
+    second = Document(page_content="Vision is covered.\n\nThe deductible is 500 USD.\n- Dental.", metadata={"source": "b.pdf"})
+    packed = ContextPacker(token_budget=1000).pack([first, second])
+
+    assert packed[1].page_content == "Vision is covered.\n\n- Dental."
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from app.core.ttl_cache import TTLCache
+from app.schemas.conversations_schema import RequestItem, RequestModel, RequestOverrides, RetrievalMode
+from app.services import conversation_store as conversation_store_module
+from app.services.chat_history import ChatHistoryManager, RollingSummary, history_fingerprint
+from app.services.conversation_store import ConversationNotFoundError, ConversationStore, InMemoryConversationBackend
+
+@pytest.fixture
+def history_manager(monkeypatch):
+    # a manager per test, resolve() and record() go through the module's one
+    manager = ChatHistoryManager(cache=TTLCache(max_entries=100, ttl_seconds=3600))
+    monkeypatch.setattr(conversation_store_module, "chat_history_manager", manager)
+    return manager
+
+@pytest.fixture
+def store(history_manager):
+    return ConversationStore(InMemoryConversationBackend(max_entries=100), max_turns=10)
+
+def chat_request(question, conversation_id=None, history=None):
+    return RequestModel(lastUserQuestion=question,
+                        conversationId=conversation_id,
+                        history=history or [],
+                        overrides=RequestOverrides(semanticRanker=None, retrievalMode=RetrievalMode.Hybrid, semanticCaptions=None,
+                                                   excludeCategory=None, top=3, temperature=None, promptTemplate=None,
+                                                   promptTemplatePrefix=None, promptTemplateSuffix=None,
+                                                   suggestFollowupQuestions=False),
+                        approach=1)
+
+def test_create_resolve_record(store):
+    store.create("conv-1", expires_at=time.time() + 60, owner="alice")
+
+    request, state = store.resolve(chat_request("What is the deductible?", "conv-1"), owner="alice")
+    assert state.conversation_id == "conv-1"
+    assert request.history == []
+
+    store.record(state, "What is the deductible?", "500 USD.", standalone_question="deductible amount", sources=["Benefit_Options.pdf"])
+
+    request, state = store.resolve(chat_request("And the co-pay?", "conv-1"), owner="alice")
+    assert request.history == [RequestItem(user="What is the deductible?", bot="500 USD.")]
+    assert state.turns[0].standalone_question == "deductible amount"
+    assert state.turns[0].sources == ["Benefit_Options.pdf"]
+
+def test_record_appends_to_the_stored_state(store):
+    store.create("conv-1", expires_at=time.time() + 60)
+    _, first = store.resolve(chat_request("q1", "conv-1"))
+    _, second = store.resolve(chat_request("q2", "conv-1"))
+
+    # both resolved before either answer was recorded, neither turn is lost
+    store.record(first, "q1", "a1")
+    store.record(second, "q2", "a2")
+
+    assert [turn.user for turn in store.get("conv-1").turns] == ["q1", "q2"]
+
+def test_record_keeps_the_last_max_turns(store):
+    store.create("conv-1", expires_at=time.time() + 60)
+    _, state = store.resolve(chat_request("q", "conv-1"))
+    for index in range(15):
+        store.record(state, f"q{index}", f"a{index}")
+
+    turns = store.get("conv-1").turns
+    assert len(turns) == 10
+    assert turns[-1].user == "q14"
+
+def test_expired_conversation_is_not_found(store, monkeypatch):
+    store.create("conv-1", expires_at=time.time() + 60)
+    now = time.time()
+    monkeypatch.setattr(conversation_store_module.time, "time", lambda: now + 61)
+
+    assert store.get("conv-1") is None
+    with pytest.raises(ConversationNotFoundError):
+        store.resolve(chat_request("q", "conv-1"))
+
+def test_unknown_conversation_is_not_found(store):
+    with pytest.raises(ConversationNotFoundError):
+        store.resolve(chat_request("q", "missing"))
+
+def test_unknown_conversation_with_client_history_is_answered(store):
+    history = [RequestItem(user="q0", bot="a0")]
+    request, state = store.resolve(chat_request("q1", "missing", history))
+
+    assert state is None
+    assert request.history == history
+
+def test_someone_elses_conversation_is_not_found(store):
+    store.create("conv-1", expires_at=time.time() + 60, owner="alice")
+    _, state = store.resolve(chat_request("q", "conv-1"), owner="alice")
+    store.record(state, "q", "a")
+
+    for owner in ("mallory", None):
+        with pytest.raises(ConversationNotFoundError):
+            store.resolve(chat_request("q", "conv-1"), owner=owner)
+
+def test_client_history_takes_precedence(store):
+    store.create("conv-1", expires_at=time.time() + 60)
+    _, state = store.resolve(chat_request("q", "conv-1"))
+    store.record(state, "stored question", "stored answer")
+
+    history = [RequestItem(user="client question", bot="client answer")]
+    request, state = store.resolve(chat_request("q", "conv-1", history))
+
+    assert request.history == history
+    assert state.conversation_id == "conv-1"
+
+def test_summary_round_trip(store, history_manager):
+    store.create("conv-1", expires_at=time.time() + 60)
+    _, state = store.resolve(chat_request("q", "conv-1"))
+    turns = [RequestItem(user=f"q{index}", bot=f"a{index}") for index in range(4)]
+    for turn in turns:
+        store.record(state, turn.user, turn.bot)
+
+    # the summary folded by the manager is stored with the next turn
+    summary = RollingSummary(summary="The user asked about q0 and q1.", turns=2, fingerprint=history_fingerprint(turns[:2]))
+    history_manager.remember("conv-1", summary)
+    store.record(state, "q4", "a4")
+    assert store.get("conv-1").summary == summary
+
+    # another worker, or this one once its cache expired, gets it back on resolve
+    history_manager.cache.clear()
+    store.resolve(chat_request("q5", "conv-1"))
+    assert history_manager.recall("conv-1") == summary
+
+def test_resolve_maps_not_found_to_404(monkeypatch):
+    os.environ.setdefault("AZURE_STORAGE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+    os.environ.setdefault("AZURE_STORAGE_BLOB_CONTAINERS", "documents")
+    from fastapi import HTTPException
+    from app.api.api_v1.endpoints import conversations
+
+    store = ConversationStore(InMemoryConversationBackend(max_entries=10))
+    monkeypatch.setattr(conversation_store_module, "conversation_store", store)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(conversations.resolve_chat_request(chat_request("q", "missing"), owner=None))
+    assert error.value.status_code == 404
+
+def test_claims_are_per_request():
+    os.environ.setdefault("AZURE_STORAGE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+    from app.api.auth import auth_jwt
+
+    alice = auth_jwt.create_access_token([{"client_id": "client", "user_name": "alice"}])
+    bob = auth_jwt.create_access_token([{"client_id": "client", "user_name": "bob"}])
+
+    async def both():
+        return await asyncio.gather(auth_jwt.get_current_claims(alice), auth_jwt.get_current_claims(bob))
+
+    # the owner of a conversation is read from them, another request must not overwrite it
+    alice_claims, bob_claims = asyncio.run(both())
+    assert (alice_claims.sub, bob_claims.sub) == ("alice", "bob")
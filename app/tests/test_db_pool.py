@@ -0,0 +1,174 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app.core.ttl_cache import TTLCache
+from app.dbcontext import db_token
+from app.dbcontext.db_pool import ConnectionPool, PoolTimeoutError
+from app.dbcontext.db_token import token_dbcontext
+
+# stands in for getAPIConsumerDetails
+CONSUMER_QUERY = "SELECT client_id, user_name, full_name, email, disabled FROM api_consumers WHERE user_name = ?"
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "consumers.db")
+    with sqlite3.connect(path) as cnxn:
+        cnxn.execute("CREATE TABLE api_consumers (client_id TEXT, user_name TEXT, full_name TEXT, email TEXT, disabled INTEGER)")
+        cnxn.execute("INSERT INTO api_consumers VALUES ('client-1', 'alice', 'Alice Example', 'alice@example.com', 0)")
+    return path
+
+@pytest.fixture
+def statements():
+    return []
+
+@pytest.fixture
+def pool(database, statements):
+    def connect():
+        cnxn = sqlite3.connect(database, check_same_thread=False)
+        cnxn.set_trace_callback(statements.append)
+        return cnxn
+
+    pool = ConnectionPool(connect, max_size=2, acquire_timeout_seconds=0.1)
+    yield pool
+    pool.close()
+
+def consumer_queries(statements) -> int:
+    return sum("api_consumers" in statement for statement in statements)
+
+def test_connection_is_returned_and_reused(pool):
+    with pool.connection() as first:
+        assert pool.stats()["in_use"] == 1
+    with pool.connection() as second:
+        assert second is first
+
+    stats = pool.stats()
+    assert stats["created"] == 1
+    assert stats["acquisitions"] == 2
+    assert stats["idle"] == 1
+
+def test_connection_is_discarded_after_a_failure(pool):
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.connection() as cnxn:
+            cnxn.execute("SELECT * FROM missing_table")
+
+    stats = pool.stats()
+    assert stats["closed"] == 1
+    assert stats["size"] == 0
+
+def test_open_transaction_is_rolled_back_on_release(pool, database):
+    pooled = pool.acquire()
+    # e.g. the caller failed between its writes and the commit
+    pooled.connection.execute("INSERT INTO api_consumers VALUES ('client-2', 'mallory', 'Mallory', 'mallory@example.com', 0)")
+    pool.release(pooled)
+
+    assert not pooled.connection.in_transaction
+    with sqlite3.connect(database) as cnxn:
+        assert cnxn.execute("SELECT COUNT(*) FROM api_consumers").fetchone()[0] == 1
+
+def test_connection_is_closed_when_the_rollback_fails(pool):
+    pooled = pool.acquire()
+    pooled.connection.close()
+    pool.release(pooled)
+
+    stats = pool.stats()
+    assert stats["closed"] == 1
+    assert stats["idle"] == 0
+
+def test_unhealthy_idle_connection_is_replaced(pool):
+    pool.health_check_idle_seconds = 0
+    with pool.connection() as first:
+        pass
+    # e.g. dropped by the server while idle
+    first.close()
+
+    with pool.connection() as second:
+        assert second is not first
+        second.execute("SELECT 1")
+    assert pool.stats()["health_check_failures"] == 1
+
+def test_healthy_idle_connection_is_checked_before_reuse(pool, statements):
+    pool.health_check_idle_seconds = 0
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert "SELECT 1" in statements
+
+def test_connection_past_max_lifetime_is_closed(pool):
+    pool.max_lifetime_seconds = 0.01
+    with pool.connection() as first:
+        time.sleep(0.02)
+    # closed on release instead of going back to the pool
+    assert pool.stats()["idle"] == 0
+
+    with pool.connection() as second:
+        assert second is not first
+    assert pool.stats()["created"] == 2
+
+def test_exhausted_pool_times_out(pool):
+    with pool.connection(), pool.connection():
+        with pytest.raises(PoolTimeoutError):
+            with pool.connection():
+                pass
+    assert pool.stats()["timeouts"] == 1
+
+def test_waiter_gets_the_released_connection(pool):
+    held = [pool.acquire(), pool.acquire()]
+    pool.acquire_timeout_seconds = 5
+    threading.Timer(0.05, pool.release, args=(held[0],)).start()
+
+    with pool.connection() as cnxn:
+        assert cnxn is held[0].connection
+    pool.release(held[1])
+    assert pool.stats()["waits"] == 1
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def context(pool, clock):
+    return token_dbcontext(pool=pool, cache=TTLCache(max_entries=10, ttl_seconds=60, clock=clock), sp_name=CONSUMER_QUERY)
+
+def test_consumer_details_are_cached_for_the_ttl(context, clock, statements):
+    details = context.get_api_consumer_details("alice")
+    assert details == [{"client_id": "client-1", "user_name": "alice", "full_name": "Alice Example", "email": "alice@example.com", "disabled": 0}]
+
+    # callers get copies, the cached rows cannot be changed through them
+    details[0]["disabled"] = 1
+    assert context.get_api_consumer_details("alice")[0]["disabled"] == 0
+    assert consumer_queries(statements) == 1
+
+    clock.advance(61)
+    context.get_api_consumer_details("alice")
+    assert consumer_queries(statements) == 2
+
+def test_unknown_consumers_are_cached_for_the_negative_ttl(context, clock, statements, monkeypatch):
+    monkeypatch.setattr(db_token.settings, "CONSUMER_CACHE_NEGATIVE_TTL_SECONDS", 5)
+
+    assert context.get_api_consumer_details("mallory") is None
+    assert context.get_api_consumer_details("mallory") is None
+    assert consumer_queries(statements) == 1
+
+    clock.advance(6)
+    assert context.get_api_consumer_details("mallory") is None
+    assert consumer_queries(statements) == 2
+
+def test_consumer_details_without_cache(pool, statements):
+    context = token_dbcontext(pool=pool, cache=None, sp_name=CONSUMER_QUERY)
+    context.get_api_consumer_details("alice")
+    context.get_api_consumer_details("alice")
+    assert consumer_queries(statements) == 2
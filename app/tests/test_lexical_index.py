@@ -0,0 +1,89 @@
+import threading
+import time
+
+from langchain_core.documents import Document
+
+from app.schemas.conversations_schema import RetrievalMode
+from app.services.lexical_index import LexicalIndexProvider
+from app.services.retrieval_context import RetrievalContext
+from app.tests.benchmarks import fakes
+
+documents = [Document(page_content=text, metadata=metadata) for text, metadata in fakes.create_corpus(16)]
+
+class FakeCorpus:
+    '''Corpus loader counting its reads, held back until release() when blocked.'''
+    def __init__(self, revision=1, blocked=False):
+        self.revision = revision
+        self.reads = 0
+        self._released = threading.Event()
+        if not blocked:
+            self._released.set()
+
+    def release(self):
+        self._released.set()
+
+    def load(self):
+        self._released.wait(timeout=5)
+        self.reads += 1
+        return self.revision, documents
+
+def wait_ready(provider: LexicalIndexProvider):
+    deadline = time.monotonic() + 5
+    while not provider.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert provider.ready
+
+def test_searches_do_not_wait_for_the_first_build():
+    corpus = FakeCorpus(blocked=True)
+    provider = LexicalIndexProvider(corpus_loader=corpus.load)
+    provider.start()
+
+    assert provider.get_index() is None
+    assert provider.search("deductible", k=3) == []
+
+    corpus.release()
+    wait_ready(provider)
+    assert "deductible" in provider.search("deductible", k=3)[0][0].page_content
+    assert corpus.reads == 1
+
+def test_unchanged_revision_skips_reading_the_corpus():
+    corpus = FakeCorpus(revision=1)
+    provider = LexicalIndexProvider(corpus_loader=corpus.load, revision_loader=lambda: corpus.revision)
+    provider.build()
+    index = provider.get_index()
+
+    provider._refresh()
+    assert corpus.reads == 1
+    assert provider.get_index() is index
+
+    corpus.revision = 2
+    provider._refresh()
+    assert corpus.reads == 2
+    assert provider.get_index() is not index
+
+def test_failed_build_is_retried_after_retry_seconds():
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise ConnectionError("search service unavailable")
+
+    provider = LexicalIndexProvider(corpus_loader=failing, retry_seconds=3600)
+    provider._refresh()
+    assert provider.get_index() is None
+    # within retry_seconds the failure is not retried on every search
+    assert len(calls) == 1
+
+def test_retrieval_falls_back_to_the_vector_search_until_the_index_is_built():
+    embeddings = fakes.FakeEmbeddings(dimensions=64, latency_ms=0)
+    vector_store = fakes.FakeVectorStore(embedding_function=embeddings.embed_query, latency_ms=0)
+    vector_store.add_texts([doc.page_content for doc in documents], metadatas=[doc.metadata for doc in documents])
+
+    corpus = FakeCorpus(blocked=True)
+    provider = LexicalIndexProvider(corpus_loader=corpus.load)
+
+    for mode in (RetrievalMode.Hybrid, RetrievalMode.Text):
+        context = RetrievalContext(vector_store=vector_store, search_kwargs={"k": 3}, embedding_function=embeddings.embed_query,
+                                   retrieval_mode=mode, lexical_index=provider)
+        assert len(context.retrieve("What is the deductible?")) == 3
+    corpus.release()
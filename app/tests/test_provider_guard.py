@@ -0,0 +1,116 @@
+import asyncio
+import os
+from typing import Any, List
+
+import pytest
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from app.core.resilience import CircuitBreaker, ProviderUnavailableError
+from app.schemas.conversations_schema import RetrievalMode
+from app.services.provider_guard import GuardedChatModel
+from app.tests.test_resilience import FakeClock, FakeProviderError, guard
+
+class FakeStreamingChatModel(BaseChatModel):
+    '''Streams "partial" then fails with the next scripted error, or streams "answer" once they are used up.'''
+    errors: List[Any] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="answer"))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.errors:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="partial"))
+            raise self.errors.pop(0)
+        yield ChatGenerationChunk(message=AIMessageChunk(content="answer"))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            yield chunk
+
+messages = [HumanMessage(content="What is the deductible?")]
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+def half_open_model(clock, *errors):
+    provider_guard = guard(clock, failure_threshold=1)
+    provider_guard.breaker.record_failure()
+    clock.advance(30)
+    return GuardedChatModel(underlying=FakeStreamingChatModel(errors=list(errors)), guard=provider_guard)
+
+def stream(model) -> List[str]:
+    return [chunk.text for chunk in model._stream(messages)]
+
+async def astream(model) -> List[str]:
+    return [chunk.text async for chunk in model._astream(messages)]
+
+def test_stream_failure_after_first_chunk_reopens_the_circuit(clock):
+    model = half_open_model(clock, FakeProviderError(503))
+
+    # the probe streamed a chunk then failed, not retried
+    with pytest.raises(FakeProviderError):
+        stream(model)
+    assert model.guard.breaker.state == CircuitBreaker.OPEN
+
+    clock.advance(30)
+    assert stream(model) == ["answer"]
+    assert model.guard.breaker.state == CircuitBreaker.CLOSED
+
+def test_async_stream_failure_after_first_chunk_reopens_the_circuit(clock):
+    model = half_open_model(clock, FakeProviderError(500))
+
+    with pytest.raises(FakeProviderError):
+        asyncio.run(astream(model))
+    assert model.guard.breaker.state == CircuitBreaker.OPEN
+
+def test_stream_client_error_after_first_chunk_releases_the_probe(clock):
+    model = half_open_model(clock, FakeProviderError(400))
+
+    with pytest.raises(FakeProviderError):
+        stream(model)
+    # says nothing about the provider, the next call probes again instead of failing fast forever
+    assert model.guard.breaker.state == CircuitBreaker.HALF_OPEN
+    assert stream(model) == ["answer"]
+    assert model.guard.breaker.state == CircuitBreaker.CLOSED
+
+def test_mid_stream_server_errors_open_the_circuit(clock):
+    provider_guard = guard(clock, failure_threshold=2)
+    model = GuardedChatModel(underlying=FakeStreamingChatModel(errors=[FakeProviderError(503), FakeProviderError(503)]), guard=provider_guard)
+
+    for _ in range(2):
+        with pytest.raises(FakeProviderError):
+            stream(model)
+    assert provider_guard.breaker.state == CircuitBreaker.OPEN
+
+class UnavailableEmbeddings(Embeddings):
+    '''Embeddings behind an open circuit.'''
+    def embed_documents(self, texts):
+        raise ProviderUnavailableError("gemini-embeddings circuit is open", retry_after_seconds=30)
+
+    def embed_query(self, text):
+        raise ProviderUnavailableError("gemini-embeddings circuit is open", retry_after_seconds=30)
+
+def test_embedding_outage_returns_the_degraded_answer():
+    os.environ.setdefault("AZURE_STORAGE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+    from app.services import langchain_service
+    from app.tests.benchmarks import fakes
+    from app.tests.test_conversation_store import chat_request
+
+    embeddings = UnavailableEmbeddings()
+    vector_store = fakes.FakeVectorStore(embedding_function=embeddings.embed_query, latency_ms=0)
+    with langchain_service.embeddings_resource.override(embeddings), langchain_service.vector_store_resource.override(vector_store):
+        request = chat_request("What is the deductible?")
+        # vector retrieval, the question has to be embedded
+        request.overrides.retrievalMode = RetrievalMode.Vector
+        response = asyncio.run(langchain_service.LangchainService().aget_chat_response_with_history(request))
+
+    assert response["answer"]["degraded"]
+    assert response["context"] == []
@@ -0,0 +1,228 @@
+import asyncio
+
+import pytest
+
+from app.core.resilience import (AdaptiveConcurrencyLimit, CircuitBreaker, ProviderGuard, ProviderUnavailableError, RetryBudget,
+                                 SERVER_ERROR, THROTTLED, TokenBucket, classify_error)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+class FakeProviderError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+class FakeProvider:
+    '''Fails with the scripted errors in turn, then answers "ok".'''
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+    async def acall(self) -> str:
+        return self()
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+def guard(clock, max_retries=2, retry_budget=None, failure_threshold=5):
+    # no backoff, the tests do not sleep
+    return ProviderGuard("gemini-test",
+                         concurrency=AdaptiveConcurrencyLimit(initial=8, clock=clock),
+                         retry_budget=retry_budget or RetryBudget(clock=clock),
+                         breaker=CircuitBreaker("gemini-test", failure_threshold=failure_threshold, reset_seconds=30, clock=clock),
+                         max_retries=max_retries,
+                         backoff_base_seconds=0,
+                         backoff_max_seconds=0)
+
+def test_classify_error():
+    assert classify_error(FakeProviderError(429)) == THROTTLED
+    assert classify_error(FakeProviderError(503)) == SERVER_ERROR
+    assert classify_error(TimeoutError()) == SERVER_ERROR
+    assert classify_error(FakeProviderError(400)) is None
+    assert classify_error(ValueError()) is None
+
+def test_token_bucket_reserve_and_refill(clock):
+    bucket = TokenBucket(rate_per_minute=60, capacity=2, clock=clock)
+
+    assert bucket.reserve(1, max_wait_seconds=0) == 0
+    assert bucket.reserve(1, max_wait_seconds=0) == 0
+    # empty, the next unit comes in a second at 1 per second
+    assert bucket.reserve(1, max_wait_seconds=5) == pytest.approx(1.0)
+    assert bucket.available() == pytest.approx(-1.0)
+
+    clock.advance(3)
+    assert bucket.available() == pytest.approx(2.0)
+
+def test_token_bucket_refuses_long_waits_without_taking(clock):
+    bucket = TokenBucket(rate_per_minute=60, capacity=1, clock=clock)
+    bucket.charge(5)
+
+    assert bucket.reserve(1, max_wait_seconds=2) is None
+    assert bucket.available() == pytest.approx(-4.0)
+
+    clock.advance(5)
+    assert bucket.reserve(1, max_wait_seconds=0) == 0
+
+def test_token_bucket_default_capacity():
+    assert TokenBucket(rate_per_minute=600).capacity == 60
+    assert TokenBucket(rate_per_minute=5).capacity == 1
+
+def test_adaptive_concurrency_limit(clock):
+    limit = AdaptiveConcurrencyLimit(initial=4, minimum=1, maximum=5, cooldown_seconds=1, clock=clock)
+    assert all(limit.try_acquire() for _ in range(4))
+    assert not limit.try_acquire()
+
+    limit.on_overload()
+    assert int(limit.limit) == 2
+    # calls failing together decrease it once
+    limit.on_overload()
+    assert int(limit.limit) == 2
+
+    clock.advance(1)
+    limit.on_overload()
+    limit.release()
+    limit.release()
+    limit.release()
+    assert int(limit.limit) == 1
+    assert not limit.try_acquire()
+
+    limit.release()
+    for _ in range(20):
+        limit.on_success()
+    assert limit.limit == 5
+
+def test_retry_budget(clock):
+    budget = RetryBudget(ratio=0.5, min_retries=1, window_seconds=10, clock=clock)
+    assert budget.try_withdraw()
+    assert not budget.try_withdraw()
+    assert budget.exhausted == 1
+
+    budget.record_call()
+    budget.record_call()
+    assert budget.try_withdraw()
+    assert not budget.try_withdraw()
+
+    # the retries of the window are forgotten with it
+    clock.advance(10)
+    assert budget.try_withdraw()
+
+def test_circuit_breaker_cycle(clock):
+    breaker = CircuitBreaker("gemini-test", failure_threshold=2, reset_seconds=30, clock=clock)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(ProviderUnavailableError) as error:
+        breaker.before_call()
+    assert error.value.retry_after_seconds == 30
+
+    # one probe once reset_seconds elapsed, its failure opens the circuit again
+    clock.advance(30)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(ProviderUnavailableError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # its success closes it
+    clock.advance(30)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+def test_circuit_breaker_ignored_probe_lets_another_through(clock):
+    breaker = CircuitBreaker("gemini-test", failure_threshold=1, reset_seconds=30, clock=clock)
+    breaker.record_failure()
+    clock.advance(30)
+
+    breaker.before_call()
+    breaker.record_ignored()
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+def test_guard_retries_throttled_then_server_error(clock):
+    provider = FakeProvider(FakeProviderError(429), FakeProviderError(500))
+    provider_guard = guard(clock)
+
+    assert provider_guard.call(provider) == "ok"
+    assert provider.calls == 3
+    assert provider_guard.retries == 2
+    assert provider_guard.breaker.failures == 0
+    assert provider_guard.concurrency.limit < 8
+
+def test_guard_async_retries(clock):
+    provider = FakeProvider(FakeProviderError(429), FakeProviderError(503))
+    provider_guard = guard(clock)
+
+    assert asyncio.run(provider_guard.acall(provider.acall)) == "ok"
+    assert provider.calls == 3
+
+def test_guard_gives_up_after_max_retries(clock):
+    provider = FakeProvider(*(FakeProviderError(503) for _ in range(5)))
+    provider_guard = guard(clock, max_retries=2)
+
+    with pytest.raises(FakeProviderError):
+        provider_guard.call(provider)
+    assert provider.calls == 3
+
+def test_guard_gives_up_when_the_retry_budget_is_exhausted(clock):
+    budget = RetryBudget(ratio=0, min_retries=1, clock=clock)
+    provider = FakeProvider(*(FakeProviderError(429) for _ in range(5)))
+    provider_guard = guard(clock, max_retries=5, retry_budget=budget)
+
+    with pytest.raises(FakeProviderError):
+        provider_guard.call(provider)
+    assert provider.calls == 2
+    assert budget.exhausted == 1
+
+def test_guard_does_not_retry_client_errors(clock):
+    provider = FakeProvider(FakeProviderError(400))
+    provider_guard = guard(clock)
+
+    with pytest.raises(FakeProviderError):
+        provider_guard.call(provider)
+    assert provider.calls == 1
+    assert provider_guard.breaker.failures == 0
+
+def test_guard_circuit_open_half_open_closed(clock):
+    provider = FakeProvider(FakeProviderError(503), FakeProviderError(503), FakeProviderError(503))
+    provider_guard = guard(clock, max_retries=0, failure_threshold=2)
+
+    for _ in range(2):
+        with pytest.raises(FakeProviderError):
+            provider_guard.call(provider)
+    assert provider_guard.breaker.state == CircuitBreaker.OPEN
+
+    # fails fast without calling the provider
+    with pytest.raises(ProviderUnavailableError):
+        provider_guard.call(provider)
+    assert provider.calls == 2
+
+    # the failed probe opens it again, the next one closes it
+    clock.advance(30)
+    with pytest.raises(FakeProviderError):
+        provider_guard.call(provider)
+    assert provider_guard.breaker.state == CircuitBreaker.OPEN
+
+    clock.advance(30)
+    assert provider_guard.call(provider) == "ok"
+    assert provider_guard.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,53 @@
+from langchain_core.documents import Document
+
+from app.services.semantic_cache import InMemorySemanticCacheBackend, SemanticAnswerCache
+
+answer = {"answer": {"answer": "500 USD."}, "context": [Document(page_content="The deductible is 500 USD.", metadata={"source": "Benefit_Options.pdf"})]}
+
+class FakeRevision:
+    def __init__(self):
+        self.revision = 1
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.revision
+
+def semantic_cache(revision_loader=None, revision_check_seconds=0) -> SemanticAnswerCache:
+    return SemanticAnswerCache(InMemorySemanticCacheBackend(max_entries=10), similarity_threshold=0.95, ttl_seconds=60,
+                               revision_loader=revision_loader, revision_check_seconds=revision_check_seconds)
+
+def test_hit_within_the_same_variant_only():
+    cache = semantic_cache()
+    cache.update([1.0, 0.0], "deductible?", answer, variant=("Hybrid", 3, False))
+
+    assert cache.lookup([1.0, 0.01], variant=("Hybrid", 3, False))["answer"] == answer["answer"]
+    assert cache.lookup([1.0, 0.01], variant=("Hybrid", 5, False)) is None
+    assert cache.lookup([1.0, 0.01], variant=("Vector", 3, True)) is None
+    assert cache.stats()["hits"] == 1
+
+def test_changed_index_revision_is_a_miss():
+    revision = FakeRevision()
+    cache = semantic_cache(revision)
+    cache.update([1.0, 0.0], "deductible?", answer)
+    assert cache.lookup([1.0, 0.0]) is not None
+
+    # e.g. a new snapshot loaded or documents re-ingested
+    revision.revision = 2
+    assert cache.lookup([1.0, 0.0]) is None
+
+def test_revision_is_checked_every_revision_check_seconds():
+    revision = FakeRevision()
+    cache = semantic_cache(revision, revision_check_seconds=3600)
+    cache.update([1.0, 0.0], "deductible?", answer)
+    for _ in range(5):
+        cache.lookup([1.0, 0.0])
+
+    assert revision.reads == 1
+
+def test_invalidate_drops_every_answer():
+    cache = semantic_cache()
+    cache.update([1.0, 0.0], "deductible?", answer)
+    cache.invalidate()
+
+    assert cache.lookup([1.0, 0.0]) is None
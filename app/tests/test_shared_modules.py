@@ -0,0 +1,17 @@
+import filecmp
+import os
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# function app copy -> app module it is vendored from, see README
+shared_modules = {
+    "functions/vector_index.py": "app/services/vector_index.py",
+    "functions/cached_embeddings.py": "app/services/cached_embeddings.py",
+    "functions/lazy.py": "app/core/lazy.py",
+}
+
+@pytest.mark.parametrize("copy, source", shared_modules.items())
+def test_function_copy_matches_the_app_module(copy, source):
+    assert filecmp.cmp(os.path.join(root, copy), os.path.join(root, source), shallow=False), f"copy {source} over {copy}"
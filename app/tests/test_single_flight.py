@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from app.core.single_flight import SingleFlight
+from app.tests.test_resilience import FakeClock
+
+class SlowCall:
+    '''Answers "ok", or fails with error, once released.'''
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.calls = 0
+        self.released = asyncio.Event()
+
+    async def __call__(self) -> str:
+        self.calls += 1
+        await self.released.wait()
+        if self.error is not None:
+            raise self.error
+        return "ok"
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight()
+        call = SlowCall()
+        callers = [asyncio.ensure_future(flight.ado("key", call)) for _ in range(5)]
+        await asyncio.sleep(0)
+        call.released.set()
+
+        assert await asyncio.gather(*callers) == ["ok"] * 5
+        assert call.calls == 1
+        assert flight.stats() == {"executions": 1, "shared": 4, "in_flight": 0, "recent": 0}
+
+    asyncio.run(scenario())
+
+def test_failure_is_shared_but_not_reused():
+    async def scenario():
+        flight = SingleFlight(window_seconds=60)
+        call = SlowCall(error=ConnectionError("provider down"))
+        callers = [asyncio.ensure_future(flight.ado("key", call)) for _ in range(2)]
+        await asyncio.sleep(0)
+        call.released.set()
+
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, ConnectionError) for result in results)
+
+        call.error = None
+        assert await flight.ado("key", call) == "ok"
+        assert call.calls == 2
+
+    asyncio.run(scenario())
+
+def test_result_is_reused_within_the_window():
+    async def scenario():
+        clock = FakeClock()
+        flight = SingleFlight(window_seconds=5, clock=clock)
+        call = SlowCall()
+        call.released.set()
+
+        assert await flight.ado("key", call) == "ok"
+        clock.advance(4)
+        assert await flight.ado("key", call) == "ok"
+        assert call.calls == 1
+
+        clock.advance(2)
+        assert await flight.ado("key", call) == "ok"
+        assert call.calls == 2
+
+    asyncio.run(scenario())
+
+def test_execution_is_cancelled_once_every_caller_is():
+    async def scenario():
+        flight = SingleFlight()
+        call = SlowCall()
+        first = asyncio.ensure_future(flight.ado("key", call))
+        second = asyncio.ensure_future(flight.ado("key", call))
+        await asyncio.sleep(0)
+
+        # the other caller still waits, the execution goes on
+        first.cancel()
+        await asyncio.sleep(0)
+        assert flight.stats()["in_flight"] == 1
+
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        await asyncio.sleep(0)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,231 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Callable, ContextManager, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+class DiskEmbeddingStore:
+    '''
+    On-disk embedding store shared by every worker process. Each vector is one file
+    <directory>/<model>/<kind>/<hash[:2]>/<hash>.f32 holding the raw little-endian float32 values,
+    where hash is the sha256 of the text. Files are written to a temporary name and renamed into
+    place, so concurrent readers never see a partial vector.
+
+    With max_bytes the store of the model is kept below that size: a read touches the file's mtime
+    and once the bytes written since the last scan could exceed it, or scan_interval_seconds after
+    it (the other processes write too), the least recently used vectors are removed down to
+    prune_ratio of max_bytes.
+    '''
+    def __init__(self, directory: str, model: str, max_bytes: int = None, prune_ratio: float = 0.9,
+                 scan_interval_seconds: float = 300, clock: Callable[[], float] = time.monotonic):
+        self.directory = os.path.join(directory, model.replace("/", "_"))
+        self.max_bytes = max_bytes
+        self.prune_ratio = prune_ratio
+        self.scan_interval_seconds = scan_interval_seconds
+        self.clock = clock
+        self.pruned = 0
+        self._lock = threading.Lock()
+        # size of the store as of the last scan plus the bytes written since, None until scanned
+        self._size: Optional[int] = None
+        self._scanned_at = 0.0
+
+    def _path(self, kind: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, kind, digest[:2], digest + ".f32")
+
+    def get(self, kind: str, text: str) -> Optional[np.ndarray]:
+        path = self._path(kind, text)
+        try:
+            vector = np.fromfile(path, dtype="<f4")
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if self.max_bytes is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                # pruned meanwhile
+                pass
+        return vector
+
+    def put(self, kind: str, text: str, vector: np.ndarray):
+        path = self._path(kind, text)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = np.asarray(vector, dtype="<f4").tobytes()
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self.max_bytes is not None:
+            self._written(len(data))
+
+    def _written(self, size: int):
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            due = self._size is None or self._size > self.max_bytes or self.clock() - self._scanned_at >= self.scan_interval_seconds
+            if not due:
+                return
+            # not due for the other writers until prune() sets the scanned size
+            self._size = 0
+            self._scanned_at = self.clock()
+
+        self.prune()
+
+    def _files(self) -> List[Tuple[float, int, str]]:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".f32"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def prune(self) -> int:
+        '''Removes the least recently used vectors while the store exceeds max_bytes. Returns the size left.'''
+        files = self._files()
+        size = sum(file_size for _, file_size, _ in files)
+        if self.max_bytes is not None and size > self.max_bytes:
+            target = self.max_bytes * self.prune_ratio
+            for _, file_size, path in sorted(files):
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self.pruned += 1
+                except FileNotFoundError:
+                    # removed by another process
+                    pass
+                size -= file_size
+
+        with self._lock:
+            self._size = size
+            self._scanned_at = self.clock()
+        return size
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Embeddings wrapper with a bounded in-memory LRU in front of an optional DiskEmbeddingStore.
+    Query and document embeddings are cached separately (the model embeds them with different
+    task types). Batch calls only send the texts that are not cached to the underlying model.
+    The calls to the model run in stage("embed"), e.g. telemetry.stage to time them.
+    '''
+    QUERY = "query"
+    DOCUMENT = "document"
+
+    def __init__(self, underlying: Embeddings, max_entries: int = 4096, disk_store: DiskEmbeddingStore = None,
+                 stage: Callable[[str], ContextManager] = lambda name: nullcontext()):
+        self.underlying = underlying
+        self.max_entries = max_entries
+        self.disk_store = disk_store
+        self.stage = stage
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+
+    def _lookup(self, kind: str, text: str) -> Optional[np.ndarray]:
+        key = (kind, text)
+
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return vector
+
+        if self.disk_store is not None:
+            vector = self.disk_store.get(kind, text)
+            if vector is not None:
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+
+        return None
+
+    def _remember(self, key: tuple, vector: np.ndarray):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _store(self, kind: str, text: str, embedding: List[float]):
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._remember((kind, text), vector)
+        if self.disk_store is not None:
+            self.disk_store.put(kind, text, vector)
+
+    def _split_misses(self, texts: List[str]):
+        vectors = [self._lookup(self.DOCUMENT, text) for text in texts]
+        # deduplicate so a text repeated in the batch is embedded once
+        misses = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        self.misses += len(misses)
+        return vectors, misses
+
+    def _merge(self, texts: List[str], vectors: list, misses: List[str], embedded: List[List[float]]) -> List[List[float]]:
+        for text, embedding in zip(misses, embedded):
+            self._store(self.DOCUMENT, text, embedding)
+
+        embedded_by_text = dict(zip(misses, embedded))
+        return [vector.tolist() if vector is not None else list(embedded_by_text[text]) for text, vector in zip(texts, vectors)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors, misses = self._split_misses(texts)
+        embedded = []
+        if misses:
+            with self.stage("embed"):
+                embedded = self.underlying.embed_documents(misses)
+        return self._merge(texts, vectors, misses, embedded)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors, misses = self._split_misses(texts)
+        embedded = []
+        if misses:
+            with self.stage("embed"):
+                embedded = await self.underlying.aembed_documents(misses)
+        return self._merge(texts, vectors, misses, embedded)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._lookup(self.QUERY, text)
+        if vector is not None:
+            return vector.tolist()
+
+        self.misses += 1
+        with self.stage("embed"):
+            embedding = self.underlying.embed_query(text)
+        self._store(self.QUERY, text, embedding)
+        return list(embedding)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = self._lookup(self.QUERY, text)
+        if vector is not None:
+            return vector.tolist()
+
+        self.misses += 1
+        with self.stage("embed"):
+            embedding = await self.underlying.aembed_query(text)
+        self._store(self.QUERY, text, embedding)
+        return list(embedding)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "size": len(self._memory)}
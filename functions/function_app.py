@@ -3,80 +3,121 @@ import logging
 import os
 import getpass
 
-from langchain_community.document_loaders import AzureBlobStorageContainerLoader
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores.redis import Redis
-
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_community.document_loaders import PyPDFLoader
-
-from azure.search.documents.indexes.models import (
-    ScoringProfile,
-    SearchableField,
-    SearchField,
-    SearchFieldDataType,
-    SimpleField,
-    TextWeights,
-)
+from cached_embeddings import CachedEmbeddings, DiskEmbeddingStore
+from ingestion_pipeline import IndexVersion, IngestionConfig, IngestionPipeline
+from ingestion_manifest import IncrementalIngestion, IngestionManifestStore
+from lazy import LazyResource
+from vector_index import NumpyVectorStore
+
+from azure.storage.blob import BlobServiceClient
 
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
-if "GOOGLE_API_KEY" not in os.environ:
-    os.environ["GOOGLE_API_KEY"] = getpass("Provide your Google API key here")
-
-vector_store_address: str = os.environ["AZURE_SEARCH_ENDPOINT"]
-vector_store_password: str = os.environ["AZURE_SEARCH_ADMIN_KEY"]
-
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-embedding_function = embeddings.embed_query
-
-fields = [
-    SimpleField(
-        name="id",
-        type=SearchFieldDataType.String,
-        key=True,
-        filterable=True,
-    ),
-    SearchableField(
-        name="content",
-        type=SearchFieldDataType.String,
-        searchable=True,
-    ),
-    SearchField(
-        name="content_vector",
-        type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-        searchable=True,
-        vector_search_dimensions=len(embedding_function("Text")),
-        vector_search_profile_name="myHnswProfile",
-    ),
-    SearchableField(
-        name="metadata",
-        type=SearchFieldDataType.String,
-        searchable=True,
-    ),
-    # Additional field to store the title
-    SearchableField(
-        name="title",
-        type=SearchFieldDataType.String,
-        searchable=True,
-    ),
-    # Additional field for filtering on document source
-    SimpleField(
-        name="source",
-        type=SearchFieldDataType.String,
-        filterable=True,
-    ),
-]
-
-index_name: str = os.environ["AZURE_SEARCH_ENDPOINT_INDEX_NAME"]
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=vector_store_address,
-    azure_search_key=vector_store_password,
-    index_name=index_name,
-    embedding_function=embedding_function,
-    fields=fields,
-)
+embedding_model: str = os.environ.get("EMBEDDING_MODEL", "models/embedding-001")
+embedding_cache_dir = os.environ.get("EMBEDDING_CACHE_DIR")
+# as the API, the least recently used vectors are removed beyond it, empty for no limit
+embedding_cache_max_bytes = os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+# size of content_vector, must match the embedding model (768 for models/embedding-001)
+embedding_dimensions: int = int(os.environ.get("EMBEDDING_DIMENSIONS", "768"))
+
+# "azure_search" or "numpy", the in-process index whose snapshots in VECTOR_STORE_DIR the app loads
+vector_store_backend: str = os.environ.get("VECTOR_STORE_BACKEND", "azure_search")
+
+# The embeddings and the vector store are created by the first invocation instead of at import,
+# which keeps the SDK imports and the index check out of the cold start of the host.
+
+def create_embeddings() -> CachedEmbeddings:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    if "GOOGLE_API_KEY" not in os.environ:
+        os.environ["GOOGLE_API_KEY"] = getpass.getpass("Provide your Google API key here")
+
+    return CachedEmbeddings(
+        underlying=GoogleGenerativeAIEmbeddings(model=embedding_model),
+        max_entries=int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "4096")),
+        disk_store=DiskEmbeddingStore(embedding_cache_dir, embedding_model,
+                                      max_bytes=int(embedding_cache_max_bytes) if embedding_cache_max_bytes else None) if embedding_cache_dir else None,
+    )
+
+def create_vector_store():
+    embeddings = embeddings_resource.get()
+
+    if vector_store_backend == "numpy":
+        return NumpyVectorStore(
+            embedding_function=embeddings,
+            directory=os.environ.get("VECTOR_STORE_DIR", "vector_index"),
+            mode=os.environ.get("VECTOR_INDEX_MODE", "flat"),
+            ivf_nlist=int(os.environ.get("VECTOR_INDEX_IVF_NLIST", "0")),
+        )
+
+    from langchain_community.vectorstores.azuresearch import AzureSearch
+    from azure.search.documents.indexes.models import (
+        SearchableField,
+        SearchField,
+        SearchFieldDataType,
+        SimpleField,
+    )
+
+    fields = [
+        SimpleField(
+            name="id",
+            type=SearchFieldDataType.String,
+            key=True,
+            filterable=True,
+        ),
+        SearchableField(
+            name="content",
+            type=SearchFieldDataType.String,
+            searchable=True,
+        ),
+        SearchField(
+            name="content_vector",
+            type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+            searchable=True,
+            vector_search_dimensions=embedding_dimensions,
+            vector_search_profile_name="myHnswProfile",
+        ),
+        SearchableField(
+            name="metadata",
+            type=SearchFieldDataType.String,
+            searchable=True,
+        ),
+        # Additional field to store the title
+        SearchableField(
+            name="title",
+            type=SearchFieldDataType.String,
+            searchable=True,
+        ),
+        # Additional field for filtering on document source
+        SimpleField(
+            name="source",
+            type=SearchFieldDataType.String,
+            filterable=True,
+        ),
+    ]
+
+    index_name: str = os.environ["AZURE_SEARCH_ENDPOINT_INDEX_NAME"]
+    return AzureSearch(
+        azure_search_endpoint=os.environ["AZURE_SEARCH_ENDPOINT"],
+        azure_search_key=os.environ["AZURE_SEARCH_ADMIN_KEY"],
+        index_name=index_name,
+        embedding_function=embeddings,
+        fields=fields,
+    )
+
+def create_index_version():
+    # REDIS_URL of the API when its semantic answer cache is shared through Redis
+    redis_url = os.environ.get("REDIS_URL")
+    if not redis_url:
+        return None
+
+    import redis
+    return IndexVersion(redis.Redis.from_url(redis_url))
+
+embeddings_resource = LazyResource(create_embeddings)
+vector_store_resource = LazyResource(create_vector_store)
+index_version_resource = LazyResource(create_index_version)
 
 # from app.services.langchain_service import LangchainService
 
@@ -90,12 +131,35 @@ def BlobTrigger(myblob: func.InputStream):
                 f"Name: {myblob.name}"
                 f"Blob Size: {myblob.length} bytes")
 
-    file_name = os.path.basename(myblob.name)
-    loader = AzureBlobStorageContainerLoader(conn_str=os.environ["AZURE_STORAGE_CONNECTION_STRING"], 
-                                         container=os.environ['AZURE_STORAGE_BLOB_CONTAINERS'],
-                                         prefix=file_name)
+    container_name = os.environ['AZURE_STORAGE_BLOB_CONTAINERS']
+    blob_name = myblob.name[len(container_name) + 1:] if myblob.name.startswith(container_name + "/") else myblob.name
+
+    blob_service_client = BlobServiceClient.from_connection_string(os.environ["AZURE_STORAGE_CONNECTION_STRING"])
+    etag = blob_service_client.get_blob_client(container=container_name, blob=blob_name).get_blob_properties().etag
+
+    # only the triggered blob is read; unchanged chunks are not embedded again and chunks of
+    # the previous version that are gone are deleted from the index
+    embeddings = embeddings_resource.get()
+    vector_store = vector_store_resource.get()
+
+    config = IngestionConfig.from_env()
+    index_version = index_version_resource.get()
+    # the API only sees the chunks of the numpy index once the snapshot is saved, the version is bumped after it
+    pipeline = IngestionPipeline(embeddings=embeddings, vector_store=vector_store, config=config,
+                                 index_version=None if isinstance(vector_store, NumpyVectorStore) else index_version)
+    # same setting and default as the API, which reads the manifests to tell the index changed
+    manifest_store = IngestionManifestStore(blob_service_client=blob_service_client,
+                                            container_name=os.environ.get("AZURE_STORAGE_MANIFEST_CONTAINER", "ingestion-manifest"))
+
+    if isinstance(vector_store, NumpyVectorStore):
+        # pick up the latest snapshot before changing it
+        vector_store.refresh()
+
+    IncrementalIngestion(pipeline=pipeline, manifest_store=manifest_store, config=config).ingest(myblob, blob_name=blob_name, etag=etag)
 
-    documents = loader.load_and_split()
-    vector_store.add_documents(documents=documents)
+    if isinstance(vector_store, NumpyVectorStore):
+        logging.info(f"Saved vector index snapshot {vector_store.save_snapshot()} ({len(vector_store)} chunks)")
+        if index_version is not None:
+            index_version.bump()
     
 
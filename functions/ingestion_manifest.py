@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from langchain_core.documents import Document
+
+from ingestion_pipeline import IngestionConfig, IngestionPipeline, iter_file_chunks, spool_blob
+
+@dataclass
+class BlobManifest:
+    '''
+    What is indexed for one blob: its etag and content hash when it was ingested and, for
+    every chunk, the chunk hash mapped to its id in the index.
+    '''
+    blob_name: str
+    etag: Optional[str] = None
+    content_hash: Optional[str] = None
+    chunks: Dict[str, str] = field(default_factory=dict)
+
+class IngestionManifestStore:
+    '''
+    Keeps one JSON manifest per source blob in its own container (outside the container the
+    blob trigger listens on, so writing a manifest never triggers an ingestion).
+    '''
+    def __init__(self, blob_service_client: BlobServiceClient, container_name: str):
+        self.container_client = blob_service_client.get_container_client(container_name)
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+
+    def _manifest_name(self, blob_name: str) -> str:
+        return f"{blob_name}.json"
+
+    def get(self, blob_name: str) -> Optional[BlobManifest]:
+        try:
+            data = self.container_client.download_blob(self._manifest_name(blob_name)).readall()
+        except ResourceNotFoundError:
+            return None
+        return BlobManifest(**json.loads(data))
+
+    def save(self, manifest: BlobManifest):
+        self.container_client.upload_blob(self._manifest_name(manifest.blob_name),
+                                          json.dumps(asdict(manifest)),
+                                          overwrite=True,
+                                          content_settings=ContentSettings(content_type="application/json"))
+
+def chunk_hash(doc: Document) -> str:
+    payload = json.dumps({"content": doc.page_content, "metadata": doc.metadata}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class IncrementalIngestion:
+    '''
+    Re-indexes a blob against its manifest: the blob is skipped when its etag or content hash is
+    unchanged, otherwise only chunks with a new hash are embedded and uploaded and chunks of the
+    previous version that no longer exist are deleted from the index.
+    '''
+    def __init__(self, pipeline: IngestionPipeline, manifest_store: IngestionManifestStore, config: IngestionConfig):
+        self.pipeline = pipeline
+        self.manifest_store = manifest_store
+        self.config = config
+
+    def ingest(self, stream, blob_name: str, etag: str = None):
+
+        previous = self.manifest_store.get(blob_name) or BlobManifest(blob_name=blob_name)
+
+        if etag is not None and etag == previous.etag:
+            logging.info(f"Skipping {blob_name}: etag {etag} already indexed")
+            return
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, os.path.basename(blob_name))
+            content_hash = spool_blob(stream, file_path)
+
+            if content_hash == previous.content_hash:
+                logging.info(f"Skipping {blob_name}: content unchanged")
+                previous.etag = etag
+                self.manifest_store.save(previous)
+                return
+
+            current: Dict[str, Optional[str]] = {}
+
+            def changed_chunks():
+                for doc in iter_file_chunks(file_path, source=blob_name, config=self.config):
+                    key = chunk_hash(doc)
+                    if key in current:
+                        continue
+                    current[key] = previous.chunks.get(key)
+                    if current[key] is None:
+                        yield doc
+
+            report = self.pipeline.run(changed_chunks(), source=os.path.basename(blob_name), key_function=chunk_hash)
+
+        for key, chunk_id in report.ids_by_key.items():
+            current[key] = chunk_id
+
+        stale_ids: List[str] = [chunk_id for key, chunk_id in previous.chunks.items() if key not in current]
+        if stale_ids:
+            self.pipeline.delete(stale_ids, source=blob_name)
+
+        logging.info(f"Re-indexed {blob_name}: {len(current)} chunks, {report.uploaded} embedded, "
+                     f"{len(current) - report.uploaded} unchanged, {len(stale_ids)} stale deleted")
+
+        self.manifest_store.save(BlobManifest(blob_name=blob_name, etag=etag, content_hash=content_hash, chunks=current))
@@ -0,0 +1,251 @@
+import logging
+import os
+import hashlib
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+@dataclass
+class IngestionConfig:
+    chunk_size: int = 4000
+    chunk_overlap: int = 200
+    embed_batch_size: int = 64
+    embed_concurrency: int = 4
+    upload_batch_size: int = 500
+    max_retries: int = 5
+    retry_backoff_seconds: float = 1.0
+    progress_every_chunks: int = 200
+
+    @classmethod
+    def from_env(cls) -> "IngestionConfig":
+        return cls(
+            chunk_size=int(os.environ.get("INGESTION_CHUNK_SIZE", cls.chunk_size)),
+            chunk_overlap=int(os.environ.get("INGESTION_CHUNK_OVERLAP", cls.chunk_overlap)),
+            embed_batch_size=int(os.environ.get("INGESTION_EMBED_BATCH_SIZE", cls.embed_batch_size)),
+            embed_concurrency=int(os.environ.get("INGESTION_EMBED_CONCURRENCY", cls.embed_concurrency)),
+            upload_batch_size=int(os.environ.get("INGESTION_UPLOAD_BATCH_SIZE", cls.upload_batch_size)),
+            max_retries=int(os.environ.get("INGESTION_MAX_RETRIES", cls.max_retries)),
+            retry_backoff_seconds=float(os.environ.get("INGESTION_RETRY_BACKOFF_SECONDS", cls.retry_backoff_seconds)),
+            progress_every_chunks=int(os.environ.get("INGESTION_PROGRESS_EVERY_CHUNKS", cls.progress_every_chunks)),
+        )
+
+@dataclass
+class IngestionReport:
+    source: str
+    chunks: int = 0
+    embed_batches: int = 0
+    upload_batches: int = 0
+    uploaded: int = 0
+    retries: int = 0
+    embed_seconds: float = 0.0
+    upload_seconds: float = 0.0
+    started_at: float = field(default_factory=time.perf_counter)
+    elapsed_seconds: float = 0.0
+    ids: List[str] = field(default_factory=list)
+    ids_by_key: Dict[str, str] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def chunks_per_second(self) -> float:
+        elapsed = self.elapsed_seconds or (time.perf_counter() - self.started_at)
+        return self.uploaded / elapsed if elapsed > 0 else 0.0
+
+    def log_progress(self):
+        logging.info(f"Ingestion progress {self.source}: "
+                     f"{self.chunks} chunks read, {self.uploaded} uploaded, "
+                     f"{self.retries} retries, {self.chunks_per_second:.1f} chunks/s")
+
+    def log_summary(self):
+        logging.info(f"Ingestion finished {self.source}: "
+                     f"{self.uploaded}/{self.chunks} chunks in {self.elapsed_seconds:.2f}s "
+                     f"({self.chunks_per_second:.1f} chunks/s), "
+                     f"{self.embed_batches} embed batches ({self.embed_seconds:.2f}s), "
+                     f"{self.upload_batches} upload batches ({self.upload_seconds:.2f}s), "
+                     f"{self.retries} retries")
+
+def with_retry(func, config: IngestionConfig, report: IngestionReport, description: str):
+    '''
+    Call func, retrying with exponential backoff and jitter, so a transient error only
+    repeats one batch instead of failing the whole blob.
+    '''
+    for attempt in range(config.max_retries + 1):
+        try:
+            return func()
+        except Exception as ex:
+            if attempt == config.max_retries:
+                raise
+            delay = config.retry_backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+            with report.lock:
+                report.retries += 1
+            logging.warning(f"{description} failed (attempt {attempt + 1}/{config.max_retries + 1}), retrying in {delay:.1f}s: {ex}")
+            time.sleep(delay)
+
+def spool_blob(stream, file_path: str) -> str:
+    '''
+    Copy a blob stream to a file in 1 MB blocks instead of reading it into memory.
+    :return: sha256 of the content
+    '''
+    content_hash = hashlib.sha256()
+
+    with open(file_path, "wb") as f:
+        while True:
+            block = stream.read(1024 * 1024)
+            if not block:
+                break
+            content_hash.update(block)
+            f.write(block)
+
+    return content_hash.hexdigest()
+
+def iter_file_chunks(file_path: str, source: str, config: IngestionConfig) -> Iterator[Document]:
+    '''
+    Yield the chunks of a spooled blob, only one page is loaded and split at a time.
+    '''
+    # imported here, the document loaders are slow to import and only needed once a blob arrives
+    from langchain_community.document_loaders import PyPDFLoader, UnstructuredFileLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=config.chunk_size, chunk_overlap=config.chunk_overlap)
+
+    if file_path.lower().endswith(".pdf"):
+        loader = PyPDFLoader(file_path)
+    else:
+        loader = UnstructuredFileLoader(file_path)
+
+    for page in loader.lazy_load():
+        page.metadata["source"] = source
+        for chunk in splitter.split_documents([page]):
+            yield chunk
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class IndexVersion:
+    '''
+    Version counter of the index content shared with the API through Redis: the semantic answer
+    cache of every API worker only serves answers cached under the current version. key is the
+    version key of the API's RedisSemanticCacheBackend.
+    '''
+    def __init__(self, redis_client, key: str = "omniqhub:semantic_cache:version"):
+        self.redis = redis_client
+        self.key = key
+
+    def bump(self):
+        # the index is already updated, a failure only leaves cached answers until their TTL
+        try:
+            version = self.redis.incr(self.key)
+            logging.info(f"Index version bumped to {version}")
+        except Exception as ex:
+            logging.warning(f"Could not bump the index version: {ex}")
+
+class IngestionPipeline:
+    '''
+    Embeds chunks in fixed-size batches with at most `embed_concurrency` batches in flight and
+    uploads them to the vector store in batches of `upload_batch_size`, each batch retried on
+    its own. index_version, when given, is bumped once the uploads or deletions are done.
+    '''
+    def __init__(self, embeddings: Embeddings, vector_store: VectorStore, config: IngestionConfig = None,
+                 index_version: IndexVersion = None):
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.config = config or IngestionConfig.from_env()
+        self.index_version = index_version
+
+    def _index_changed(self):
+        if self.index_version is not None:
+            self.index_version.bump()
+
+    def _embed(self, batch: List[Document], report: IngestionReport) -> List[List[float]]:
+        started = time.perf_counter()
+        vectors = with_retry(lambda: self.embeddings.embed_documents([doc.page_content for doc in batch]),
+                             self.config, report, f"Embedding batch of {len(batch)} chunks")
+        with report.lock:
+            report.embed_seconds += time.perf_counter() - started
+        return vectors
+
+    def _upload(self, pending: List[tuple], report: IngestionReport, key_function: Callable[[Document], str] = None):
+        started = time.perf_counter()
+        keys = [key_function(doc) for doc, _ in pending] if key_function else None
+        ids = with_retry(lambda: self.vector_store.add_embeddings(text_embeddings=[(doc.page_content, vector) for doc, vector in pending],
+                                                                  metadatas=[doc.metadata for doc, _ in pending],
+                                                                  keys=keys),
+                         self.config, report, f"Uploading batch of {len(pending)} chunks")
+        report.upload_seconds += time.perf_counter() - started
+        report.upload_batches += 1
+        report.uploaded += len(pending)
+        report.ids.extend(ids)
+        if keys:
+            report.ids_by_key.update(zip(keys, ids))
+
+    def delete(self, ids: List[str], source: str) -> IngestionReport:
+
+        report = IngestionReport(source=source)
+        for batch in iter_batches(ids, self.config.upload_batch_size):
+            with_retry(lambda: self.vector_store.delete(ids=batch), self.config, report, f"Deleting batch of {len(batch)} chunks")
+        report.elapsed_seconds = time.perf_counter() - report.started_at
+
+        if ids:
+            self._index_changed()
+
+        return report
+
+    def run(self, chunks: Iterable[Document], source: str, key_function: Callable[[Document], str] = None) -> IngestionReport:
+        '''
+        :param key_function: optional function returning the index key of a chunk, uploading
+                             a chunk under an existing key replaces it
+        '''
+
+        report = IngestionReport(source=source)
+        pending: List[tuple] = []
+        in_flight = deque()
+
+        def collect(future_batch):
+            future, batch = future_batch
+            pending.extend(zip(batch, future.result()))
+            report.embed_batches += 1
+            while len(pending) >= self.config.upload_batch_size:
+                self._upload(pending[:self.config.upload_batch_size], report, key_function)
+                del pending[:self.config.upload_batch_size]
+
+        with ThreadPoolExecutor(max_workers=self.config.embed_concurrency, thread_name_prefix="embed") as executor:
+            next_progress = self.config.progress_every_chunks
+            for batch in iter_batches(chunks, self.config.embed_batch_size):
+                report.chunks += len(batch)
+                in_flight.append((executor.submit(self._embed, batch, report), batch))
+
+                # bound the number of batches (and so the chunks held in memory) in flight
+                if len(in_flight) >= self.config.embed_concurrency:
+                    collect(in_flight.popleft())
+
+                if report.chunks >= next_progress:
+                    report.log_progress()
+                    next_progress += self.config.progress_every_chunks
+
+            while in_flight:
+                collect(in_flight.popleft())
+
+        if pending:
+            self._upload(pending, report, key_function)
+
+        report.elapsed_seconds = time.perf_counter() - report.started_at
+        report.log_summary()
+
+        if report.uploaded:
+            self._index_changed()
+
+        return report
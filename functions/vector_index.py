@@ -0,0 +1,348 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+class IndexState:
+    '''
+    Immutable view of the index. Writers build a new state and swap it in, so searches never
+    need a lock. vectors are L2-normalized float32 rows (memory mapped when loaded from a snapshot).
+    '''
+    def __init__(self, vectors: np.ndarray, ids: List[str], texts: List[str], metadatas: List[dict],
+                 ivf_centroids: np.ndarray = None, ivf_rows: np.ndarray = None, ivf_offsets: np.ndarray = None):
+        self.vectors = vectors
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.ivf_centroids = ivf_centroids
+        self.ivf_rows = ivf_rows
+        self.ivf_offsets = ivf_offsets
+
+    @classmethod
+    def empty(cls) -> "IndexState":
+        return cls(np.zeros((0, 0), dtype=np.float32), [], [], [])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def build_ivf(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Spherical k-means over the rows. Returns the centroids, the row numbers ordered by list and the
+    offsets of each list in it (list i is rows[offsets[i]:offsets[i + 1]]).
+    '''
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(vectors)))
+    centroids = np.array(vectors[rng.choice(len(vectors), size=nlist, replace=False)], dtype=np.float32)
+
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(nlist):
+            members = vectors[assignment == i]
+            if len(members):
+                centroids[i] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+
+    assignment = np.argmax(vectors @ centroids.T, axis=1)
+    rows = np.argsort(assignment, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(assignment[rows], np.arange(nlist + 1)).astype(np.int64)
+    return centroids, rows, offsets
+
+class NumpyVectorStore(VectorStore):
+    '''
+    In-process vector store, a drop-in alternative to AzureSearch for the retriever and the ingestion
+    pipeline (add_embeddings / delete). Search is exact ("flat") or approximate ("ivf": only the
+    ivf_nprobe lists closest to the query are scanned, exact below ivf_min_rows).
+
+    Relevance scores follow Azure AI Search for cosine similarity, 1 / (2 - cos), so the
+    similarity_score_threshold of the retriever keeps its meaning when switching backends.
+
+    With a directory the store loads the snapshot named in <directory>/CURRENT, memory mapped so
+    several workers share one copy of the vectors, and picks up newer snapshots every
+    reload_interval_seconds. save_snapshot() writes a new snapshot and switches CURRENT atomically;
+    there should be a single writer per directory.
+    '''
+    current_file = "CURRENT"
+
+    def __init__(self, embedding_function: Union[Embeddings, Callable[[str], List[float]]], directory: str = None,
+                 mode: str = "flat", ivf_nlist: int = 0, ivf_nprobe: int = 8, ivf_min_rows: int = 1000,
+                 reload_interval_seconds: float = 30, keep_snapshots: int = 3):
+        self.embedding_function = embedding_function
+        self.directory = directory
+        self.mode = mode
+        self.ivf_nlist = ivf_nlist
+        self.ivf_nprobe = ivf_nprobe
+        self.ivf_min_rows = ivf_min_rows
+        self.reload_interval_seconds = reload_interval_seconds
+        self.keep_snapshots = keep_snapshots
+
+        self._write_lock = threading.RLock()
+        self._state = IndexState.empty()
+        self._revision = 0
+        # _revision when the state last matched the snapshot _version
+        self._snapshot_revision = 0
+        self._version: str = None
+        self._checked_at = 0.0
+
+        if directory:
+            self.refresh(force=True)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_function if isinstance(self.embedding_function, Embeddings) else None
+
+    def _embed_query(self, text: str) -> List[float]:
+        if isinstance(self.embedding_function, Embeddings):
+            return self.embedding_function.embed_query(text)
+        return self.embedding_function(text)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if isinstance(self.embedding_function, Embeddings):
+            return self.embedding_function.embed_documents(texts)
+        return [self.embedding_function(text) for text in texts]
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._version
+
+    @property
+    def revision(self) -> Tuple[Optional[str], int]:
+        '''The loaded snapshot and the changes made since, the same in every process loading it.'''
+        self._maybe_refresh()
+        with self._write_lock:
+            return self._version, self._revision - self._snapshot_revision
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    def get_documents(self) -> Tuple[int, List[Document]]:
+        '''All indexed chunks with a revision number that changes whenever the content does.'''
+        self._maybe_refresh()
+        with self._write_lock:
+            revision, state = self._revision, self._state
+        return revision, [Document(page_content=text, metadata=dict(metadata)) for text, metadata in zip(state.texts, state.metadatas)]
+
+    # writes
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, keys: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self._embed_documents(texts)), metadatas=metadatas, keys=keys)
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]], metadatas: Optional[List[dict]] = None,
+                       keys: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        if not text_embeddings:
+            return []
+
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in text_embeddings]
+        ids = list(keys) if keys is not None else [uuid.uuid4().hex for _ in text_embeddings]
+        vectors = normalize_rows([vector for _, vector in text_embeddings])
+
+        with self._write_lock:
+            state = self._state
+            # same semantics as AzureSearch (merge or upload): an existing id is replaced
+            replaced = set(ids)
+            keep = np.array([id not in replaced for id in state.ids], dtype=bool)
+            old_vectors = state.vectors[keep] if len(state) else np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            if old_vectors.shape[1] != vectors.shape[1]:
+                raise ValueError(f"Embedding dimensions {vectors.shape[1]} do not match the index ({old_vectors.shape[1]})")
+
+            self._revision += 1
+            self._state = IndexState(
+                vectors=np.concatenate([old_vectors, vectors]),
+                ids=[id for id, k in zip(state.ids, keep) if k] + ids,
+                texts=[text for text, k in zip(state.texts, keep) if k] + [text for text, _ in text_embeddings],
+                metadatas=[metadata for metadata, k in zip(state.metadatas, keep) if k] + metadatas,
+            )
+
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+
+        with self._write_lock:
+            state = self._state
+            removed = set(ids)
+            keep = np.array([id not in removed for id in state.ids], dtype=bool)
+            if keep.all():
+                return False
+
+            self._revision += 1
+            self._state = IndexState(
+                vectors=np.ascontiguousarray(state.vectors[keep]),
+                ids=[id for id, k in zip(state.ids, keep) if k],
+                texts=[text for text, k in zip(state.texts, keep) if k],
+                metadatas=[metadata for metadata, k in zip(state.metadatas, keep) if k],
+            )
+
+        return True
+
+    # search
+
+    def _ivf_state(self, state: IndexState) -> IndexState:
+        if self.mode != "ivf" or len(state) < self.ivf_min_rows or state.ivf_centroids is not None:
+            return state
+
+        with self._write_lock:
+            if self._state is state:
+                nlist = self.ivf_nlist or int(np.sqrt(len(state)))
+                self._state = IndexState(state.vectors, state.ids, state.texts, state.metadatas, *build_ivf(state.vectors, nlist))
+            return self._state
+
+    def _search(self, state: IndexState, embedding: List[float], k: int) -> List[Tuple[int, float]]:
+        if not len(state) or k <= 0:
+            return []
+
+        query = normalize_rows(embedding)
+
+        if self.mode == "ivf" and state.ivf_centroids is not None:
+            nprobe = min(self.ivf_nprobe, len(state.ivf_centroids))
+            probes = np.argpartition(-(state.ivf_centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.concatenate([state.ivf_rows[state.ivf_offsets[i]:state.ivf_offsets[i + 1]] for i in probes])
+            scores = state.vectors[rows] @ query
+        else:
+            rows = None
+            scores = state.vectors @ query
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        if rows is not None:
+            return [(int(rows[i]), float(scores[i])) for i in top]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def similarity_search_by_vector_with_vectors(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Tuple[Document, float, np.ndarray]]:
+        '''The chunks with their relevance score and their stored (normalized) vector, e.g. for re-ranking.'''
+        self._maybe_refresh()
+        state = self._ivf_state(self._state)
+        return [(Document(page_content=state.texts[row], metadata=dict(state.metadatas[row])), 1.0 / (2.0 - cosine), state.vectors[row])
+                for row, cosine in self._search(state, embedding, k)]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return [(doc, score) for doc, score, _ in self.similarity_search_by_vector_with_vectors(embedding, k=k, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k=k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_relevance_scores(self._embed_query(query), k=k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # similarity_search_with_score already returns relevance scores
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding_function=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas)
+        return store
+
+    # snapshots
+
+    def _read_current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, self.current_file), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _maybe_refresh(self):
+        if self.directory and time.monotonic() - self._checked_at >= self.reload_interval_seconds:
+            self.refresh()
+
+    def refresh(self, force: bool = False) -> bool:
+        '''Loads the snapshot named in CURRENT when it differs from the loaded one.'''
+        self._checked_at = time.monotonic()
+        version = self._read_current()
+        if version is None or (version == self._version and not force):
+            return False
+
+        state = self.load_snapshot(os.path.join(self.directory, version))
+        with self._write_lock:
+            self._revision += 1
+            self._state = state
+            self._version = version
+            self._snapshot_revision = self._revision
+        return True
+
+    @staticmethod
+    def load_snapshot(path: str) -> IndexState:
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+
+        ids, texts, metadatas = [], [], []
+        with open(os.path.join(path, "documents.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                ids.append(record["id"])
+                texts.append(record["page_content"])
+                metadatas.append(record["metadata"])
+
+        ivf = {}
+        if os.path.exists(os.path.join(path, "ivf_centroids.npy")):
+            ivf = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("ivf_centroids", "ivf_rows", "ivf_offsets")}
+
+        return IndexState(vectors, ids, texts, metadatas, **ivf)
+
+    def save_snapshot(self) -> str:
+        '''Writes the current index as a new snapshot and points CURRENT at it.'''
+        if not self.directory:
+            raise ValueError("NumpyVectorStore has no snapshot directory")
+
+        with self._write_lock:
+            state = self._ivf_state(self._state)
+            os.makedirs(self.directory, exist_ok=True)
+            version = f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+
+            temp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+            try:
+                np.save(os.path.join(temp_path, "vectors.npy"), np.asarray(state.vectors, dtype=np.float32))
+                with open(os.path.join(temp_path, "documents.jsonl"), "w", encoding="utf-8") as f:
+                    for id, text, metadata in zip(state.ids, state.texts, state.metadatas):
+                        f.write(json.dumps({"id": id, "page_content": text, "metadata": metadata}, default=str) + "\n")
+                if state.ivf_centroids is not None:
+                    np.save(os.path.join(temp_path, "ivf_centroids.npy"), state.ivf_centroids)
+                    np.save(os.path.join(temp_path, "ivf_rows.npy"), state.ivf_rows)
+                    np.save(os.path.join(temp_path, "ivf_offsets.npy"), state.ivf_offsets)
+                os.replace(temp_path, os.path.join(self.directory, version))
+            except BaseException:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                raise
+
+            fd, temp_current = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(version)
+            os.replace(temp_current, os.path.join(self.directory, self.current_file))
+
+            self._version = version
+            self._snapshot_revision = self._revision
+            self._prune_snapshots()
+
+        return version
+
+    def _prune_snapshots(self):
+        # older snapshots are kept for a while, other workers may still have them mapped
+        snapshots = sorted(name for name in os.listdir(self.directory)
+                           if not name.startswith(".") and os.path.isdir(os.path.join(self.directory, name)))
+        for name in snapshots[:-self.keep_snapshots]:
+            if name != self._version:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)